@@ -0,0 +1,147 @@
+# Micro-benchmark of alternative forwarding entry handle allocation.
+#
+# Replays the inserts and deletes that TRIM_AND_CLEAR mode sends to one switch,
+# and a steady churn on a full table, against the allocator in entry_handles.py
+# and the scan FelixSwitch used before it, checking both hand out the same
+# handles.
+import random
+import sys
+import time
+
+import entry_handles
+
+
+class ScanHandles:
+    # The previous allocator: a scan from the lowest released index
+    def __init__(self):
+        self.handles = {}
+        self.next_handle = 0
+
+    def allocate(self):
+        while True:
+            handle = self.next_handle
+            self.next_handle = self.next_handle + 1
+            if handle not in self.handles:
+                self.handles[handle] = {'open': False, 'dels': 0}
+                return handle
+            if self.handles[handle]['open']:
+                self.handles[handle]['open'] = False
+                return handle
+
+    def handle(self, index):
+        return 0x1000000*self.handles[index]['dels'] + index
+
+    def release(self, index):
+        self.handles[index]['dels'] += 1
+        self.handles[index]['open'] = True
+        if index < self.next_handle:
+            self.next_handle = index
+
+
+def trim_workload(allocator, n_cycles, n_alt_states, max_entries, rng):
+    # Inserts and deletes of TRIM_AND_CLEAR mode: at every state change, a
+    # trim that keeps the previous and the current states and then entries for
+    # the alternative states of the new one, interleaved as they are when
+    # collected per destination. Returns the operations as a list of None
+    # (insert) or the released index (delete).
+    ops = []
+    entries = {}  # entries[net_state] = [index, ...]
+    prev_net_state = None
+    cur_net_state = 0
+    next_net_state = 1
+    for _ in range(n_cycles):
+        for net_state in list(entries.keys()):
+            if net_state in (prev_net_state, cur_net_state): continue
+            for index in entries.pop(net_state):
+                allocator.release(index)
+                ops.append(index)
+        pending = []
+        for _ in range(rng.randint(1, n_alt_states)):
+            pending.append([next_net_state, rng.randint(1, max_entries)])
+            next_net_state = next_net_state + 1
+        alt_states = [item[0] for item in pending]
+        while pending:
+            for item in pending:
+                entries.setdefault(item[0], []).append(allocator.allocate())
+                ops.append(None)
+                item[1] = item[1] - 1
+            pending = [item for item in pending if item[1] > 0]
+        prev_net_state = cur_net_state
+        cur_net_state = rng.choice(alt_states)
+    return ops
+
+
+def churn_workload(allocator, n_entries, n_ops, rng):
+    # A full table where a random entry is replaced at every step, the worst
+    # case for a scan from the lowest released index
+    ops = []
+    live = []
+    for _ in range(n_entries):
+        live.append(allocator.allocate())
+        ops.append(None)
+    for _ in range(n_ops):
+        i = rng.randrange(len(live))
+        allocator.release(live[i])
+        ops.append(live[i])
+        live[i] = allocator.allocate()
+        ops.append(None)
+    return ops
+
+
+def run(allocator, ops):
+    allocate = allocator.allocate
+    release = allocator.release
+    start = time.perf_counter()
+    for op in ops:
+        if op is None:
+            allocate()
+        else:
+            release(op)
+    return time.perf_counter() - start
+
+
+def trace(allocator, ops):
+    # Device handles of every insert and delete
+    handles = []
+    for op in ops:
+        if op is None:
+            handles.append(allocator.handle(allocator.allocate()))
+        else:
+            handles.append(allocator.handle(op))
+            allocator.release(op)
+    return handles
+
+
+def compare(title, ops):
+    print('{}: {} inserts/deletes'.format(title, len(ops)))
+    traces = {}
+    for name, cls in [('scan', ScanHandles),
+                      ('bitmap', entry_handles.EntryHandles)]:
+        elapsed = run(cls(), ops)
+        traces[name] = trace(cls(), ops)
+        print('{:>8}: {:9.3f} ms, {:6.3f} us per operation'.format(
+            name, elapsed*1e3, elapsed/len(ops)*1e6))
+    if traces['scan'] != traces['bitmap']:
+        print('Handles differ!')
+        sys.exit(1)
+
+
+def main(n_cycles, n_alt_states, max_entries):
+    rng = random.Random(0)
+    ops = trim_workload(entry_handles.EntryHandles(), n_cycles, n_alt_states,
+                        max_entries, rng)
+    compare('{} state changes in TRIM_AND_CLEAR mode'.format(n_cycles), ops)
+    n_entries = n_alt_states*max_entries
+    ops = churn_workload(entry_handles.EntryHandles(), n_entries, n_cycles*10,
+                         rng)
+    compare('Churn on {} entries'.format(n_entries), ops)
+    print('Handles are identical.')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 3:
+        main(int(sys.argv[1]), int(sys.argv[2]), int(sys.argv[3]))
+    else:
+        print('Usage: python3 benchmark_entry_handles.py <n_state_changes> <max_alt_states> <max_entries_per_alt_state>')
+        print('Using defaults... 2000 60 20')
+        main(2000, 60, 20)
@@ -6,6 +6,9 @@ import time
 
 from scapy.all import sniff, Packet, IntField, Ether, bind_layers
 
+import journal
+import shutdown
+
 
 CPU_PORT = 99
 
@@ -33,7 +36,7 @@ bind_layers(Ether, ClassicAnnouncement, type=0x88B5)
 
 class PacketSniffer(threading.Thread):
     def __init__(self, switch_name, interface, ann_queue, verbose=False):
-        threading.Thread.__init__(self)
+        threading.Thread.__init__(self, daemon=True)
         self.switch_name = switch_name
         self.interface = interface
         self.ann_queue = ann_queue
@@ -49,7 +52,7 @@ class PacketSniffer(threading.Thread):
         sniff(iface=self.interface, prn=lambda x: self.process_packet(x))
 
 def announcements(switches, verbose=False):
-    ann_queue = queue.Queue()
+    ann_queue = queue.SimpleQueue()
 
     if verbose:
         print('Creating sniffer threads.')
@@ -69,24 +72,34 @@ def announcements(switches, verbose=False):
 
 
 class DelayedEntryUpdates(threading.Thread):
-    def __init__(self, switch_manager, prop_delay, install_delay, entries):
+    def __init__(self, switch_manager, prop_delay, install_delay, entries,
+                 priority=None):
         threading.Thread.__init__(self)
         self.switch_manager = switch_manager
         self.prop_delay = prop_delay
         self.install_delay = install_delay
         self.entries = entries
+        if priority is not None:
+            # Highest priority first, entries with the same one in FIFO order
+            self.entries = sorted(entries, key=lambda x: -priority(x))
 
     def run(self):
-        time.sleep(self.prop_delay)
-        with open('/tmp/felix_routing_exit_flag') as f:
-            if f.read() == '1':
-                return
+        # Waiting on the exit event returns right away on shutdown
+        if shutdown.exit_event.wait(self.prop_delay):
+            return
+        name = self.switch_manager.name
         for entry in self.entries:
-            time.sleep(self.install_delay)
-            with open('/tmp/felix_routing_exit_flag') as f:
-                if f.read() == '0':
-                    self.switch_manager.set_nrml_fwding_entry(entry[0], entry[1])
-
-def send_entry_updates(switch_manager, prop_delay, install_delay, entries):
-    thr = DelayedEntryUpdates(switch_manager, prop_delay, install_delay, entries)
+            if shutdown.exit_event.wait(self.install_delay):
+                return
+            journal.record('entry_write', switch=name, dst=entry[0]['name'])
+            batch = self.switch_manager.set_nrml_fwding_entry(entry[0], entry[1])
+            if batch is not None and journal.journal is not None:
+                self.switch_manager.on_batch_done(batch, lambda info, batch=batch: journal.record(
+                    'entry_ack', switch=name, batch=batch, n=1))
+
+def send_entry_updates(switch_manager, prop_delay, install_delay, entries,
+                       priority=None):
+    # priority(entry), if given, orders the installation of entries
+    thr = DelayedEntryUpdates(switch_manager, prop_delay, install_delay, entries,
+                              priority)
     thr.start()
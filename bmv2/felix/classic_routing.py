@@ -6,9 +6,14 @@ import sys
 import time
 
 import networkx as nx
+import numpy as np
 
 import classic_broker
 import classic_switch
+import compute_cost
+import journal
+import shutdown
+import spdag
 
 
 def bitwise_not(n, numbits=32):
@@ -26,6 +31,24 @@ def sort_links(links):
     return sorted(links, key=lambda x: (int(x[0][1:]), int(x[1][1:])))
 
 
+def demand_matrix(graph, demands):
+    # demand[src][dst] over node indices, from demands[src name][dst name]
+    demand = np.zeros((graph.n_nodes, graph.n_nodes))
+    for src, rates in demands.items():
+        for dst, rate in rates.items():
+            if src in graph.index and dst in graph.index:
+                demand[graph.index[src], graph.index[dst]] += rate
+    return demand
+
+
+def entry_priority(graph, node_load, cur_hop):
+    # Entries carrying the most traffic towards their destination first
+    cur = graph.index[cur_hop]
+    def priority(entry):
+        return node_load[graph.index[entry[0]['name']], cur]
+    return priority
+
+
 def main(topology_json):
     print('Classic Routing starting up.')
 
@@ -36,6 +59,17 @@ def main(topology_json):
     slowdown = netinfo['slowdown']
     ei_rate = netinfo['entry_installation_rate']
     ei_delay = (1.0/ei_rate)*slowdown
+    driver = netinfo['switch_driver'] if 'switch_driver' in netinfo else 'cli'
+    INSTALL_ORDER = netinfo['install_order'] if 'install_order' in netinfo else 'fifo'
+    if INSTALL_ORDER not in ('fifo', 'impact'):
+        raise Exception('Unknown install order {}.'.format(INSTALL_ORDER))
+    demands = netinfo['demands'] if 'demands' in netinfo else {}
+    cost_model = compute_cost.CostModel(
+        netinfo['compute_cost_model'] if 'compute_cost_model' in netinfo else 'none',
+        slowdown,
+        netinfo['compute_cost_per_destination']/1e6 if 'compute_cost_per_destination' in netinfo else None)
+    if netinfo['event_journal'] if 'event_journal' in netinfo else True:
+        journal.open_journal('logs/classic_routing_events.jsonl')
     del switches['s0']
 
     # Create switch interface objects and configure forwarding to hosts
@@ -43,7 +77,8 @@ def main(topology_json):
     for sname, sinfo in switches.items():
         if sname == 's0':
             continue
-        man[sname] = classic_switch.ClassicSwitch(sinfo, script='classic')
+        man[sname] = classic_switch.ClassicSwitch(sinfo, script='classic',
+                                                  driver=driver)
         for peer in sinfo['adj'].keys():
             if peer[0] == 'h':
                 man[sname].add_nrml_fwding_entry_host(netinfo['hosts'][peer])
@@ -68,7 +103,6 @@ def main(topology_json):
 
     # Create graph to represent the current network state
     net = nx.Graph()
-    fwd = {}  # fwd[dst][cur_hop] = next_hop
     node_links = {}
     port_to_peer = {}
     for sname, sinfo in switches.items():
@@ -83,52 +117,72 @@ def main(topology_json):
                 net.add_edge(sname, peer, weight=link_delay[sname][peer])
                 node_links[sname].append(order_link((sname, peer)))
     
+    # Shortest paths to every destination, repaired after each failure only
+    # for the destinations whose SPDAG used a failed link
+    graph = spdag.CSRGraph.from_networkx(net, nodes=switches.keys(),
+                                         weight='weight')
+    fwd = None  # forwarding state (SPDAG to each dst) of the current network
+    installed = None  # installed[dst][cur] = next-hop bitmask of the entries
+    new_failed_links = []
+    demand = None
+    if INSTALL_ORDER == 'impact':
+        demand = demand_matrix(graph, demands)
+
     failed_links = set()
     ann_queue = classic_broker.announcements(switches)
+    shutdown.listen(ann_queue)
     changed = True
     init = True
     while True:
         if changed is True:
-            ## Run dijkstra for each switch as destination
+            ## Run (or repair) dijkstra for each switch as destination
             print('Computing (new) forwarding entries.')
-            st = time.time()
+            timer = compute_cost.PhaseTimer()
+            journal.record('compute_start', n_failed_links=len(failed_links))
             changes = {}
-            for dst, dstinfo in switches.items():
-                if dst == 's0':
-                    continue
-                pred, _ = nx.dijkstra_predecessor_and_distance(net, dst, weight='weight')
-                if dst not in fwd:
-                    fwd[dst] = {}
-                for cur_hop, next_hops in pred.items():
-                    o_next_hops = sorted(next_hops)
-                    if cur_hop not in fwd[dst]:
-                        fwd[dst][cur_hop] = []
-                    if len(o_next_hops) > 0 and o_next_hops != fwd[dst][cur_hop]:
-                        if cur_hop not in changes:
-                            changes[cur_hop] = []
-                        changes[cur_hop].append([dstinfo, o_next_hops])
-                        fwd[dst][cur_hop] = o_next_hops
-                # for cur_hop in switches.keys():
-                #     if cur_hop not in pred:
-                #         print('{} will drop packets to {}'.format(cur_hop, dst))
-                #         if cur_hop not in changes:
-                #             changes[cur_hop] = []
-                #         changes[cur_hop].append([dstinfo, ['drop']])
-                #         fwd[dst][cur_hop] = ['drop']
-            et = time.time()
+            if fwd is None:
+                fwd = spdag.ForwardingState.compute(graph)
+                installed = np.zeros_like(fwd.nexthops)
+            else:
+                fwd = fwd.derive(new_failed_links)
+            new_failed_links = []
+            # Switches that lost every path to a destination keep their
+            # entries to it (and drop the packets at the failed link)
+            updated = (fwd.nexthops != installed) & (fwd.nexthops != 0)
+            for dst, cur in zip(*updated.nonzero()):
+                cur_hop = graph.nodes[cur]
+                if cur_hop not in changes:
+                    changes[cur_hop] = []
+                changes[cur_hop].append([switches[graph.nodes[dst]],
+                                         fwd.next_hops(dst, cur)])
+            installed = np.where(updated, fwd.nexthops, installed)
+            elapsed = timer.lap('compute')
+            journal.record('compute_end',
+                           n_changes=sum(len(entries) for entries in changes.values()),
+                           n_computed=fwd.n_computed)
             # Simulate computation delay
-            # if init is False:
-                # time_to_sleep = (et - st)*1e6*slowdown - (et - st)
-                # print('Sleeping for {:.3f} seconds.'.format(time_to_sleep))
-                # time.sleep(time_to_sleep)
+            if init is True:
+                cost_model.calibrate(elapsed, fwd.n_computed)
+            elif cost_model.inject(elapsed, fwd.n_computed):
+                timer.lap('compute delay')
             # Install entries
             print('Installing/updating forwarding entries.')
+            if INSTALL_ORDER == 'impact':
+                node_load = fwd.loads(demand)[0]
             for cur_hop, entries in changes.items():
                 prop_delay = 0 if init is True else delay_to_dp[cur_hop]
                 install_delay = 0 if init is True else ei_delay
+                priority = None
+                if INSTALL_ORDER == 'impact':
+                    priority = entry_priority(graph, node_load, cur_hop)
                 classic_broker.send_entry_updates(man[cur_hop], prop_delay,
-                                                  install_delay, entries)
+                                                  install_delay, entries,
+                                                  priority)
             init = False
+            timer.lap('send')
+            print('Computed {} changes ({} destinations): {}'.format(
+                sum(len(entries) for entries in changes.values()),
+                fwd.n_computed, timer.report()))
 
         changed = False
 
@@ -142,11 +196,14 @@ def main(topology_json):
                 ann = ann_queue.get(timeout=1)
             except queue.Empty:
                 pass
-            with open('/tmp/felix_routing_exit_flag') as f:
-                if f.read() == '1':
-                    print('Exiting!')
-                    sys.exit(0)
+            if ann is shutdown.EXIT:
+                print('Exiting!')
+                journal.record('exit')
+                sys.exit(0)
         print('\nAnnouncement received!', ann)
+        journal.record('announcement', announcer=ann.announcer,
+                       new_loc_state=ann.new_loc_state,
+                       prev_loc_state=ann.prev_loc_state)
 
         loc_state_change = ann.prev_loc_state & (bitwise_not(ann.new_loc_state))
         u = ann.announcer
@@ -157,6 +214,8 @@ def main(topology_json):
                     changed = True
                     net.remove_edge(u, v)
                     failed_links.add(order_link((u, v)))
+                    new_failed_links.append((u, v))
+                    journal.record('state_change', failed_link='-'.join(order_link((u, v))))
 
 
 if __name__ == '__main__':
@@ -1,17 +1,19 @@
 import os
-import subprocess
 import time
 
+import cli_session
+import selector_pool
+
+
+SELECTOR_SIZE = 128  # members of nrml_selector, as declared in classic.p4
+
 
 class ClassicSwitch:
-    def __init__(self, sw_info, script='classic'):
+    def __init__(self, sw_info, script='classic', driver='cli'):
         #
         self.thrift_port = sw_info['thrift_port']
-        cmd = ['runtime_CLI.py', '--thrift-port', str(self.thrift_port)]
         self.log = open('logs/{}_{}.log'.format(sw_info['name'], script), 'w')
-        self.conn = subprocess.Popen(cmd, stdin=subprocess.PIPE,
-                                     stdout=self.log, stderr=subprocess.STDOUT,
-                                     text=True)
+        self.session = cli_session.connect(sw_info, self.log, driver=driver)
         #
         self.id = sw_info['id']
         self.name = sw_info['name']
@@ -26,20 +28,30 @@ class ClassicSwitch:
                 self.d_loc_state = self.d_loc_state | (1 << (port - 1))
         self.loc_state = None
         # Normal Forwarding
+        self.nf_pool = selector_pool.SelectorPool(self, 'ingress.nrml_selector',
+                                                  SELECTOR_SIZE)
         self.nf_member_handles = {}
-        self.nf_groups = {}
+        self.nf_entries = {}  # nf_entries[dst] = {'handle', 'group'}
+        self.next_nf_entry_handle = 0
 
     def __del__(self):
-        self._cmd('EOF')
-        self.conn.wait()
+        self.session.close()
         self.log.close()
 
     def _cmd(self, cmdline, flush=True):
-        clean_cmdline = cmdline.strip('\n')
-        self.log.write('{}\n'.format(clean_cmdline))
-        self.conn.stdin.write(clean_cmdline + '\n')
-        if flush:
-            self.conn.stdin.flush()
+        self.session.cmd(cmdline, flush=flush)
+
+    def begin_batch(self):
+        self.session.begin_batch()
+
+    def end_batch(self):
+        return self.session.end_batch()
+
+    def wait_batch(self, batch, timeout=None):
+        return self.session.wait_batch(batch, timeout=timeout)
+
+    def on_batch_done(self, batch, callback):
+        self.session.on_batch_done(batch, callback)
 
     def init_state(self, reset=False):
         reg_wr1 = ''
@@ -65,13 +77,13 @@ class ClassicSwitch:
             raise Exception('Invalid link (connected to s0 or host) to take down.')
         if_down = 'ifconfig {}-eth{} down'
         if_down = if_down.format(self.name, self.adj[peer])
-        self.log.write('{}\n'.format(if_down))
+        self.session.write_log('{}\n'.format(if_down))
         os.system(if_down)
 
     def set_all_interfaces_up(self, reset=False):
         if_up = 'ifconfig {}-eth{} up'
         for port in self.adj.values():
-            self.log.write('{}\n'.format(if_up.format(self.name, port)))
+            self.session.write_log('{}\n'.format(if_up.format(self.name, port)))
             os.system(if_up.format(self.name, port))
         #
         self.init_state(reset=reset)
@@ -87,16 +99,14 @@ class ClassicSwitch:
         if_down = 'ifconfig {}-eth{} down'
         for port in self.adj.values():
             cmd = cmd + '{}\n'.format(if_down.format(self.name, port))
-        self.log.write(cmd)
+        self.session.write_log(cmd)
         os.system(cmd)
     
     def _create_forwarding_act_prof_members(self):
         # Create normal forwarding members
-        apcm = 'act_prof_create_member ingress.nrml_selector nrml_fwd {}'
         for peer, port in self.adj.items():
-            new_handle = len(self.nf_member_handles)
-            self.nf_member_handles[peer] = new_handle
-            self._cmd(apcm.format(port))
+            self.nf_member_handles[peer] = self.nf_pool.get_member(
+                'nrml_fwd {}'.format(port))
         # # Create drop member
         # apcm = 'act_prof_create_member ingress.nrml_selector drop'
         # new_handle = len(self.nf_member_handles)
@@ -113,45 +123,38 @@ class ClassicSwitch:
         add_entry = add_entry.format(host['ip'][:-3] + '/32',
                                      self.nf_member_handles[host['name']])
         self._cmd(add_entry)
+        self.next_nf_entry_handle = self.next_nf_entry_handle + 1
 
     def set_nrml_fwding_entry(self, dstinfo, next_hops):
+        self.begin_batch()
         # Make sure base members exist
         if len(self.nf_member_handles) == 0:
             self._create_forwarding_act_prof_members()
-        # Make sure group and forwarding entry exists
+        # Get group of members pointing to the next hops (shared with every
+        # other destination with the same next hops)
         dstname = dstinfo['name']
-        new_group = False
-        if dstname not in self.nf_groups:
-            # Create group
-            create_group = 'act_prof_create_group ingress.nrml_selector'
-            self._cmd(create_group)
-            new_handle = len(self.nf_groups)
-            self.nf_groups[dstname] = {
-                "handle": new_handle,
-                "members": []
-            }
-            new_group = True
-        # Figure out members to add and to remove
-        to_add = set(next_hops) - set(self.nf_groups[dstname]['members'])
-        # to_add = sorted(next_hops)
-        to_del = set(self.nf_groups[dstname]['members']) - set(next_hops)
-        # to_del = self.nf_groups[dstname]['members']
-        self.nf_groups[dstname]['members'] = next_hops
-        group_handle = self.nf_groups[dstname]['handle']
-        # Add new members to group
-        for adj in to_add:
-            member_handle = self.nf_member_handles[adj]
-            add_m2g = 'act_prof_add_member_to_group ingress.nrml_selector {} {}'
-            add_m2g = add_m2g.format(member_handle, group_handle)
-            self._cmd(add_m2g)
-        # And remove deprecated members from group
-        for adj in to_del:
-            member_handle = self.nf_member_handles[adj]
-            add_m2g = 'act_prof_remove_member_from_group ingress.nrml_selector {} {}'
-            add_m2g = add_m2g.format(member_handle, group_handle)
-            self._cmd(add_m2g)
-        # Create forwarding entry (if new group)
-        if new_group is True:
+        group_handle = self.nf_pool.get_group([
+            'nrml_fwd {}'.format(self.adj[next_hop]) for next_hop in next_hops])
+        if dstname not in self.nf_entries:
+            # Create forwarding entry
             add_entry = 'table_indirect_add_with_group ingress.nrml_fwding_table {} => {}'
-            add_entry = add_entry.format(dstinfo['ip'], new_handle)
+            add_entry = add_entry.format(dstinfo['ip'], group_handle)
             self._cmd(add_entry)
+            self.nf_entries[dstname] = {'handle': self.next_nf_entry_handle,
+                                        'group': group_handle}
+            self.next_nf_entry_handle = self.next_nf_entry_handle + 1
+        elif self.nf_entries[dstname]['group'] != group_handle:
+            # Point forwarding entry to the new group
+            mod_entry = 'table_indirect_modify_with_group ingress.nrml_fwding_table {} {}'
+            mod_entry = mod_entry.format(self.nf_entries[dstname]['handle'],
+                                         group_handle)
+            self._cmd(mod_entry)
+            self.nf_pool.put_group(self.nf_entries[dstname]['group'])
+            self.nf_entries[dstname]['group'] = group_handle
+        else:
+            self.nf_pool.put_group(group_handle)
+        self.nf_pool.collect_if_needed()
+        return self.end_batch()
+
+    def selector_occupancy(self):
+        return {'nrml_selector': self.nf_pool.occupancy()}
@@ -0,0 +1,139 @@
+import collections
+import os
+import re
+import subprocess
+import threading
+import time
+
+
+# Batches end with a marker line that runtime_CLI.py does not know. Its
+# "Unknown syntax" reply tells us every command before it was processed.
+BATCH_MARKER = 'felix_batch'
+BATCH_MARKER_RE = re.compile(r'Unknown syntax: ' + BATCH_MARKER + r' (\d+)')
+
+
+class RuntimeCLISession:
+    def __init__(self, thrift_port, log):
+        self.log = log
+        self.log_lock = threading.Lock()
+        cmd = ['runtime_CLI.py', '--thrift-port', str(thrift_port)]
+        env = dict(os.environ, PYTHONUNBUFFERED='1')
+        self.conn = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT, text=True,
+                                     env=env)
+        # Batching
+        self.batch_lock = threading.RLock()
+        self.depth = 0
+        self.pending = []
+        self.next_batch = 0
+        # Acknowledgements
+        self.acks = threading.Condition()
+        self.batches = {}  # batches[batch] = {'n_cmds', 'sent', 'done', 'errors', 'callbacks'}
+        self.in_flight = collections.deque()
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
+
+    def write_log(self, text):
+        with self.log_lock:
+            self.log.write(text)
+
+    def cmd(self, cmdline, flush=True):
+        clean_cmdline = cmdline.strip('\n')
+        with self.batch_lock:
+            if self.depth > 0:
+                self.pending.append(clean_cmdline)
+                return
+            self.write_log('{}\n'.format(clean_cmdline))
+            self.conn.stdin.write(clean_cmdline + '\n')
+            if flush:
+                self.conn.stdin.flush()
+
+    def begin_batch(self):
+        # Batches may be nested, only the outermost one is sent
+        self.batch_lock.acquire()
+        self.depth = self.depth + 1
+
+    def end_batch(self):
+        try:
+            self.depth = self.depth - 1
+            if self.depth > 0 or not self.pending:
+                return None
+            return self._send_batch()
+        finally:
+            self.batch_lock.release()
+
+    def _send_batch(self):
+        batch = self.next_batch
+        self.next_batch = self.next_batch + 1
+        cmdlines = self.pending
+        self.pending = []
+        with self.acks:
+            self.batches[batch] = {'n_cmds': len(cmdlines), 'sent': time.time(),
+                                   'done': None, 'errors': 0, 'callbacks': []}
+            self.in_flight.append(batch)
+        self.write_log(''.join('{}\n'.format(c) for c in cmdlines))
+        self.conn.stdin.write(''.join('{}\n'.format(c) for c in cmdlines))
+        self.conn.stdin.write('{} {}\n'.format(BATCH_MARKER, batch))
+        self.conn.stdin.flush()
+        return batch
+
+    def _read(self):
+        for line in self.conn.stdout:
+            m = BATCH_MARKER_RE.search(line)
+            with self.acks:
+                if m is None:
+                    if 'Error' in line and self.in_flight:
+                        self.batches[self.in_flight[0]]['errors'] += 1
+                    self.write_log(line)
+                    continue
+                batch = int(m.group(1))
+                while self.in_flight and self.in_flight[0] <= batch:
+                    self.in_flight.popleft()
+                info = self.batches[batch]
+                info['done'] = time.time()
+                callbacks = info['callbacks']
+                info['callbacks'] = []
+                self.acks.notify_all()
+            self.write_log('# batch {} done: {} commands, {} errors, {:.3f} ms\n'.format(
+                batch, info['n_cmds'], info['errors'],
+                (info['done'] - info['sent'])*1e3))
+            for callback in callbacks:
+                callback(info)
+        with self.acks:
+            self.in_flight.clear()
+            self.acks.notify_all()
+
+    def wait_batch(self, batch, timeout=None):
+        # Returns the batch info once acknowledged (None on timeout)
+        with self.acks:
+            self.acks.wait_for(lambda: self.batches[batch]['done'] is not None
+                               or self.conn.poll() is not None, timeout)
+            if self.batches[batch]['done'] is None:
+                return None
+            return self.batches[batch]
+
+    def on_batch_done(self, batch, callback):
+        # Calls callback(info) once the batch is acknowledged, without waiting
+        with self.acks:
+            info = self.batches[batch]
+            if info['done'] is None:
+                info['callbacks'].append(callback)
+                return
+        callback(info)
+
+    def close(self):
+        self.cmd('EOF')
+        self.conn.wait()
+        self.reader.join()
+
+
+def connect(sw_info, log, driver='cli'):
+    # Opens the session used by a switch class to send runtime_CLI commands
+    if driver == 'p4runtime':
+        # Only needed (and importable) when grpc and p4runtime are installed
+        import p4runtime_session
+        return p4runtime_session.P4RuntimeSession(sw_info, log)
+    if driver != 'cli':
+        raise Exception('Unknown switch driver {}.'.format(driver))
+    return RuntimeCLISession(sw_info['thrift_port'], log)
@@ -0,0 +1,75 @@
+# Emulation of the time the routing scripts take to compute routes
+#
+# Experiments run slowdown times slower than the network they emulate, while
+# the controllers compute at full speed, so route computation would look
+# slowdown times faster than it is. A cost model gives the computation time in
+# experiment time, and the routing scripts wait for what is left of it before
+# sending entries to the switches.
+#
+# Models:
+#   "none"            no delay (the default)
+#   "measured"        the measured computation time, times slowdown
+#   "per_destination" a cost per destination computed (or repaired), times
+#                     slowdown. The cost is given in the configuration, so
+#                     runs on different machines are delayed the same, or
+#                     else measured on the computation at startup.
+import time
+
+import shutdown
+
+
+MODELS = ('none', 'measured', 'per_destination')
+
+
+class CostModel:
+    def __init__(self, model, slowdown, cost_per_dst=None):
+        if model not in MODELS:
+            raise Exception('Unknown compute cost model {}.'.format(model))
+        self.model = model
+        self.slowdown = slowdown
+        self.cost_per_dst = cost_per_dst  # seconds, without slowdown
+
+    def calibrate(self, elapsed, n_dst):
+        # Per destination cost from the computation at startup, if not given
+        if self.cost_per_dst is None and n_dst > 0:
+            self.cost_per_dst = elapsed/n_dst
+
+    def cost(self, elapsed, n_dst):
+        # Computation time in experiment time
+        if self.model == 'measured':
+            return elapsed*self.slowdown
+        if self.model == 'per_destination':
+            return (self.cost_per_dst or 0)*n_dst*self.slowdown
+        return 0.0
+
+    def inject(self, elapsed, n_dst):
+        # Waits for the rest of the cost (elapsed seconds are already spent),
+        # returning early on shutdown. Returns the time waited.
+        delay = self.cost(elapsed, n_dst) - elapsed
+        if delay <= 0:
+            return 0.0
+        shutdown.exit_event.wait(delay)
+        return delay
+
+
+class PhaseTimer:
+    # Wall-clock time of the phases of one reaction to a network change
+    def __init__(self):
+        self.phases = []  # [(name, seconds)]
+        self.last = time.monotonic()
+
+    def lap(self, name):
+        # Ends phase name (started at the previous lap) and returns its time
+        now = time.monotonic()
+        elapsed = now - self.last
+        self.phases.append((name, elapsed))
+        self.last = now
+        return elapsed
+
+    def total(self, names=None):
+        return sum(elapsed for name, elapsed in self.phases
+                   if names is None or name in names)
+
+    def report(self):
+        return ', '.join('{} {:.3f} ms'.format(name, elapsed*1e3)
+                         for name, elapsed in self.phases)
@@ -10,6 +10,7 @@ CPU_PORT = 99
 BROADCAST_MC_GRP = 99
 SELECT_MC_GRP = 100
 BASE_THRIFT_PORT = 9090
+BASE_GRPC_PORT = 50051  # switches get gRPC ports and device ids in the same order as thrift ports
 
 
 def main(p4prog, exp_json):
@@ -40,6 +41,7 @@ def main(p4prog, exp_json):
     if queue_rate is not None:
         queue_rate = queue_rate//slowdown
     queue_depth = net['queue_depth'] if 'queue_depth' in net else None
+    def_link_failure_prob = net['default_link_failure_prob'] if 'default_link_failure_prob' in net else 0.01
     if queue_depth is not None:
         queue_depth = queue_depth//slowdown
     edge_switches = None
@@ -52,6 +54,7 @@ def main(p4prog, exp_json):
     switches = {}
     hosts = {}
     links = []
+    link_failure_probs = {}
     table_entries = {}
     mc_grp_entries = {}
     cli_commands = {}
@@ -75,6 +78,8 @@ def main(p4prog, exp_json):
         'ip': '10.0.0.0/24',
         'mac': '01:02:04:08:16:32',
         'thrift_port': BASE_THRIFT_PORT + 0,
+        'grpc_port': BASE_GRPC_PORT + 0,
+        'device_id': 0,
         'adj': {},
         'runtime_json': 'config/s0-runtime.json'
     }
@@ -100,6 +105,8 @@ def main(p4prog, exp_json):
             'ip': '10.0.{}.0/24'.format(snum),
             'mac': '08:00:00:00:{:02X}:00'.format(snum),
             'thrift_port': BASE_THRIFT_PORT + snum,
+            'grpc_port': BASE_GRPC_PORT + snum,
+            'device_id': snum,
             'adj': {},
             'runtime_json': 'config/{}-runtime.json'.format(sname),
             'cli_input': 'config/{}-cli.txt'.format(sname)
@@ -185,6 +192,13 @@ def main(p4prog, exp_json):
         link_delay = def_link_delay
         if 'delay' in link:
             link_delay = '{:.0f}us'.format(link['delay']*slowdown)
+        link_failure_prob = def_link_failure_prob
+        if 'failure_prob' in link:
+            link_failure_prob = link['failure_prob']
+        if not 0 <= link_failure_prob < 1:
+            raise Exception('Failure probability of link {}-{} must be in [0, 1).'.format(uname, vname))
+        link_name = '{}-{}'.format(*sorted([uname, vname], key=lambda x: int(x[1:])))
+        link_failure_probs[link_name] = link_failure_prob
 
         # Add adjacency between switches
         uport = next_port[uname]
@@ -246,6 +260,21 @@ def main(p4prog, exp_json):
         mc_grp_entries[sname].append(broadcast_mc_grp)
         mc_grp_entries[sname].append(select_mc_grp)
 
+    # Aggregate workload demands by the switches of their hosts
+    demands = {}  # demands[src switch][dst switch] = rate (Mbps)
+    if 'workload' in exp:
+        wl = exp['workload']
+        multiplier = wl['multiplier'] if 'multiplier' in wl else 1.0
+        for demand in wl['demands']:
+            src = hosts[demand['src']]['adj']
+            dst = hosts[demand['dst']]['adj']
+            if src == dst: continue
+            if src not in demands:
+                demands[src] = {}
+            if dst not in demands[src]:
+                demands[src][dst] = 0
+            demands[src][dst] = demands[src][dst] + (demand['rate']/slowdown)*multiplier
+
     # Generate topology.json configuration file
     topology_json = {
         'capture_traffic': exp['capture_traffic'],
@@ -255,9 +284,22 @@ def main(p4prog, exp_json):
         'hosts': hosts,
         'switches': switches,
         'entry_installation_rate': net['entry_installation_rate'],
+        'routing_workers': exp['routing_workers'] if 'routing_workers' in exp else 1,
+        'switch_driver': exp['switch_driver'] if 'switch_driver' in exp else 'cli',
+        'table_reconciliation': exp['table_reconciliation'] if 'table_reconciliation' in exp else False,
+        'lookahead_depth': exp['lookahead_depth'] if 'lookahead_depth' in exp else 1,
+        'lookahead_states': exp['lookahead_states'] if 'lookahead_states' in exp else 32,
+        'lookahead_cache_size': exp['lookahead_cache_size'] if 'lookahead_cache_size' in exp else 256,
+        'link_failure_probs': link_failure_probs,
+        'install_order': exp['install_order'] if 'install_order' in exp else 'fifo',
+        'compute_cost_model': exp['compute_cost_model'] if 'compute_cost_model' in exp else 'none',
+        'event_journal': exp['event_journal'] if 'event_journal' in exp else True,
+        'demands': demands,
         'links': links,
         'failures': exp['network']['failures']
     }
+    if 'compute_cost_per_destination' in exp:
+        topology_json['compute_cost_per_destination'] = exp['compute_cost_per_destination']
     print('Creating config/topology.json', end='... ')
     with open('config/topology.json', 'w') as f:
         json.dump(topology_json, f, indent=4)
@@ -0,0 +1,54 @@
+# Table entry handles, mirroring the way bmv2 hands them out.
+#
+# bmv2 reuses the lowest free index first and keeps a version above the index
+# bits that goes up every time the index is freed, so a stale handle can not
+# delete the entry that reused its index.
+VERSION_SHIFT = 24
+WORD_SHIFT = 6  # 64 indices per bitmap word
+WORD_MASK = (1 << WORD_SHIFT) - 1
+
+
+class EntryHandles:
+    # Free indices are kept in a two-level bitmap: words of 64 indices and a
+    # summary with one bit per non-empty word, so finding the lowest free index
+    # takes the lowest set bit of two small integers.
+    def __init__(self):
+        self.words = []  # words[w] = bitmap of free indices (w << WORD_SHIFT) + b
+        self.summary = 0  # bit w is set when words[w] is not empty
+        self.versions = []  # versions[index] = times index was released
+
+    def allocate(self):
+        summary = self.summary
+        if summary:
+            w = (summary & -summary).bit_length() - 1
+            word = self.words[w]
+            lowest = word & -word
+            word = word ^ lowest
+            self.words[w] = word
+            if not word:
+                self.summary = summary ^ (1 << w)
+            return (w << WORD_SHIFT) | (lowest.bit_length() - 1)
+        index = len(self.versions)
+        self.versions.append(0)
+        if not index & WORD_MASK:
+            self.words.append(0)
+        return index
+
+    def handle(self, index):
+        # Handle of the entry currently using index, as returned by bmv2
+        return (self.versions[index] << VERSION_SHIFT) | index
+
+    def release(self, index):
+        self.versions[index] += 1
+        w = index >> WORD_SHIFT
+        self.words[w] |= 1 << (index & WORD_MASK)
+        self.summary |= 1 << w
+
+    def clear(self):
+        self.words = []
+        self.summary = 0
+        self.versions = []
+
+    def __len__(self):
+        n_free = sum(bin(word).count('1') for word in self.words)
+        return len(self.versions) - n_free
@@ -1,16 +1,35 @@
 import collections
+import ctypes
+import heapq
 import queue
+import select
+import socket
+import struct
 import sys
 import threading
 import time
 
 from scapy.all import sniff, Packet, IntField, BitField, Ether, bind_layers
 
+import journal
+import shutdown
+
 
 CPU_PORT = 99
+ETH_P_FELIX = 0x88B5
+ETH_HLEN = 14
+ANN_STRUCT = struct.Struct('!6I')  # the six 32-bit fields of FelixAnnouncement
+RECV_BUFSIZE = 2048
+SO_ATTACH_FILTER = 26
+SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS', 35)
+PACKET_OUTGOING = 4
+# Classic BPF: accept frames with ethertype ETH_P_FELIX, drop everything else
+#   ldh [12]; jeq #ETH_P_FELIX, 0, 1; ret #0x40000; ret #0
+FELIX_BPF = [(0x28, 0, 0, 12), (0x15, 0, 1, ETH_P_FELIX),
+             (0x06, 0, 0, 0x40000), (0x06, 0, 0, 0)]
 
 
-FelixAnnTuple = collections.namedtuple('FelixAnnTuple', ['new_net_state', 'announcer', 'opposite', 'prev_net_state', 'latent_net_state', 'n_transitions'])
+FelixAnnTuple = collections.namedtuple('FelixAnnTuple', ['new_net_state', 'announcer', 'opposite', 'prev_net_state', 'latent_net_state', 'n_transitions', 'timestamp'])
 
 
 class FelixAnnouncement(Packet):
@@ -30,14 +49,75 @@ class FelixAnnouncement(Packet):
         opposite = 's{}'.format(self.opposite)
         return FelixAnnTuple(self.new_net_state, announcer, opposite,
                              self.prev_net_state, self.latent_net_state,
-                             self.n_transitions)
+                             self.n_transitions, float(self.time))
 #
-bind_layers(Ether, FelixAnnouncement, type=0x88B5)
+bind_layers(Ether, FelixAnnouncement, type=ETH_P_FELIX)
+
+
+def decode_announcement(frame, timestamp):
+    (new_net_state, announcer, opposite, prev_net_state, latent_net_state,
+     n_transitions) = ANN_STRUCT.unpack_from(frame, ETH_HLEN)
+    return FelixAnnTuple(new_net_state, 's{}'.format(announcer),
+                         's{}'.format(opposite), prev_net_state,
+                         latent_net_state, n_transitions, timestamp)
+
+
+def attach_filter(sock, program):
+    insns = b''.join(struct.pack('HBBI', *insn) for insn in program)
+    buf = ctypes.create_string_buffer(insns, len(insns))
+    fprog = struct.pack('HL', len(program), ctypes.addressof(buf))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+
+class AnnouncementCapture(threading.Thread):
+    # Receives announcements from all interfaces in a single epoll loop. The
+    # kernel only delivers Felix frames and stamps them on reception.
+    def __init__(self, interfaces, ann_queue, verbose=False):
+        threading.Thread.__init__(self, daemon=True)
+        self.ann_queue = ann_queue
+        self.VERBOSE = verbose
+        self.epoll = select.epoll()
+        self.socks = {}
+        for interface in interfaces:
+            # Protocol 0 receives nothing until bind, after the filter is set
+            sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, 0)
+            attach_filter(sock, FELIX_BPF)
+            sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+            sock.bind((interface, ETH_P_FELIX))
+            sock.setblocking(False)
+            self.epoll.register(sock.fileno(), select.EPOLLIN)
+            self.socks[sock.fileno()] = sock
+        self.cmsg_size = socket.CMSG_SPACE(struct.calcsize('qq'))
+
+    def receive(self, sock):
+        while True:
+            try:
+                frame, ancdata, _, addr = sock.recvmsg(RECV_BUFSIZE,
+                                                       self.cmsg_size)
+            except BlockingIOError:
+                return
+            if addr[2] == PACKET_OUTGOING or len(frame) < ETH_HLEN + ANN_STRUCT.size:
+                continue
+            timestamp = None
+            for level, cmsg_type, data in ancdata:
+                if level == socket.SOL_SOCKET and cmsg_type == SO_TIMESTAMPNS:
+                    sec, nsec = struct.unpack('qq', data[:struct.calcsize('qq')])
+                    timestamp = sec + nsec/1e9
+            if timestamp is None:
+                timestamp = time.time()
+            self.ann_queue.put(decode_announcement(frame, timestamp))
+
+    def run(self):
+        if self.VERBOSE:
+            print('Capturing on {} interfaces'.format(len(self.socks)))
+        while True:
+            for fd, _ in self.epoll.poll():
+                self.receive(self.socks[fd])
 
 
 class PacketSniffer(threading.Thread):
     def __init__(self, switch_name, interface, ann_queue, verbose=False):
-        threading.Thread.__init__(self)
+        threading.Thread.__init__(self, daemon=True)
         self.switch_name = switch_name
         self.interface = interface
         self.ann_queue = ann_queue
@@ -53,15 +133,26 @@ class PacketSniffer(threading.Thread):
         sniff(iface=self.interface, prn=lambda x: self.process_packet(x))
 
 def announcements(switches, verbose=False):
-    ann_queue = queue.Queue()
+    ann_queue = queue.SimpleQueue()
 
-    if verbose:
-        print('Creating sniffer threads.')
-    sniffers = []
+    interfaces = {}
     for sname, sinfo in switches.items():
         if sname == 's0':
             continue
-        interface = 's0-eth{}'.format(sinfo['num'])
+        interfaces[sname] = 's0-eth{}'.format(sinfo['num'])
+
+    if hasattr(socket, 'AF_PACKET'):
+        if verbose:
+            print('Starting the capture thread.')
+        capture = AnnouncementCapture(interfaces.values(), ann_queue, verbose)
+        capture.start()
+        return ann_queue
+
+    # Fall back to one scapy sniffer per interface
+    if verbose:
+        print('Creating sniffer threads.')
+    sniffers = []
+    for sname, interface in interfaces.items():
         sniffers.append(PacketSniffer(sname, interface, ann_queue))
     
     if verbose:
@@ -72,32 +163,193 @@ def announcements(switches, verbose=False):
     return ann_queue
 
 
-class DelayedEntryUpdates(threading.Thread):
-    def __init__(self, switch_manager, prop_delay, install_delay, entries):
-        threading.Thread.__init__(self)
+def more_advanced(ann, other):
+    # Same order the switches use: more transitions first, then the lowest
+    # network state
+    if ann.n_transitions != other.n_transitions:
+        return ann.n_transitions > other.n_transitions
+    return ann.new_net_state < other.new_net_state
+
+
+class AnnouncementCoalescer:
+    # Sits between the capture thread and the routing loop. Every get drains
+    # the announcements queued so far and returns only the most advanced one.
+    # Replicas of an announcement (and of the last one handed out) are dropped.
+    def __init__(self, ann_queue):
+        self.ann_queue = ann_queue
+        self.last = None  # (new_net_state, latent_net_state) last handed out
+        self.stats = {'received': 0, 'bursts': 0, 'delivered': 0,
+                      'duplicates': 0, 'superseded': 0}
+
+    def get(self, timeout=None):
+        # Raises queue.Empty on timeout or if the whole burst was suppressed
+        burst = [self.ann_queue.get(timeout=timeout)]
+        while True:
+            try:
+                burst.append(self.ann_queue.get_nowait())
+            except queue.Empty:
+                break
+        if shutdown.EXIT in burst:
+            return shutdown.EXIT
+        self.stats['bursts'] += 1
+        self.stats['received'] += len(burst)
+        best = None
+        seen = set()
+        for ann in burst:
+            key = (ann.new_net_state, ann.latent_net_state)
+            if key in seen or key == self.last:
+                self.stats['duplicates'] += 1
+                continue
+            seen.add(key)
+            if best is None:
+                best = ann
+            elif more_advanced(ann, best):
+                self.stats['superseded'] += 1
+                best = ann
+            else:
+                self.stats['superseded'] += 1
+        if best is None:
+            raise queue.Empty
+        self.last = (best.new_net_state, best.latent_net_state)
+        self.stats['delivered'] += 1
+        return best
+
+
+class EntryUpdate:
+    def __init__(self, switch_manager, start, install_delay, entries,
+                 priority=None):
         self.switch_manager = switch_manager
-        self.prop_delay = prop_delay
+        self.start = start  # monotonic time the update reaches the switch
+        self.start_wall = time.time() + (start - time.monotonic())
         self.install_delay = install_delay
-        self.entries = entries
+        self.entries = [('fwd', entry) for entry in entries['fwd']]
+        self.entries += [('stt', entry) for entry in entries['stt']]
+        if priority is not None:
+            # Highest priority first, entries with the same one in FIFO order
+            self.entries.sort(key=lambda x: -priority(*x))
+        self.n_installed = 0
+        self.batches = []
+        self.max_lag = 0.0
+        self.cancelled = False
 
-    def run(self):
-        time.sleep(self.prop_delay)
-        with open('/tmp/felix_routing_exit_flag') as f:
-            if f.read() == '1':
-                return
-        for entry in self.entries['fwd']:
-            time.sleep(self.install_delay)
-            with open('/tmp/felix_routing_exit_flag') as f:
-                if f.read() == '0':
-                    self.switch_manager.add_alt_fwding_entry(entry[0], entry[1],
+    def due(self):
+        # Entries are installed one per install_delay after the update arrives
+        if self.install_delay == 0:
+            return self.start
+        return self.start + (self.n_installed + 1)*self.install_delay
+
+    def install(self, entry):
+        kind, entry = entry
+        journal.record('entry_write', switch=self.switch_manager.name,
+                       kind=kind, net_state=entry[0], peer=entry[1]['name'])
+        if kind == 'fwd':
+            batch = self.switch_manager.add_alt_fwding_entry(entry[0], entry[1],
                                                              entry[2])
-        for entry in self.entries['stt']:
-            time.sleep(self.install_delay)
-            with open('/tmp/felix_routing_exit_flag') as f:
-                if f.read() == '0':
-                    self.switch_manager.add_state_transition(entry[0], entry[1],
+        else:
+            batch = self.switch_manager.add_state_transition(entry[0], entry[1],
                                                              entry[2], entry[3])
+        if batch is not None:
+            self.track(batch, 1)
+        self.n_installed = self.n_installed + 1
+
+    def track(self, batch, n_entries):
+        self.batches.append(batch)
+        if journal.journal is not None:
+            name = self.switch_manager.name
+            self.switch_manager.on_batch_done(batch, lambda info: journal.record(
+                'entry_ack', switch=name, batch=batch, n=n_entries))
+
+    def report(self, info):
+        msg = '# updates: {} entries in {} batches, ready after {:.3f} ms (max lag {:.3f} ms)\n'
+        msg = msg.format(len(self.entries), len(self.batches),
+                         (info['done'] - self.start_wall)*1e3, self.max_lag*1e3)
+        self.switch_manager.session.write_log(msg)
+
+
+class EntryScheduler(threading.Thread):
+    # Installs the entries of every update at their exact due times from a
+    # single thread
+    def __init__(self):
+        threading.Thread.__init__(self, daemon=True)
+        self.cv = threading.Condition()
+        self.queue = []  # heap of (due, seq, update)
+        self.seq = 0
+        self.pending = {}  # pending[switch name] = [update, ...]
+
+    def _push(self, update):
+        heapq.heappush(self.queue, (update.due(), self.seq, update))
+        self.seq = self.seq + 1
+
+    def submit(self, update):
+        with self.cv:
+            name = update.switch_manager.name
+            self.pending.setdefault(name, []).append(update)
+            self._push(update)
+            self.cv.notify()
+
+    def cancel(self, switch_manager):
+        # Drop whatever is still pending for the switch (superseded updates)
+        with self.cv:
+            updates = self.pending.pop(switch_manager.name, [])
+            for update in updates:
+                update.cancelled = True
+        return len(updates)
+
+    def _finish(self, update):
+        with self.cv:
+            updates = self.pending.get(update.switch_manager.name, [])
+            if update in updates:
+                updates.remove(update)
+        if update.batches:
+            update.switch_manager.on_batch_done(update.batches[-1], update.report)
+
+    def run(self):
+        while True:
+            with self.cv:
+                while not self.queue or self.queue[0][0] > time.monotonic():
+                    timeout = self.queue[0][0] - time.monotonic() if self.queue else None
+                    self.cv.wait(timeout)
+                due, _, update = heapq.heappop(self.queue)
+                if update.cancelled:
+                    continue
+            update.max_lag = max(update.max_lag, time.monotonic() - due)
+            if shutdown.exit_event.is_set():
+                continue
+            if update.install_delay == 0:
+                # Without an installation delay, all entries go in a single batch
+                update.switch_manager.begin_batch()
+                for entry in update.entries:
+                    update.install(entry)
+                batch = update.switch_manager.end_batch()
+                if batch is not None:
+                    update.track(batch, len(update.entries))
+            elif update.entries:
+                update.install(update.entries[update.n_installed])
+            if update.n_installed < len(update.entries):
+                with self.cv:
+                    if not update.cancelled:
+                        self._push(update)
+            else:
+                self._finish(update)
+
+
+scheduler = None
+
+
+def send_entry_updates(switch_manager, prop_delay, install_delay, entries,
+                       priority=None):
+    # priority(kind, entry), if given, orders the installation of entries
+    global scheduler
+    if scheduler is None:
+        scheduler = EntryScheduler()
+        scheduler.start()
+    update = EntryUpdate(switch_manager, time.monotonic() + prop_delay,
+                         install_delay, entries, priority)
+    scheduler.submit(update)
+    return update
+
 
-def send_entry_updates(switch_manager, prop_delay, install_delay, entries):
-    thr = DelayedEntryUpdates(switch_manager, prop_delay, install_delay, entries)
-    thr.start()
+def cancel_entry_updates(switch_manager):
+    if scheduler is None:
+        return 0
+    return scheduler.cancel(switch_manager)
@@ -1,4 +1,6 @@
 # Fix-it Felix
+import collections
+import heapq
 import json
 import os
 import queue
@@ -6,10 +8,17 @@ import signal
 import sys
 import time
 
+from multiprocessing import Pool
+
 import networkx as nx
+import numpy as np
 
+import compute_cost
 import felix_switch
 import felix_broker
+import journal
+import shutdown
+import spdag
 
 
 def order_link(link):
@@ -22,27 +31,281 @@ def sort_links(links):
     return sorted(links, key=lambda x: (int(x[0][1:]), int(x[1][1:])))
 
 
+MAX_NET_STATE = 2**32 - 1  # net_state is a bit<32> in the data plane
+
+
+class FailureSet:
+    # Interned set of failed links, a bitset over base graph link indices
+    # with its hash computed once. Equal sets are the same object, which also
+    # lets each set memoize its unions with one link or one node's links.
+    __slots__ = ('manager', 'bits', 'net_state', 'hash', 'unions',
+                 '_failed_links')
+
+    def __init__(self, manager, bits, net_state):
+        self.manager = manager
+        self.bits = bits
+        self.net_state = net_state
+        self.hash = hash(bits)
+        self.unions = {}  # unions[link index or node name] = FailureSet
+        self._failed_links = None
+
+    def __hash__(self):
+        return self.hash
+
+    def __eq__(self, other):
+        return self is other
+
+    def add_link(self, lid):
+        if lid not in self.unions:
+            self.unions[lid] = self.manager.intern(
+                self.bits | self.manager.link_bits[lid])
+        return self.unions[lid]
+
+    def add_node(self, node):
+        if node not in self.unions:
+            self.unions[node] = self.manager.intern(
+                self.bits | self.manager.node_bits[node])
+        return self.unions[node]
+
+    @property
+    def failed_links(self):
+        if self._failed_links is None:
+            links = self.manager.graph.links
+            self._failed_links = sort_links([
+                order_link(links[lid]) for lid in range(len(links))
+                if self.bits >> lid & 1])
+        return self._failed_links
+
+
 class StateManager:
-    def __init__(self):
-        self.states = {'': 0}
-        self.failed_links = {0: []}
-    
+    def __init__(self, graph):
+        self.graph = graph
+        self.link_bits = [1 << lid for lid in range(graph.n_links)]
+        self.node_bits = {node: 0 for node in graph.nodes}
+        for lid, (u, v) in enumerate(graph.links):
+            self.node_bits[u] |= self.link_bits[lid]
+            self.node_bits[v] |= self.link_bits[lid]
+        self.sets = {}  # sets[bits] = FailureSet
+        self.states = []  # states[net_state] = FailureSet
+        self.intern(0)
+
+    def intern(self, bits):
+        failure_set = self.sets.get(bits)
+        if failure_set is None:
+            if len(self.states) > MAX_NET_STATE:
+                raise Exception('Ran out of network state ids.')
+            failure_set = FailureSet(self, bits, len(self.states))
+            self.sets[bits] = failure_set
+            self.states.append(failure_set)
+        return failure_set
+
+    def link_set_bits(self, links):
+        bits = 0
+        for link in links:
+            bits |= self.link_bits[self.graph.link_index[link]]
+        return bits
+
     def add_get_state(self, failed_links):
-        f_links = []
-        for link in failed_links:
-            f_links.append(order_link(link))
-        f_links = sort_links(list(set(f_links)))
-        link_names = []
-        for u, v in f_links:
-            link_names.append('{}-{}'.format(u, v))
-        state_id = ','.join([str(x) for x in link_names])
-        if state_id not in self.states:
-            self.states[state_id] = len(self.states)
-            self.failed_links[self.states[state_id]] = f_links
-        return self.states[state_id]
-    
+        return self.intern(self.link_set_bits(failed_links)).net_state
+
+    def get_state(self, state_num):
+        return self.states[state_num]
+
     def get_failed_links(self, state_num):
-        return self.failed_links[state_num]
+        return self.states[state_num].failed_links
+
+
+def add_changes(changes, cur_hop):
+    if cur_hop not in changes:
+        changes[cur_hop] = {}
+        changes[cur_hop]['fwd'] = []
+        changes[cur_hop]['stt'] = []
+
+
+def add_alt_fwding_changes(changes, switches, fwd, base_net_state, net_state):
+    state = fwd[net_state]
+    nodes = state.graph.nodes
+    for dst, cur in zip(*state.changed(fwd[base_net_state])):
+        cur_hop = nodes[cur]
+        add_changes(changes, cur_hop)
+        changes[cur_hop]['fwd'].append([net_state, switches[nodes[dst]],
+                                        state.next_hops(dst, cur)])
+
+
+# Worker pool for deriving alternative states (graph is shared at startup)
+worker_graph = None
+
+def init_worker(graph):
+    global worker_graph
+    worker_graph = graph
+
+
+def derive_worker(failed, nexthops, dist, tasks, worker_id, n_workers):
+    cur_state = spdag.ForwardingState(worker_graph, failed, nexthops, dist)
+    results = []
+    for i, (net_state, links) in enumerate(tasks):
+        if (i % n_workers) == worker_id:
+            state = cur_state.derive(links)
+            results.append((i, state.failed, state.nexthops, state.dist,
+                            state.n_computed))
+    return results
+
+
+def derive_net_states(fwd, cur_net_state, tasks, pool, n_workers):
+    cur_state = fwd[cur_net_state]
+    if pool is None or len(tasks) < 2:
+        for net_state, links in tasks:
+            fwd[net_state] = cur_state.derive(links)
+        return
+    worker_arguments = ((cur_state.failed, cur_state.nexthops, cur_state.dist,
+                         tasks, i, n_workers) for i in range(n_workers))
+    for worker_results in pool.starmap(derive_worker, worker_arguments):
+        for i, failed, nexthops, dist, n_computed in worker_results:
+            fwd[tasks[i][0]] = spdag.ForwardingState(cur_state.graph, failed,
+                                                     nexthops, dist, n_computed)
+
+
+# Speculative lookahead beyond the states installed one failure ahead
+class LookaheadCache:
+    # Derived states keyed by failure set bits (not interned, so that
+    # speculation does not change the numbers given to installed states).
+    # When full, the state least worth keeping (probability times compute
+    # time) is dropped, the least recently used first among equals.
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.states = collections.OrderedDict()  # states[bits] = [state, worth]
+        self.stats = {'stored': 0, 'hits': 0, 'misses': 0, 'evicted': 0}
+
+    def __contains__(self, bits):
+        return bits in self.states
+
+    def get(self, bits):
+        if bits not in self.states:
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        self.states.move_to_end(bits)
+        return self.states[bits][0]
+
+    def touch(self, bits):
+        self.states.move_to_end(bits)
+
+    def put(self, bits, state, worth):
+        if bits in self.states:
+            self.states[bits] = [state, worth]
+            self.states.move_to_end(bits)
+            return
+        if len(self.states) >= self.capacity:
+            # min keeps the first of equals, i.e. the least recently used
+            victim = min(self.states, key=lambda x: self.states[x][1])
+            del self.states[victim]
+            self.stats['evicted'] += 1
+        self.states[bits] = [state, worth]
+        self.stats['stored'] += 1
+
+
+# Installation order of alternative entries
+class EntryImpact:
+    # Ranks entries by the traffic they would carry, so that the ones
+    # protecting the most demand are installed first: the traffic towards
+    # their destination through their switch in their state (alternative
+    # forwarding entries) or the traffic over their link in the current state
+    # (state transitions), times the odds of the failure leading to the state.
+    def __init__(self, graph, demands):
+        self.graph = graph
+        self.demand = np.zeros((graph.n_nodes, graph.n_nodes))
+        for src, rates in demands.items():
+            for dst, rate in rates.items():
+                if src in graph.index and dst in graph.index:
+                    self.demand[graph.index[src], graph.index[dst]] += rate
+        self.loads = {}  # loads[net_state] = (node loads, link loads)
+        self.odds = {}  # odds[net_state] = odds of the failure leading to it
+
+    def state_loads(self, fwd, net_state):
+        if net_state not in self.loads:
+            if net_state not in fwd:
+                return None
+            self.loads[net_state] = fwd[net_state].loads(self.demand)
+        return self.loads[net_state]
+
+    def forget(self):
+        self.loads = {}
+        self.odds = {}
+
+    def priority(self, fwd, cur_hop):
+        graph = self.graph
+        cur = graph.index[cur_hop]
+        def priority(kind, entry):
+            loads = self.state_loads(fwd, entry[0])
+            if loads is None:
+                return 0
+            if kind == 'fwd':
+                odds = self.odds.get(entry[0], 0)
+                return odds*loads[0][graph.index[entry[1]['name']], cur]
+            odds = self.odds.get(entry[2], 0)
+            return odds*loads[1][graph.link_index[(cur_hop, entry[1]['name'])]]
+        return priority
+
+
+def likely_failure_sets(odds, depth, n_sets):
+    # Best-first enumeration of sets of 2 to depth link indices, by the
+    # product of their failure odds (odds sorted in decreasing order). Odds
+    # rank sets of different sizes by the probability of exactly them failing.
+    heap = []
+    for size in range(2, min(depth, len(odds)) + 1):
+        idx = tuple(range(size))
+        heap.append((-prod(odds[i] for i in idx), idx))
+    heapq.heapify(heap)
+    seen = set(idx for _, idx in heap)
+    sets = []
+    while heap and len(sets) < n_sets:
+        neg_odds, idx = heapq.heappop(heap)
+        sets.append((-neg_odds, idx))
+        for i in range(len(idx)):
+            j = idx[i] + 1
+            if j < len(odds) and (i + 1 == len(idx) or j < idx[i + 1]):
+                nxt = idx[:i] + (j,) + idx[i + 1:]
+                if nxt not in seen:
+                    seen.add(nxt)
+                    heapq.heappush(heap, (-prod(odds[k] for k in nxt), nxt))
+    return sets
+
+
+def prod(values):
+    result = 1.0
+    for value in values:
+        result = result*value
+    return result
+
+
+def speculate(lookahead, sttman, fwd, cur_net_state, link_odds, depth,
+              n_states, pool, n_workers):
+    # Derive the most likely states 2 to depth link failures away from the
+    # current one into the lookahead cache
+    cur_bits = sttman.get_state(cur_net_state).bits
+    links = fwd[cur_net_state].graph.links
+    lids = sorted(fwd[cur_net_state].up_link_ids(), key=lambda lid: -link_odds[lid])
+    tasks = []
+    worth = {}
+    for odds, idx in likely_failure_sets([link_odds[lid] for lid in lids],
+                                         depth, n_states):
+        bits = cur_bits
+        for i in idx:
+            bits |= sttman.link_bits[lids[i]]
+        if bits in lookahead:
+            lookahead.touch(bits)
+        elif bits not in worth:
+            worth[bits] = odds
+            tasks.append((bits, [links[lids[i]] for i in idx]))
+    if not tasks:
+        return 0
+    spec = {cur_net_state: fwd[cur_net_state]}
+    start = time.time()
+    derive_net_states(spec, cur_net_state, tasks, pool, n_workers)
+    cost = (time.time() - start)/len(tasks)
+    for bits, _ in tasks:
+        lookahead.put(bits, spec[bits], worth[bits]*cost)
+    return len(tasks)
 
 
 def main(topology_json):
@@ -55,16 +318,23 @@ def main(topology_json):
     slowdown = netinfo['slowdown']
     ei_rate = netinfo['entry_installation_rate']
     ei_delay = (1.0/ei_rate)*slowdown
+    driver = netinfo['switch_driver'] if 'switch_driver' in netinfo else 'cli'
+    cost_model = compute_cost.CostModel(
+        netinfo['compute_cost_model'] if 'compute_cost_model' in netinfo else 'none',
+        slowdown,
+        netinfo['compute_cost_per_destination']/1e6 if 'compute_cost_per_destination' in netinfo else None)
+    if netinfo['event_journal'] if 'event_journal' in netinfo else True:
+        journal.open_journal('logs/felix_routing_events.jsonl')
     del switches['s0']
 
-    net = {}  # net[state] = graph
-    fwd = {}  # fwd[state][dst][cur_hop] = next_hops
+    fwd = {}  # fwd[state] = forwarding state (failed links and SPDAG to each dst)
 
     # Create switch interface objects and configure forwarding to hosts
     man = {}
     for sname, sinfo in switches.items():
         if sname == 's0': continue
-        man[sname] = felix_switch.FelixSwitch(sinfo, script='felix')
+        man[sname] = felix_switch.FelixSwitch(sinfo, script='felix',
+                                              driver=driver)
         for peer in sinfo['adj'].keys():
             if peer[0] == 'h':
                 man[sname].add_nrml_fwding_entry_host(netinfo['hosts'][peer])
@@ -90,36 +360,73 @@ def main(topology_json):
     # Compute and install normal forwarding entries
     ## Create BASE_STATE graph that represents the network with no failures
     BASE_STATE = 0
-    net[BASE_STATE] = nx.Graph()
+    base_net = nx.Graph()
     node_links = {}
     for sname, sinfo in switches.items():
         if sname == 's0': continue
         node_links[sname] = []
-        net[BASE_STATE].add_node(sname)
+        base_net.add_node(sname)
         for peer in sinfo['adj'].keys():
             if peer != 's0' and peer[0] != 'h':
-                net[BASE_STATE].add_edge(sname, peer, weight=link_delay[sname][peer])
+                base_net.add_edge(sname, peer, weight=link_delay[sname][peer])
                 node_links[sname].append(order_link((sname, peer)))
+    graph = spdag.CSRGraph.from_networkx(base_net, nodes=switches.keys(),
+                                         weight='weight')
     ## Run dijkstra for each switch as destination and install entries
-    fwd[BASE_STATE] = {}
-    for dst, dstinfo in switches.items():
-        if dst == 's0': continue
-        pred, _ = nx.dijkstra_predecessor_and_distance(net[BASE_STATE], dst, weight='weight')
-        fwd[BASE_STATE][dst] = {}
-        for cur_hop, next_hops in pred.items():
-            fwd[BASE_STATE][dst][cur_hop] = sorted(next_hops)
-            if len(next_hops) > 0:
-                man[cur_hop].add_nrml_fwding_entry(dstinfo, next_hops)
-
-    sttman = StateManager()
+    start = time.time()
+    fwd[BASE_STATE] = spdag.ForwardingState.compute(graph)
+    cost_model.calibrate(time.time() - start, fwd[BASE_STATE].n_computed)
+    for dst, cur in zip(*fwd[BASE_STATE].nexthops.nonzero()):
+        next_hops = fwd[BASE_STATE].next_hops(dst, cur)
+        man[graph.nodes[cur]].add_nrml_fwding_entry(switches[graph.nodes[dst]],
+                                                    next_hops)
+
+    sttman = StateManager(graph)
     cur_net_state = BASE_STATE
     prev_net_state = None
     failed_links = []
 
     TRIM_AND_CLEAR = netinfo['trim_and_clear'] if 'trim_and_clear' in netinfo else False
+    
+    # Speculative lookahead (off with depth 1)
+    LOOKAHEAD_DEPTH = netinfo['lookahead_depth'] if 'lookahead_depth' in netinfo else 1
+    LOOKAHEAD_STATES = netinfo['lookahead_states'] if 'lookahead_states' in netinfo else 32
+    lookahead = None
+    if LOOKAHEAD_DEPTH > 1:
+        cache_size = netinfo['lookahead_cache_size'] if 'lookahead_cache_size' in netinfo else 256
+        lookahead = LookaheadCache(cache_size)
+    link_odds = []  # link_odds[link index] = p/(1 - p)
+    link_probs = netinfo['link_failure_probs'] if 'link_failure_probs' in netinfo else {}
+    for link in graph.links:
+        p = link_probs.get('{}-{}'.format(*order_link(link)), 0.01)
+        link_odds.append(p/(1 - p))
     visited_states = []
 
+    # Order of installation of the entries sent to each switch
+    INSTALL_ORDER = netinfo['install_order'] if 'install_order' in netinfo else 'fifo'
+    if INSTALL_ORDER not in ('fifo', 'impact'):
+        raise Exception('Unknown install order {}.'.format(INSTALL_ORDER))
+    impact = None
+    if INSTALL_ORDER == 'impact':
+        impact = EntryImpact(graph, netinfo['demands'] if 'demands' in netinfo else {})
+
+    # Reconcile tables on recovery instead of clearing and reinstalling them
+    # (not with TRIM_AND_CLEAR, which deletes the entries this would keep)
+    RECONCILE = netinfo['table_reconciliation'] if 'table_reconciliation' in netinfo else False
+    RECONCILE = RECONCILE and not TRIM_AND_CLEAR
+    installed = {}  # installed[net_state] = changes sent for its alternatives
+    base_fwd = None
+
+    # Start worker processes before the sniffer threads
+    N_WORKERS = netinfo['routing_workers'] if 'routing_workers' in netinfo else 1
+    pool = None
+    if N_WORKERS > 1:
+        pool = Pool(processes=N_WORKERS, initializer=init_worker,
+                    initargs=(graph,))
+
     ann_queue = felix_broker.announcements(switches)
+    shutdown.listen(ann_queue)
+    anns = felix_broker.AnnouncementCoalescer(ann_queue)
     init = True
     while True:
         install_alt_entries = False
@@ -131,99 +438,114 @@ def main(topology_json):
 
         if install_alt_entries:
             # Compute alternative forwarding entries
+            timer = compute_cost.PhaseTimer()
+            journal.record('compute_start', net_state=cur_net_state)
             changes = {}
-            for link in net[cur_net_state].edges():
-                if link in failed_links:
-                    continue
-                uname, vname = order_link(link)
+            # Plan the states reachable from the current one
+            plan = []
+            tasks = []  # [(net_state, links to fail on cur_net_state)]
+            planned = set()
+            cur_set = sttman.get_state(cur_net_state)
+            for lid in fwd[cur_net_state].up_link_ids():
+                uname, vname = order_link(graph.links[lid])
                 # Link Failure
-                new_net_state = sttman.add_get_state(failed_links + [link])
-                if new_net_state not in net:
-                    net[new_net_state] = net[cur_net_state].copy()
-                    net[new_net_state].remove_edge(uname, vname)
-                    fwd[new_net_state] = {}
-                    for dst, dstinfo in switches.items():
-                        fwd[new_net_state][dst] = {}
-                        pred, _ = nx.dijkstra_predecessor_and_distance(net[new_net_state], dst, weight='weight')
-                        for cur_hop, next_hops in pred.items():
-                            fwd[new_net_state][dst][cur_hop] = sorted(next_hops)
-                            if len(next_hops) > 0 and fwd[new_net_state][dst][cur_hop] != fwd[BASE_STATE][dst][cur_hop]:
-                                # man[cur_hop].add_alt_fwding_entry(new_net_state,
-                                #                                   dstinfo,
-                                #                                   next_hops)
-                                if cur_hop not in changes:
-                                    changes[cur_hop] = {}
-                                    changes[cur_hop]['fwd'] = []
-                                    changes[cur_hop]['stt'] = []
-                                changes[cur_hop]['fwd'].append([new_net_state, dstinfo, next_hops])
+                new_set = cur_set.add_link(lid)
+                new_net_state = new_set.net_state
                 # Node Failure
                 ## uname node
-                u_lat_net_state = sttman.add_get_state(failed_links + [link] + node_links[vname])
-                if u_lat_net_state not in net:
-                    net[u_lat_net_state] = net[new_net_state].copy()
-                    net[u_lat_net_state].remove_edges_from(node_links[vname])
-                    fwd[u_lat_net_state] = {}
-                    for dst, dstinfo in switches.items():
-                        fwd[u_lat_net_state][dst] = {}
-                        pred, _ = nx.dijkstra_predecessor_and_distance(net[u_lat_net_state], dst, weight='weight')
-                        for cur_hop, next_hops in pred.items():
-                            fwd[u_lat_net_state][dst][cur_hop] = sorted(next_hops)
-                            if len(next_hops) > 0 and fwd[u_lat_net_state][dst][cur_hop] != fwd[BASE_STATE][dst][cur_hop]:
-                                # man[cur_hop].add_alt_fwding_entry(u_lat_net_state,
-                                #                                   dstinfo,
-                                #                                   next_hops)
-                                if cur_hop not in changes:
-                                    changes[cur_hop] = {}
-                                    changes[cur_hop]['fwd'] = []
-                                    changes[cur_hop]['stt'] = []
-                                changes[cur_hop]['fwd'].append([u_lat_net_state, dstinfo, next_hops])
+                u_lat_net_state = new_set.add_node(vname).net_state
                 ## vname node
-                v_lat_net_state = sttman.add_get_state(failed_links + [link] + node_links[uname])
-                if v_lat_net_state not in net:
-                    net[v_lat_net_state] = net[new_net_state].copy()
-                    net[v_lat_net_state].remove_edges_from(node_links[uname])
-                    fwd[v_lat_net_state] = {}
-                    for dst, dstinfo in switches.items():
-                        fwd[v_lat_net_state][dst] = {}
-                        pred, _ = nx.dijkstra_predecessor_and_distance(net[v_lat_net_state], dst, weight='weight')
-                        for cur_hop, next_hops in pred.items():
-                            fwd[v_lat_net_state][dst][cur_hop] = sorted(next_hops)
-                            if len(next_hops) > 0 and fwd[v_lat_net_state][dst][cur_hop] != fwd[BASE_STATE][dst][cur_hop]:
-                                # man[cur_hop].add_alt_fwding_entry(v_lat_net_state,
-                                #                                   dstinfo,
-                                #                                   next_hops)
-                                if cur_hop not in changes:
-                                    changes[cur_hop] = {}
-                                    changes[cur_hop]['fwd'] = []
-                                    changes[cur_hop]['stt'] = []
-                                changes[cur_hop]['fwd'].append([v_lat_net_state, dstinfo, next_hops])
+                v_lat_net_state = new_set.add_node(uname).net_state
+                link_states = []
+                for net_state, links in [
+                        (new_net_state, [(uname, vname)]),
+                        (u_lat_net_state, [(uname, vname)] + node_links[vname]),
+                        (v_lat_net_state, [(uname, vname)] + node_links[uname])]:
+                    if net_state not in fwd and net_state not in planned:
+                        planned.add(net_state)
+                        link_states.append(net_state)
+                        state = None
+                        if lookahead is not None:
+                            state = lookahead.get(sttman.get_state(net_state).bits)
+                        if state is None:
+                            tasks.append((net_state, links))
+                        else:
+                            fwd[net_state] = state
+                plan.append((uname, vname, new_net_state, u_lat_net_state,
+                             v_lat_net_state, link_states))
+                if impact is not None:
+                    for net_state in (new_net_state, u_lat_net_state,
+                                      v_lat_net_state):
+                        impact.odds[net_state] = max(
+                            impact.odds.get(net_state, 0), link_odds[lid])
+
+            timer.lap('plan')
+
+            # Derive the planned states (serially or in the worker pool)
+            derive_net_states(fwd, cur_net_state, tasks, pool, N_WORKERS)
+            n_computed = sum(fwd[net_state].n_computed for net_state, _ in tasks)
+            timer.lap('derive')
+
+            # Collect entries following the plan order (same for both modes)
+            for uname, vname, new_net_state, u_lat_net_state, v_lat_net_state, link_states in plan:
+                for net_state in link_states:
+                    add_alt_fwding_changes(changes, switches, fwd, BASE_STATE,
+                                           net_state)
                 # State Transition
-                new_net_state = sttman.add_get_state(failed_links + [link])
-                if uname not in changes:
-                    changes[uname] = {}
-                    changes[uname]['fwd'] = []
-                    changes[uname]['stt'] = []
+                add_changes(changes, uname)
                 # man[uname].add_state_transition(cur_net_state, switches[vname],
                 #                                 new_net_state, u_lat_net_state)
                 changes[uname]['stt'].append([cur_net_state, switches[vname],
                                               new_net_state, u_lat_net_state])
-                if vname not in changes:
-                    changes[vname] = {}
-                    changes[vname]['fwd'] = []
-                    changes[vname]['stt'] = []
+                add_changes(changes, vname)
                 # man[vname].add_state_transition(cur_net_state, switches[uname],
                 #                                 new_net_state, v_lat_net_state)
                 changes[vname]['stt'].append([cur_net_state, switches[uname],
                                               new_net_state, v_lat_net_state])
             
+            timer.lap('collect')
+            journal.record('compute_end', net_state=cur_net_state,
+                           n_states=len(tasks), n_computed=n_computed)
+
+            # Wait out the computation time given by the cost model
+            if init is False and cost_model.inject(timer.total(), n_computed):
+                timer.lap('compute delay')
+
+            if RECONCILE:
+                if cur_net_state == BASE_STATE and base_fwd is None:
+                    base_fwd = dict(fwd)
+                installed[cur_net_state] = changes
+
             # Install entries
             # if init is True:
             for cur_hop, entries in changes.items():
+                if RECONCILE:
+                    # Skip entries left installed from an earlier visit
+                    entries = man[cur_hop].missing_entries(entries)
+                    if not entries['fwd'] and not entries['stt']:
+                        continue
                 prop_delay = 0 if init is True else delay_to_dp[cur_hop]
                 install_delay = 0 if init is True else ei_delay
+                priority = None
+                if impact is not None and install_delay > 0:
+                    priority = impact.priority(fwd, cur_hop)
                 felix_broker.send_entry_updates(man[cur_hop], prop_delay,
-                                                install_delay, entries)
+                                                install_delay, entries,
+                                                priority)
             init = False
+            timer.lap('send')
+            print('Computed {} states ({} destinations): {}'.format(
+                len(tasks), n_computed, timer.report()))
+
+            # Speculate while the entries are being installed
+            if lookahead is not None:
+                start = time.time()
+                n_derived = speculate(lookahead, sttman, fwd, cur_net_state,
+                                      link_odds, LOOKAHEAD_DEPTH,
+                                      LOOKAHEAD_STATES, pool, N_WORKERS)
+                print('Lookahead: {} states derived in {:.3f} ms'.format(
+                    n_derived, (time.time() - start)*1e3))
+                print('Lookahead cache: {stored} stored, {hits} hits, {misses} misses, {evicted} evicted'.format(**lookahead.stats))
 
         print('=> Current network state is', cur_net_state)
         print('Current failed links set is', failed_links)
@@ -233,18 +555,28 @@ def main(topology_json):
         while ann is None:
             print(end='.')
             try:
-                ann = ann_queue.get(timeout=1)
+                ann = anns.get(timeout=1)
             except queue.Empty:
                 pass
-            with open('/tmp/felix_routing_exit_flag') as f:
-                if f.read() == '1':
-                    print('Exiting!')
-                    sys.exit(0)
+            if ann is shutdown.EXIT:
+                print('Exiting!')
+                journal.record('exit')
+                if pool is not None:
+                    pool.terminate()
+                sys.exit(0)
         print('\nAnnouncement received!', ann)
+        journal.record('announcement', new_net_state=ann.new_net_state,
+                       latent_net_state=ann.latent_net_state,
+                       announcer=ann.announcer,
+                       n_transitions=ann.n_transitions,
+                       captured_ns=int(ann.timestamp*1e9))
+        print('Captured {:.3f} ms ago'.format((time.time() - ann.timestamp)*1e3))
+        print('Announcements: {received} received in {bursts} bursts, {duplicates} duplicates and {superseded} superseded suppressed'.format(**anns.stats))
 
         if ann.new_net_state == 0:
             # Update the network state
             if cur_net_state != 0:
+                left_net_state = cur_net_state
                 # IF TRIM_AND_CLEAR IS TRUE
                 prev_net_state = None
                 # IF TRIM_AND_CLEAR IS FALSE
@@ -253,14 +585,59 @@ def main(topology_json):
                 failed_links = []
                 cur_net_state = BASE_STATE
                 print('New network state is', cur_net_state)
+                journal.record('state_change', prev_net_state=left_net_state,
+                               net_state=cur_net_state)
                 print('No links are failed')
-                net = {BASE_STATE: net[BASE_STATE]}
-                fwd = {BASE_STATE: fwd[BASE_STATE]}
-                # Clear alternative forwarding and state transition tables
-                for sname in switches.keys():
-                    if sname == 's0': continue
-                    man[sname].clear_alt_fwding_table()
-                    man[sname].clear_state_transition_table()
+                if RECONCILE and base_fwd is not None:
+                    # Keep the entries for the alternatives of BASE_STATE and
+                    # of the state being left (entries only depend on the
+                    # state ids, so a flapping link finds them in place),
+                    # delete the rest and install only what is missing
+                    # (dropping updates still pending for the superseded
+                    # states)
+                    installed = {BASE_STATE: installed[BASE_STATE],
+                                 left_net_state: installed.get(left_net_state, {})}
+                    prev_net_state = BASE_STATE
+                    visited_states = [BASE_STATE]
+                    fwd = dict(base_fwd)
+                    n_kept = 0
+                    n_deleted = 0
+                    n_missing = 0
+                    for sname in switches.keys():
+                        if sname == 's0': continue
+                        felix_broker.cancel_entry_updates(man[sname])
+                        entries = {'fwd': [], 'stt': []}
+                        for changes in installed.values():
+                            if sname in changes:
+                                entries['fwd'] = entries['fwd'] + changes[sname]['fwd']
+                                entries['stt'] = entries['stt'] + changes[sname]['stt']
+                        missing, kept, deleted = man[sname].reconcile(entries)
+                        n_kept = n_kept + kept
+                        n_deleted = n_deleted + deleted
+                        n_missing = n_missing + len(missing['fwd']) + len(missing['stt'])
+                        if missing['fwd'] or missing['stt']:
+                            priority = None
+                            if impact is not None:
+                                priority = impact.priority(fwd, sname)
+                            felix_broker.send_entry_updates(man[sname],
+                                                            delay_to_dp[sname],
+                                                            ei_delay, missing,
+                                                            priority)
+                    print('Reconciled tables: {} entries kept, {} deleted, {} to install'.format(
+                        n_kept, n_deleted, n_missing))
+                    journal.record('reconciled', n_kept=n_kept,
+                                   n_deleted=n_deleted, n_missing=n_missing)
+                else:
+                    fwd = {BASE_STATE: fwd[BASE_STATE]}
+                    if impact is not None:
+                        impact.forget()
+                    # Clear alternative forwarding and state transition tables
+                    # (dropping updates still pending for the superseded states)
+                    for sname in switches.keys():
+                        if sname == 's0': continue
+                        felix_broker.cancel_entry_updates(man[sname])
+                        man[sname].clear_alt_fwding_table()
+                        man[sname].clear_state_transition_table()
             else:
                 print('Replicated announcement for the current net state. Nothing to do.')
         elif ann.new_net_state > 0:
@@ -270,6 +647,8 @@ def main(topology_json):
             if new_net_state != cur_net_state:
                 cur_net_state = new_net_state
                 print('New network state is', cur_net_state)
+                journal.record('state_change', prev_net_state=prev_net_state,
+                               net_state=cur_net_state)
                 failed_links = sttman.get_failed_links(new_net_state)
                 print('New failed links set is', failed_links)
                 if TRIM_AND_CLEAR:
@@ -1,17 +1,20 @@
 import os
-import subprocess
 import time
 
+import cli_session
+import entry_handles
+import selector_pool
+
+
+SELECTOR_SIZE = 128  # members per action selector, as declared in felix.p4
+
 
 class FelixSwitch:
-    def __init__(self, sw_info, script='felix'):
+    def __init__(self, sw_info, script='felix', driver='cli'):
         # 
         self.thrift_port = sw_info['thrift_port']
-        cmd = ['runtime_CLI.py', '--thrift-port', str(self.thrift_port)]
         self.log = open('logs/{}_{}.log'.format(sw_info['name'], script), 'w')
-        self.conn = subprocess.Popen(cmd, stdin=subprocess.PIPE,
-                                     stdout=self.log, stderr=subprocess.STDOUT,
-                                     text=True)
+        self.session = cli_session.connect(sw_info, self.log, driver=driver)
         #
         self.id = sw_info['id']
         self.name = sw_info['name']
@@ -27,27 +30,38 @@ class FelixSwitch:
                 self.add_opposite_entry(peer, [port])
         self.loc_state = None
         # Normal Forwarding
-        self.nf_members = {}
-        self.nf_groups = {}
+        self.nf_pool = selector_pool.SelectorPool(self, 'ingress.nrml_selector',
+                                                  SELECTOR_SIZE)
         # Alternative Forwarding
-        self.af_members = {}
-        self.af_groups = {}
+        self.af_pool = selector_pool.SelectorPool(self, 'ingress.alt_selector',
+                                                  SELECTOR_SIZE)
         self.af_entries = {}
-        self.af_entry_handles = {}
-        self.next_af_handle = 0
+        self.af_entry_handles = entry_handles.EntryHandles()
+        # State Transition
+        self.st_entries = {}  # st_entries[(net_state, peer)] = {'handle', 'params'}
+        self.st_entry_handles = entry_handles.EntryHandles()
     
     def __del__(self):
         self.close = True
-        self._cmd('EOF')
-        self.conn.wait()
+        self.session.close()
         self.log.close()
     
     def _cmd(self, cmdline, flush=True):
-        clean_cmdline = cmdline.strip('\n')
-        self.log.write('{}\n'.format(clean_cmdline))
-        self.conn.stdin.write(clean_cmdline + '\n')
-        if flush:
-            self.conn.stdin.flush()
+        self.session.cmd(cmdline, flush=flush)
+
+    def begin_batch(self):
+        # Commands are buffered until the matching end_batch and then written
+        # to runtime_CLI at once
+        self.session.begin_batch()
+
+    def end_batch(self):
+        return self.session.end_batch()
+
+    def wait_batch(self, batch, timeout=None):
+        return self.session.wait_batch(batch, timeout=timeout)
+
+    def on_batch_done(self, batch, callback):
+        self.session.on_batch_done(batch, callback)
     
     def init_state(self, reset=False):
         reg_wr = 'register_write ingress.net_state 0 0'
@@ -91,13 +105,13 @@ class FelixSwitch:
             raise Exception('Invalid link (connected to s0 or host) to take down.')
         if_down = 'ifconfig {}-eth{} down'
         if_down = if_down.format(self.name, self.adj[peer])
-        self.log.write('{}\n'.format(if_down))
+        self.session.write_log('{}\n'.format(if_down))
         os.system(if_down)
 
     def set_all_interfaces_up(self, reset=False):
         if_up = 'ifconfig {}-eth{} up'
         for port in self.adj.values():
-            self.log.write('{}\n'.format(if_up.format(self.name, port)))
+            self.session.write_log('{}\n'.format(if_up.format(self.name, port)))
             os.system(if_up.format(self.name, port))
         #
         self.init_state(reset=reset)
@@ -113,175 +127,184 @@ class FelixSwitch:
         if_down = 'ifconfig {}-eth{} down'
         for port in self.adj.values():
             cmd = cmd + '{}\n'.format(if_down.format(self.name, port))
-        self.log.write(cmd)
+        self.session.write_log(cmd)
         os.system(cmd)
 
     def add_nrml_fwding_entry_host(self, host):
-        # Create member pointing to port connected to host
-        create_member = 'act_prof_create_member ingress.nrml_selector nrml_fwd {} 0'
+        # Get member pointing to port connected to host
         port = self.adj[host['name']]
-        member_id = '{}:{}'.format(host['name'], port)
-        create_member = create_member.format(port)
-        self._cmd(create_member)
-        member_handle = len(self.nf_members)
-        self.nf_members[member_id] = {'handle': member_handle,
-                                        'dst_switch': None,
-                                        'port': port}
+        member_handle = self.nf_pool.get_member('nrml_fwd {} 0'.format(port))
         # Add forwarding entry
         add_entry = 'table_indirect_add ingress.nrml_fwding_table {} => {}'
         add_entry = add_entry.format(host['ip'][:-3] + '/32', member_handle)
         self._cmd(add_entry)
     
     def add_nrml_fwding_entry(self, dstinfo, next_hops):
-        # Create act_prof_members pointing to each possible next hop
-        member_handles = []
-        for next_hop in next_hops:
-            port = self.adj[next_hop]
-            member_id = '{}:{}'.format(dstinfo['name'], port)
-            if member_id not in self.nf_members:
-                # Create member pointing to port connected to switch
-                create_member = 'act_prof_create_member ingress.nrml_selector nrml_fwd {} {}'
-                create_member = create_member.format(port, dstinfo['num'])
-                self._cmd(create_member)
-                member_handle = len(self.nf_members)
-                self.nf_members[member_id] = {
-                    'handle': member_handle, 'dst_switch': dstinfo['name'],
-                    'port': port
-                }
-                member_handles.append(member_handle)
-            else:
-                member_handles.append(self.nf_members[member_id]['handle'])
-        member_handles.sort()
-        # Create group containing all possible next hops
-        hs_string = ','.join([str(mh) for mh in member_handles])
-        group_id = '{}:{}'.format(dstinfo['name'], hs_string)
-        group_handle = None
-        if group_id not in self.nf_groups:
-            # Create group
-            create_group = 'act_prof_create_group ingress.nrml_selector'
-            self._cmd(create_group)
-            group_handle = len(self.nf_groups)
-            self.nf_groups[group_id] = {
-                'handle': group_handle, 'members': []
-            }
-            # Add members to group
-            for next_hop, member_handle in zip(next_hops, member_handles):
-                add_m2g = 'act_prof_add_member_to_group ingress.nrml_selector {} {}'
-                add_m2g = add_m2g.format(member_handle, group_handle)
-                self._cmd(add_m2g)
-                self.nf_groups[group_id]['members'].append(next_hop)
-        else:
-            group_handle = self.nf_groups[group_id]['handle']
+        # Get group of members pointing to each possible next hop
+        group_handle = self.nf_pool.get_group([
+            'nrml_fwd {} {}'.format(self.adj[next_hop], dstinfo['num'])
+            for next_hop in next_hops])
         # Add forwarding entry
         add_entry = 'table_indirect_add_with_group ingress.nrml_fwding_table {} => {}'
         add_entry = add_entry.format(dstinfo['ip'], group_handle)
         self._cmd(add_entry)
     
     def add_alt_fwding_entry(self, net_state, dstinfo, next_hops):
-        # Create members pointing to each possible next hop
-        member_handles = []
-        for next_hop in next_hops:
-            port = self.adj[next_hop]
-            member_id = '{}'.format(port)
-            if member_id not in self.af_members:
-                # Create member pointing to port connected to s0
-                create_member = 'act_prof_create_member ingress.alt_selector alt_fwd {}'
-                create_member = create_member.format(port)
-                self._cmd(create_member)
-                member_handle = len(self.af_members)
-                self.af_members[member_id] = {'handle': member_handle,
-                                                'port': port}
-                member_handles.append(member_handle)
-            else:
-                member_handles.append(self.af_members[member_id]['handle'])
-        member_handles.sort()
-        # Create group containing all possible next hops
-        hs_string = ','.join([str(mh) for mh in member_handles])
-        group_id = '{}'.format(hs_string)
-        group_handle = None
-        if group_id not in self.af_groups:
-            # Create group
-            create_group = 'act_prof_create_group ingress.alt_selector'
-            self._cmd(create_group)
-            group_handle = len(self.af_groups)
-            self.af_groups[group_id] = {'handle': group_handle, 'members': []}
-            # Add members to group
-            for next_hop, member_handle in zip(next_hops, member_handles):
-                add_m2g = 'act_prof_add_member_to_group ingress.alt_selector {} {}'
-                add_m2g = add_m2g.format(member_handle, group_handle)
-                self._cmd(add_m2g)
-                self.af_groups[group_id]['members'].append(next_hop)
-        else:
-            group_handle = self.af_groups[group_id]['handle']
-        # Add forwarding entry
-        entry_handle = self.get_new_alt_entry_handle()
+        self.begin_batch()
+        # Get group of members pointing to each possible next hop (shared
+        # with every other entry with the same next hops)
+        group_handle = self.af_pool.get_group([
+            'alt_fwd {}'.format(self.adj[next_hop]) for next_hop in next_hops])
         if net_state not in self.af_entries:
             self.af_entries[net_state] = {}
-        self.af_entries[net_state][dstinfo['name']] = {'handle': entry_handle}
-        add_entry = 'table_indirect_add_with_group ingress.alt_fwding_table {} {} => {}'
-        add_entry = add_entry.format(net_state, dstinfo['num'], group_handle)
-        self._cmd(add_entry)
+        entryinfo = self.af_entries[net_state].get(dstinfo['name'])
+        if entryinfo is None:
+            # Add forwarding entry
+            entry_handle = self.af_entry_handles.allocate()
+            self.af_entries[net_state][dstinfo['name']] = {
+                'handle': entry_handle, 'group': group_handle,
+                'next_hops': list(next_hops)}
+            add_entry = 'table_indirect_add_with_group ingress.alt_fwding_table {} {} => {}'
+            add_entry = add_entry.format(net_state, dstinfo['num'], group_handle)
+            self._cmd(add_entry)
+        elif entryinfo['group'] != group_handle:
+            # Point the installed entry to the new group
+            mod_entry = 'table_indirect_modify_with_group ingress.alt_fwding_table {} {}'
+            mod_entry = mod_entry.format(
+                self.af_entry_handles.handle(entryinfo['handle']), group_handle)
+            self._cmd(mod_entry)
+            self.af_pool.put_group(entryinfo['group'])
+            entryinfo['group'] = group_handle
+            entryinfo['next_hops'] = list(next_hops)
+        else:
+            # Already installed
+            self.af_pool.put_group(group_handle)
+        return self.end_batch()
     
-    def get_new_alt_entry_handle(self):
-        found = False
-        handle = 0
-        while found is False:
-            if self.next_af_handle not in self.af_entry_handles:
-                found = True
-                handle = self.next_af_handle
-                self.af_entry_handles[handle] = {'open': False, 'dels': 0}
-            elif self.af_entry_handles[self.next_af_handle]['open']:
-                found = True
-                handle = self.next_af_handle
-                self.af_entry_handles[handle]['open'] = False
-            self.next_af_handle = self.next_af_handle + 1
-        return handle
-
     def del_alt_fwding_entry(self, handle):
-        act_handle = 0x1000000*self.af_entry_handles[handle]['dels'] + handle
         remove_entry = 'table_indirect_delete ingress.alt_fwding_table {}'
-        remove_entry = remove_entry.format(act_handle)
+        remove_entry = remove_entry.format(self.af_entry_handles.handle(handle))
         self._cmd(remove_entry)
-        self.af_entry_handles[handle]['dels'] += 1
-        self.af_entry_handles[handle]['open'] = True
-        if handle < self.next_af_handle:
-            self.next_af_handle = handle
+        self.af_entry_handles.release(handle)
     
     def trim_alt_fwding_table(self, states_to_keep):
+        self.begin_batch()
         net_states_to_delete_entries = []
         for net_state, destinations in self.af_entries.items():
             if net_state in states_to_keep: continue
             for dst, entryinfo in destinations.items():
                 self.del_alt_fwding_entry(entryinfo['handle'])
+                self.af_pool.put_group(entryinfo['group'])
             net_states_to_delete_entries.append(net_state)
         for net_state in net_states_to_delete_entries:
             del self.af_entries[net_state]
+        self.af_pool.collect_if_needed()
+        self.end_batch()
     
     def clear_alt_fwding_table(self):
+        self.begin_batch()
         # Clear table
         clear_table = 'table_clear ingress.alt_fwding_table'
         self._cmd(clear_table)
-        # Reset structures
-        self.af_members = {}
-        self.af_groups = {}
+        # Release groups (kept for reuse until enough pile up) and reset
+        # structures
+        for destinations in self.af_entries.values():
+            for entryinfo in destinations.values():
+                self.af_pool.put_group(entryinfo['group'])
         self.af_entries = {}
-        self.af_entry_handles = {}
-        self.next_af_handle = 0
+        self.af_entry_handles.clear()
+        self.af_pool.collect_if_needed()
+        self.end_batch()
+        self.session.write_log('# {}\n'.format(self.af_pool.report()))
+
+    def selector_occupancy(self):
+        return {'nrml_selector': self.nf_pool.occupancy(),
+                'alt_selector': self.af_pool.occupancy()}
 
     def add_state_transition(self, cur_net_state, peerinfo, new_net_state, latent_net_state):
-        add_entry = 'table_add ingress.state_transition_table ingress.set_new_net_state {} {} => {} {}'
         # loc_state = self.d_loc_state
         # for u, v in failed_links:
         #     if u == self.name:
         #         loc_state = loc_state & ~(1<<(self.adj[v] - 1))
         #     elif v == self.name:
         #         loc_state = loc_state & ~(1<<(self.adj[u] - 1))
-        add_entry = add_entry.format(cur_net_state, peerinfo['num'],
-                                     new_net_state, latent_net_state)
-        self._cmd(add_entry)
+        key = (cur_net_state, peerinfo['name'])
+        params = (new_net_state, latent_net_state)
+        self.begin_batch()
+        entryinfo = self.st_entries.get(key)
+        if entryinfo is None:
+            add_entry = 'table_add ingress.state_transition_table ingress.set_new_net_state {} {} => {} {}'
+            add_entry = add_entry.format(cur_net_state, peerinfo['num'],
+                                         new_net_state, latent_net_state)
+            self._cmd(add_entry)
+            self.st_entries[key] = {'handle': self.st_entry_handles.allocate(),
+                                    'params': params}
+        elif entryinfo['params'] != params:
+            mod_entry = 'table_modify ingress.state_transition_table ingress.set_new_net_state {} {} {}'
+            mod_entry = mod_entry.format(
+                self.st_entry_handles.handle(entryinfo['handle']),
+                new_net_state, latent_net_state)
+            self._cmd(mod_entry)
+            entryinfo['params'] = params
+        return self.end_batch()
+    
+    def del_state_transition(self, key):
+        entryinfo = self.st_entries.pop(key)
+        remove_entry = 'table_delete ingress.state_transition_table {}'
+        remove_entry = remove_entry.format(
+            self.st_entry_handles.handle(entryinfo['handle']))
+        self._cmd(remove_entry)
+        self.st_entry_handles.release(entryinfo['handle'])
     
     def clear_state_transition_table(self):
         clear_table = 'table_clear ingress.state_transition_table'
         self._cmd(clear_table)
+        self.st_entries = {}
+        self.st_entry_handles.clear()
 
+    def missing_entries(self, entries):
+        # Entries ({'fwd': [...], 'stt': [...]}, as sent to the installer) that
+        # are not installed as given
+        missing = {'fwd': [], 'stt': []}
+        for entry in entries['fwd']:
+            net_state, dstinfo, next_hops = entry
+            entryinfo = self.af_entries.get(net_state, {}).get(dstinfo['name'])
+            if entryinfo is None or entryinfo['next_hops'] != list(next_hops):
+                missing['fwd'].append(entry)
+        for entry in entries['stt']:
+            cur_net_state, peerinfo, new_net_state, latent_net_state = entry
+            entryinfo = self.st_entries.get((cur_net_state, peerinfo['name']))
+            if entryinfo is None or entryinfo['params'] != (new_net_state, latent_net_state):
+                missing['stt'].append(entry)
+        return missing
 
+    def reconcile(self, entries):
+        # Brings the alternative forwarding and state transition tables to the
+        # given entries from what is installed. Entries not wanted anymore are
+        # deleted right away; the ones missing or different are returned, to
+        # be installed as usual.
+        wanted_fwd = set((e[0], e[1]['name']) for e in entries['fwd'])
+        wanted_stt = set((e[0], e[1]['name']) for e in entries['stt'])
+        self.begin_batch()
+        n_deleted = 0
+        for net_state in list(self.af_entries.keys()):
+            for dst in list(self.af_entries[net_state].keys()):
+                if (net_state, dst) in wanted_fwd: continue
+                entryinfo = self.af_entries[net_state].pop(dst)
+                self.del_alt_fwding_entry(entryinfo['handle'])
+                self.af_pool.put_group(entryinfo['group'])
+                n_deleted = n_deleted + 1
+            if not self.af_entries[net_state]:
+                del self.af_entries[net_state]
+        for key in list(self.st_entries.keys()):
+            if key not in wanted_stt:
+                self.del_state_transition(key)
+                n_deleted = n_deleted + 1
+        self.af_pool.collect_if_needed()
+        self.end_batch()
+        missing = self.missing_entries(entries)
+        n_missing = len(missing['fwd']) + len(missing['stt'])
+        n_kept = len(entries['fwd']) + len(entries['stt']) - n_missing
+        self.session.write_log('# reconciled: {} kept, {} deleted, {} to install\n'.format(
+            n_kept, n_deleted, n_missing))
+        return missing, n_kept, n_deleted
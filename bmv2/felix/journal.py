@@ -0,0 +1,150 @@
+# Event journal of the routing scripts
+#
+# Events are recorded with monotonic nanosecond timestamps into a ring buffer
+# and written as JSON lines by a background thread, so recording costs a tuple
+# and a list store. Writers claim slots from an itertools.count, whose next is
+# atomic, and never wait: if the flusher falls a whole ring behind, the oldest
+# events are overwritten and counted as lost.
+#
+# The first event, "journal", pairs the monotonic clock with the wall clock
+# (time_ns), which announcement capture timestamps use.
+#
+# Usage: python3 journal.py <events_jsonl> prints, for every announcement, how
+# long it took until the switches acknowledged the entries written after it.
+import atexit
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+
+
+RING_SIZE = 1 << 16  # events, a power of two
+FLUSH_INTERVAL = 0.1  # seconds
+
+
+class Journal:
+    def __init__(self, path, ring_size=RING_SIZE, flush_interval=FLUSH_INTERVAL):
+        if ring_size & (ring_size - 1):
+            raise Exception('Journal ring size must be a power of two.')
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.file = open(path, 'w')
+        self.mask = ring_size - 1
+        self.ring = [None]*ring_size  # ring[seq & mask] = (seq, ts, event, fields)
+        self.counter = itertools.count()
+        self.next_seq = 0  # next event to write
+        self.n_lost = 0
+        self.flush_interval = flush_interval
+        self.flush_lock = threading.Lock()
+        self.closed = threading.Event()
+        self.flusher = threading.Thread(target=self._run, daemon=True)
+        self.flusher.start()
+        self.record('journal', wall_ns=time.time_ns())
+
+    def record(self, event, **fields):
+        seq = next(self.counter)
+        self.ring[seq & self.mask] = (seq, time.monotonic_ns(), event, fields)
+
+    def flush(self):
+        with self.flush_lock:
+            lines = []
+            while True:
+                item = self.ring[self.next_seq & self.mask]
+                if item is None or item[0] < self.next_seq:
+                    break  # not written yet
+                if item[0] > self.next_seq:
+                    # Overwritten before being flushed, skip to the oldest
+                    # event the ring still holds
+                    oldest = item[0] - self.mask
+                    self.n_lost = self.n_lost + oldest - self.next_seq
+                    self.next_seq = oldest
+                    continue
+                seq, ts, event, fields = item
+                fields['ts'] = ts
+                fields['event'] = event
+                lines.append(json.dumps(fields))
+                self.next_seq = seq + 1
+            if lines:
+                self.file.write('\n'.join(lines) + '\n')
+                self.file.flush()
+
+    def _run(self):
+        while not self.closed.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        self.flush()
+        if self.n_lost:
+            self.file.write(json.dumps({'ts': time.monotonic_ns(),
+                                        'event': 'lost', 'n': self.n_lost}) + '\n')
+        self.file.close()
+
+
+journal = None
+
+
+def open_journal(path):
+    # Opens the journal of the process (flushed and closed at exit)
+    global journal
+    journal = Journal(path)
+    atexit.register(journal.close)
+    return journal
+
+
+def record(event, **fields):
+    # Does nothing unless the journal was opened
+    if journal is not None:
+        journal.record(event, **fields)
+
+
+def load(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def reaction_times(events):
+    # For every announcement: (event, ms until the computation ended, ms until
+    # the last entry acknowledgement before the next announcement, entries)
+    reactions = []
+    cur = None
+    for e in sorted(events, key=lambda x: x['ts']):
+        if e['event'] == 'announcement':
+            cur = {'ann': e, 'computed': None, 'acked': None, 'n_acked': 0}
+            reactions.append(cur)
+        elif cur is None:
+            continue
+        elif e['event'] == 'compute_end' and cur['computed'] is None:
+            cur['computed'] = e['ts']
+        elif e['event'] == 'entry_ack':
+            cur['acked'] = e['ts']
+            cur['n_acked'] = cur['n_acked'] + e['n']
+    results = []
+    for r in reactions:
+        start = r['ann']['ts']
+        results.append((r['ann'],
+                        (r['computed'] - start)/1e6 if r['computed'] else None,
+                        (r['acked'] - start)/1e6 if r['acked'] else None,
+                        r['n_acked']))
+    return results
+
+
+def main(path):
+    for ann, computed, acked, n_acked in reaction_times(load(path)):
+        fields = ' '.join('{}={}'.format(k, v) for k, v in ann.items()
+                          if k not in ('ts', 'event'))
+        print('{}: computed after {} ms, {} entries acknowledged after {} ms'.format(
+            fields,
+            '-' if computed is None else '{:.3f}'.format(computed), n_acked,
+            '-' if acked is None else '{:.3f}'.format(acked)))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(sys.argv[1])
+    else:
+        print('Usage: python3 journal.py <events_jsonl>')
+        sys.exit(1)
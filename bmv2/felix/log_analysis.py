@@ -0,0 +1,471 @@
+# Analysis of the packet loss and reordering of an experiment run
+#
+# Shared by the analyze_logs.py scripts of the experiments. Receiver logs are
+# read as columns (source address, TOS, identification, TTL, payload stamp and
+# receive time, 0 if not logged): binary logs as they are, CSV logs parsed once
+# and cached in <host>_receiver.npz next to them. The cache is used while the
+# modification time and size of the CSV log match the ones it was made from.
+import json
+import os
+import socket
+import struct
+
+import numpy as np
+import pandas as pd
+
+import journal
+import traffic_receiver
+import workload
+
+
+COLUMNS = [('src', np.uint32), ('tos', np.uint8), ('id', np.uint16),
+           ('ttl', np.uint8), ('ns', np.uint32), ('ts', np.uint64)]
+TIMELINE_BIN = 1.0  # ms of emulated time
+HIST_BINS = 50
+
+
+def load_hosts(exp):
+    # Hosts of an experiment definition and the host of each IP address
+    n_switches = exp['network']['n_switches']
+    hosts_per_switch = exp['network']['hosts_per_switch']
+    if 'edge_switches' in exp['network']:
+        edge_switches = exp['network']['edge_switches']
+    else:
+        edge_switches = ['s{}'.format(i + 1) for i in range(n_switches)]
+    hosts = {}
+    ip2host = {}
+    for i in range(n_switches):
+        snum = i + 1
+        sname = 's{}'.format(snum)
+        if sname in edge_switches:
+            for j in range(hosts_per_switch):
+                hnum = (snum - 1)*hosts_per_switch + j + 1
+                hname = 'h{}'.format(hnum)
+                hosts[hname] = {
+                    'name': hname,
+                    'num': hnum,
+                    'ip': '10.0.{}.{}'.format(snum, hnum),
+                    'mac': '08:00:00:00:{:02X}:{:02X}'.format(snum, hnum),
+                }
+                ip2host['10.0.{}.{}'.format(snum, hnum)] = hname
+    return hosts, ip2host
+
+
+def parse_csv_log(path):
+    df = pd.read_csv(path)
+    columns = {name: np.zeros(len(df), dtype=dtype) for name, dtype in COLUMNS}
+    if len(df):
+        ips, src = np.unique(df['src'].to_numpy(str), return_inverse=True)
+        addrs = np.array([traffic_receiver.ip_to_int(ip) for ip in ips], dtype=np.uint32)
+        columns['src'] = addrs[src]
+        for name in ('tos', 'id', 'ttl', 'ns'):
+            columns[name] = df[name].to_numpy().astype(columns[name].dtype)
+    return columns
+
+
+def read_receiver_columns(logs_dir, hname):
+    # Columns of the receiver log of host hname
+    bin_path = '{}/{}_receiver.bin'.format(logs_dir, hname)
+    if os.path.exists(bin_path):
+        records = traffic_receiver.load_records(bin_path)
+        return {name: records[name].astype(dtype) for name, dtype in COLUMNS}
+    csv_path = '{}/{}_receiver.txt'.format(logs_dir, hname)
+    cache_path = '{}/{}_receiver.npz'.format(logs_dir, hname)
+    st = os.stat(csv_path)
+    key = np.array([st.st_mtime_ns, st.st_size], dtype=np.int64)
+    if os.path.exists(cache_path):
+        try:
+            with np.load(cache_path) as cache:
+                if np.array_equal(cache['key'], key):
+                    return {name: cache[name] for name, _ in COLUMNS}
+        except Exception:
+            pass  # unreadable, parse again
+    columns = parse_csv_log(csv_path)
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, key=key, **columns)
+    os.replace(tmp_path, cache_path)
+    return columns
+
+
+def receiver_packets(logs_dir, hname, ip2host, host_index):
+    # Packet numbers in a receiver log and the (src, dst) pair of each, coded
+    # as src*len(host_index) + dst over the host indices
+    columns = read_receiver_columns(logs_dir, hname)
+    addrs, src = np.unique(columns['src'], return_inverse=True)
+    src_index = np.array([host_index[ip2host[socket.inet_ntoa(struct.pack('!I', a))]]
+                          for a in addrs.tolist()], dtype=np.int64)
+    return pd.DataFrame({
+        'pair': src_index[src]*len(host_index) + host_index[hname],
+        'num': 2**32 * columns['tos'].astype(np.int64) + columns['id'],
+        'ts': columns['ts'].astype(np.int64),
+    })
+
+
+def group_packets(recvd, pairs, host_index):
+    # The received packets of the (src, dst, expected) pairs, grouped by pair
+    # in the order they were logged. Returns the number received per pair,
+    # the pair of each packet and the other columns of recvd.
+    n_hosts = len(host_index)
+    codes = np.array([host_index[src]*n_hosts + host_index[dst] for src, dst, _ in pairs],
+                     dtype=np.int64)
+    order = np.argsort(recvd['pair'].to_numpy(), kind='stable')
+    pair_codes = recvd['pair'].to_numpy()[order]
+    begins = np.searchsorted(pair_codes, codes, side='left')
+    ends = np.searchsorted(pair_codes, codes, side='right')
+    received = ends - begins
+    pair_of = np.repeat(np.arange(len(pairs)), received)
+    keep = order[np.concatenate([np.arange(b, e) for b, e in zip(begins, ends)])] \
+        if len(pairs) else np.zeros(0, dtype=np.int64)
+    columns = {name: recvd[name].to_numpy()[keep] for name in recvd.columns if name != 'pair'}
+    return received, pair_of, columns
+
+
+def missing_packets(pair_of, nums, expected):
+    # Packets in range(expected) of each pair that never arrived, as positions
+    # over the expected packets of all pairs one after the other (those of
+    # pair i start at bases[i])
+    bases = np.concatenate([[0], np.cumsum(np.maximum(expected, 0))])
+    arrived = np.zeros(bases[-1], dtype=np.bool_)
+    in_range = (nums >= 0) & (nums < expected[pair_of])
+    arrived[bases[pair_of[in_range]] + nums[in_range]] = True
+    return bases, np.flatnonzero(~arrived)
+
+
+def analyze_pairs(recvd, pairs, host_index):
+    # Losses and reorders of all (src, dst, expected) pairs in one pass over
+    # the received packets (grouped by pair, in the order they were logged).
+    # A packet is reordered if its number is below the highest one received
+    # before it, and lost if its number in range(expected) never arrives.
+    # Returns the per-pair counts, the loss and reorder marker summaries
+    # (indexed like the counts), and per pair the lists of normal, reordered
+    # and lost markers: (num + 1)/expected as a percentage.
+    expected = np.array([exp for _, _, exp in pairs], dtype=np.int64)
+    received, pair_of, columns = group_packets(recvd, pairs, host_index)
+    nums = columns['num']
+    lost = expected - received
+    exp_of = expected[pair_of]
+
+    # Running max of the previous packets of the same pair, kept apart by
+    # shifting each pair above the numbers of the pairs before it
+    span = int(nums.max()) + 2 if len(nums) else 1
+    shifted = nums + pair_of*span
+    prev_max = np.empty_like(shifted)
+    prev_max[1:] = np.maximum.accumulate(shifted)[:-1]
+    firsts = (np.cumsum(received) - received)[received > 0]
+    prev_max[firsts] = pair_of[firsts]*span - 1
+    reo = shifted < prev_max
+
+    # Lost packets of the pairs that lost some
+    bases, missing = missing_packets(pair_of, nums, expected)
+    missing_pair = np.searchsorted(bases, missing, side='right') - 1
+    missing_num = missing - bases[missing_pair]
+    has_lost = lost[missing_pair] > 0
+    missing_pair = missing_pair[has_lost]
+    missing_num = missing_num[has_lost]
+
+    nrml_markers = ((nums[~reo] + 1)/exp_of[~reo])*100
+    reo_markers = ((nums[reo] + 1)/exp_of[reo])*100
+    lst_markers = ((missing_num + 1)/expected[missing_pair])*100
+    n_reordered = np.bincount(pair_of[reo], minlength=len(pairs))
+
+    ana = pd.DataFrame({
+        'src': [src for src, _, _ in pairs],
+        'dst': [dst for _, dst, _ in pairs],
+        'expected': expected,
+        'received': received,
+        'lost': lost,
+        'reordered': n_reordered,
+    }, columns=('src', 'dst', 'expected', 'received', 'lost', 'reordered'))
+    summary = ['min', 'mean', 'median', 'max']
+    ana_lst = pd.Series(lst_markers).groupby(missing_pair).agg(summary)
+    ana_lst = ana_lst.reindex(np.flatnonzero(lost > 0))
+    ana_reo = pd.Series(reo_markers).groupby(pair_of[reo]).agg(summary)
+
+    markers = []
+    nrml_split = np.split(nrml_markers, np.cumsum(received - n_reordered)[:-1])
+    reo_split = np.split(reo_markers, np.cumsum(n_reordered)[:-1])
+    lst_split = np.split(lst_markers, np.searchsorted(missing_pair, np.arange(1, len(pairs))))
+    for idx in range(len(pairs)):
+        markers.append((nrml_split[idx].tolist(), reo_split[idx].tolist(),
+                        lst_split[idx].tolist()))
+    return ana, ana_lst, ana_reo, markers
+
+
+def send_times(exp, hosts, pairs):
+    # Send time of every packet of the pairs, in seconds since the start of
+    # the workload, generated again as build_workload.py generated the PCAPs
+    slowdown = exp['slowdown']
+    wl = exp['workload']
+    multiplier = wl['multiplier'] if 'multiplier' in wl else 1.0
+    seed = wl['seed'] if 'seed' in wl else workload.DEFAULT_SEED
+    rates = {}
+    for demand in wl['demands']:
+        rates[(demand['src'], demand['dst'])] = (demand['rate']/slowdown)*multiplier
+    times = []
+    for src, dst, expected in pairs:
+        t = workload.gen_traffic(hosts[src], hosts[dst], rates[(src, dst)],
+                                 wl['duration']*slowdown, seed)['time']
+        if len(t) != expected:
+            raise Exception('The workload of {}-{} has {} packets, not {}.'.format(
+                src, dst, len(t), expected))
+        times.append(t)
+    return times
+
+
+def failure_times(exp, logs_dir, pair_src, pair_of, ts, sent):
+    # Time of each failure ralph.py injected, per pair, in the send time of
+    # the pair's packets: (n_pairs, n_failures). With the events ralph
+    # recorded in logs/ralph_events.jsonl and the receive times of binary
+    # receiver logs, the failures are placed on the wall clock and each
+    # sender's start is taken as the earliest receive time of its packets
+    # minus their send times. Otherwise they are placed where ralph
+    # scheduled them, from the start of the workload.
+    slowdown = exp['slowdown']
+    events_path = '{}/ralph_events.jsonl'.format(logs_dir)
+    walls = None
+    if os.path.exists(events_path) and len(ts) and (ts > 0).all():
+        events = journal.load(events_path)
+        clock = [e for e in events if e['event'] == 'journal'][0]
+        walls = [(clock['wall_ns'] + e['ts'] - clock['ts'])/1e9
+                 for e in events if e['event'] == 'failure']
+    if walls is not None and len(walls) == len(exp['network']['failures']):
+        sender_starts = np.full(int(pair_src.max()) + 1, np.inf)
+        np.minimum.at(sender_starts, pair_src[pair_of], ts/1e9 - sent)
+        starts = sender_starts[pair_src]
+        return np.array(walls)[None, :] - starts[:, None], 'measured'
+    delays = [f['delay']*slowdown for f in exp['network']['failures']]
+    return np.tile(np.cumsum(delays), (len(pair_src), 1)), 'scheduled'
+
+
+def distribution(values, n_bins=HIST_BINS):
+    # Histogram and CDF (at every percentile) of values
+    if not len(values):
+        return {'n': 0, 'hist': {'counts': [], 'edges': []}, 'cdf': {'p': [], 'values': []}}
+    counts, edges = np.histogram(values, bins=n_bins)
+    p = np.arange(101)
+    return {'n': len(values),
+            'hist': {'counts': counts.tolist(), 'edges': edges.tolist()},
+            'cdf': {'p': p.tolist(), 'values': np.percentile(values, p).tolist()}}
+
+
+def timeline(exp_json, bwl_json, logs_dir, bin_ms=TIMELINE_BIN, quiet=False,
+             skip_missing=False):
+    # Writes loss_timeline.json to logs_dir: the packets lost per bin_ms of
+    # send time, the intervals over which each flow lost consecutive packets,
+    # and the time to recovery of each flow after each failure (from the
+    # failure to the end of the last loss interval of the flow that started
+    # before the next failure; flows with none are not affected). Times are
+    # in ms of emulated network time (workload time over slowdown).
+    with open(exp_json) as f:
+        exp = json.load(f)
+    hosts, ip2host = load_hosts(exp)
+    with open(bwl_json) as f:
+        total_pkts = json.load(f)
+    slowdown = exp['slowdown']
+    duration = exp['workload']['duration']*slowdown
+
+    host_index = {hname: i for i, hname in enumerate(hosts.keys())}
+    frames = [pd.DataFrame({'pair': [], 'num': [], 'ts': []}, dtype=np.int64)]
+    for host, hinfo in hosts.items():
+        try:
+            frames.append(receiver_packets(logs_dir, hinfo['name'], ip2host, host_index))
+        except OSError:
+            # No log (or an unreadable one) for a host that received nothing
+            if not skip_missing:
+                raise
+    recvd = pd.concat(frames, ignore_index=True)
+    pairs = []
+    for demand in exp['workload']['demands']:
+        src, dst = demand['src'], demand['dst']
+        if skip_missing and (src not in total_pkts or dst not in total_pkts[src]): continue
+        pairs.append((src, dst, total_pkts[src][dst]))
+    expected = np.array([exp for _, _, exp in pairs], dtype=np.int64)
+    pair_src = np.array([host_index[src] for src, _, _ in pairs], dtype=np.int64)
+
+    # Send time of every expected packet, at its position
+    times = send_times(exp, hosts, pairs)
+    times = np.concatenate(times + [[duration]])
+    received, pair_of, columns = group_packets(recvd, pairs, host_index)
+    nums = columns['num']
+    bases, missing = missing_packets(pair_of, nums, expected)
+    valid = (nums >= 0) & (nums < expected[pair_of])
+    fails, fails_source = failure_times(exp, logs_dir, pair_src, pair_of[valid],
+                                        columns['ts'][valid],
+                                        times[bases[pair_of[valid]] + nums[valid]])
+
+    # Loss intervals: runs of consecutive lost packets of a pair, from the
+    # send time of the first one to that of the next packet of the pair (or
+    # the end of the workload)
+    missing_pair = np.searchsorted(bases, missing, side='right') - 1
+    new_run = np.ones(len(missing), dtype=np.bool_)
+    new_run[1:] = (np.diff(missing) != 1) | (np.diff(missing_pair) != 0)
+    run_first = missing[new_run]
+    run_end = missing[np.append(new_run[1:], True)] + 1
+    run_pair = missing_pair[new_run]
+    run_start_t = times[run_first]
+    run_end_t = np.where(run_end < bases[run_pair + 1], times[np.minimum(run_end, len(times) - 1)],
+                         duration)
+
+    # Failure each interval follows, and the time to recovery of each flow
+    n_fails = fails.shape[1]
+    run_fail = (fails[run_pair] <= run_start_t[:, None]).sum(axis=1) - 1
+    after = run_fail >= 0
+    recovered = np.full((len(pairs), n_fails), -np.inf)
+    np.maximum.at(recovered, (run_pair[after], run_fail[after]), run_end_t[after])
+    affected = recovered > -np.inf
+    ttr = (recovered - fails)*1e3/slowdown
+
+    n_bins = max(int(np.ceil(duration*1e3/slowdown/bin_ms)), 1)
+    edges = np.arange(n_bins + 1)*bin_ms*slowdown/1e3
+    result = {
+        'slowdown': slowdown,
+        'failure_times': fails_source,
+        'timeline': {
+            'bin_ms': bin_ms,
+            'sent': np.histogram(times[:-1], bins=edges)[0].tolist(),
+            'lost': np.histogram(times[missing], bins=edges)[0].tolist(),
+        },
+        'loss_intervals': {
+            'n': int(len(run_pair)),
+            'n_before_failures': int((~after).sum()),
+            'duration_ms': distribution((run_end_t - run_start_t)*1e3/slowdown),
+            'packets': distribution(run_end - run_first),
+        },
+        'failures': [],
+        'recovery_ms': distribution(ttr[affected]),
+    }
+    for k, failure in enumerate(exp['network']['failures']):
+        result['failures'].append({
+            'failure': failure,
+            'time_ms': float(np.median(fails[:, k])*1e3/slowdown) if len(pairs) else None,
+            'n_flows': len(pairs),
+            'n_affected': int(affected[:, k].sum()),
+            'recovery_ms': distribution(ttr[affected[:, k], k]),
+            'flows': {'{}-{}'.format(src, dst): ttr[i, k]
+                      for i, (src, dst, _) in enumerate(pairs) if affected[i, k]},
+        })
+    with open(logs_dir + '/loss_timeline.json', 'w') as f:
+        f.write(json.dumps(result))
+
+    if quiet is not True:
+        print('\nLoss intervals: {} ({} before any failure), failure times {}'.format(
+            len(run_pair), int((~after).sum()), fails_source))
+        for k, res in enumerate(result['failures']):
+            line = 'failure {} at {:.3f} ms: {}/{} flows affected'.format(
+                k, res['time_ms'] if res['time_ms'] is not None else float('nan'),
+                res['n_affected'], res['n_flows'])
+            if res['n_affected']:
+                values = res['recovery_ms']['cdf']['values']
+                line = line + ', recovery min={:.3f} median={:.3f} p95={:.3f} max={:.3f} ms'.format(
+                    values[0], values[50], values[95], values[100])
+            print(line)
+    return result
+
+
+def main(exp_json, bwl_json, logs_dir, quiet=False, skip_missing=False):
+    # Writes analyze_logs.json to logs_dir and, unless quiet, prints the
+    # losses and reorders of every pair. With skip_missing, receiver logs
+    # that cannot be read are ignored, as are pairs the workload log does not
+    # list or that received no packets.
+    with open(exp_json) as f:
+        exp = json.load(f)
+    hosts, ip2host = load_hosts(exp)
+
+    # Load build wokrload log json file
+    with open(bwl_json) as f:
+        total_pkts = json.load(f)
+
+    # Received packets of all receivers, with their (src, dst) pair
+    host_index = {hname: i for i, hname in enumerate(hosts.keys())}
+    frames = [pd.DataFrame({'pair': [], 'num': [], 'ts': []}, dtype=np.int64)]
+    for host, hinfo in hosts.items():
+        try:
+            frames.append(receiver_packets(logs_dir, hinfo['name'], ip2host, host_index))
+        except OSError:
+            # No log (or an unreadable one) for a host that received nothing
+            if not skip_missing:
+                raise
+    recvd = pd.concat(frames, ignore_index=True)
+    present = set(np.unique(recvd['pair']).tolist())
+
+    # Pairs in the order they are reported
+    pairs = []
+    for src in hosts.keys():
+        for dst in hosts.keys():
+            if src == dst: continue
+            if skip_missing:
+                if src not in total_pkts or dst not in total_pkts[src]: continue
+                if host_index[src]*len(hosts) + host_index[dst] not in present: continue
+            pairs.append((src, dst, total_pkts[src][dst]))
+
+    ana, ana_lst, ana_reo, markers = analyze_pairs(recvd, pairs, host_index)
+
+    stats = {}
+    stats['total'] = {
+        'n_expected': 0,
+        'n_normal': 0,
+        'p_normal': None,
+        'normal': list(),
+        'n_reordered': 0,
+        'p_reordered': None,
+        'reordered': list(),
+        'n_lost': 0,
+        'p_lost': None,
+        'lost': list()
+    }
+
+    for src in hosts.keys():
+        stats[src] = {}
+    for idx, row in enumerate(ana.itertuples(index=False)):
+        expected = row.expected
+        received = row.received
+        nrml, reo, lst = markers[idx]
+        stats[row.src][row.dst] = {
+            'n_expected': expected,
+            'n_normal': received,
+            'p_normal': received*100.0/expected,
+            'normal': nrml,
+            'n_reordered': row.reordered,
+            'p_reordered': row.reordered*100.0/expected,
+            'reordered': reo,
+            'n_lost': row.lost,
+            'p_lost': row.lost*100.0/expected,
+            'lost': lst,
+        }
+    # Markers of all pairs, in order
+    stats['total']['n_expected'] = int(ana['expected'].sum())
+    stats['total']['n_normal'] = int(ana['received'].sum())
+    stats['total']['normal'] = [x for m in markers for x in m[0]]
+    stats['total']['n_reordered'] = int(ana['reordered'].sum())
+    stats['total']['reordered'] = [x for m in markers for x in m[1]]
+    stats['total']['n_lost'] = int(ana['lost'].sum())
+    stats['total']['lost'] = [x for m in markers for x in m[2]]
+
+    stats['total']['p_normal'] = stats['total']['n_normal']*100.0/stats['total']['n_expected']
+    stats['total']['p_reordered'] = stats['total']['n_reordered']*100.0/stats['total']['n_expected']
+    stats['total']['p_lost'] = stats['total']['n_lost']*100.0/stats['total']['n_expected']
+
+    with open(logs_dir + '/analyze_logs.json', 'w') as f:
+        # Same text as json.dump, from the C encoder
+        f.write(json.dumps(stats))
+
+    if quiet is not True:
+        for idx, row in ana.iterrows():
+            perc = (row['expected'] - row['received'])*100/row['expected']
+            print(f"src={row['src']:<3} dst={row['dst']:<3} expected={row['expected']:6d} received={row['received']:6d} lost={row['lost']:6d} {perc:6.2f}% reordered={row['reordered']:6d}")
+            if row['lost'] > 0:
+                row_lst = ana_lst.loc[idx]
+                print(f"    loss markers: min={row_lst['min']:6.2f}% mean={row_lst['mean']:6.2f}% median={row_lst['median']:6.2f}% max={row_lst['max']:6.2f}%")
+            if row['reordered'] > 0:
+                row_reo = ana_reo.loc[idx]
+                print(f"    reorder markers: min={row_reo['min']:6.2f}% mean={row_reo['mean']:6.2f}% median={row_reo['median']:6.2f}% max={row_reo['max']:6.2f}%")
+
+        perc = (ana['expected'].sum() - ana['received'].sum())*100/ana['expected'].sum()
+        print(f"\nsrc=all dst=all expected={ana['expected'].sum():6d} received={ana['received'].sum():6d} lost={ana['lost'].sum():6d} {perc:6.2f}% reordered={ana['reordered'].sum():6d}")
+        if ana['lost'].sum() > 0:
+            print(f"    loss markers: min={ana_lst['min'].min():6.2f}% mean={ana_lst['mean'].mean():6.2f}% median={ana_lst['median'].median():6.2f}% max={ana_lst['max'].max():6.2f}%")
+        if ana['reordered'].sum() > 0:
+            print(f"    reorder markers: min={ana_reo['min'].min():6.2f}% mean={ana_reo['mean'].mean():6.2f}% median={ana_reo['median'].median():6.2f}% max={ana_reo['max'].max():6.2f}%")
+
+    return ana['lost'].sum(), ana['reordered'].sum()
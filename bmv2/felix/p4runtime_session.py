@@ -0,0 +1,367 @@
+# Drives the switch over P4Runtime instead of a runtime_CLI.py child.
+#
+# It takes the same text commands as cli_session.RuntimeCLISession and
+# translates them into P4Runtime updates. Member, group and entry handles are
+# assigned the way bmv2 assigns them, so the switch classes can keep mirroring
+# handles locally regardless of the driver in use.
+import heapq
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'utils'))
+
+import grpc
+from p4.config.v1 import p4info_pb2
+from p4.v1 import p4runtime_pb2
+
+from p4runtime_lib import bmv2, convert, helper
+
+
+ENTRY_HANDLE_MASK = 0xFFFFFF  # bmv2 keeps a version counter above these bits
+
+# Kinds of updates, each one in its own WriteRequest and written in this
+# order: deletes from entries down to the members they referred to, then the
+# rest from members up to the entries referring to them. Entry modifies are
+# written last too, so removing members from a group or deleting a group or
+# member after an entry update (e.g. collecting the group an entry was just
+# moved off) starts a new segment of the batch, ordered on its own after the
+# previous one.
+DELETE_ENTRY = 0
+DELETE_GROUP = 1
+DELETE_MEMBER = 2
+MEMBER = 3
+GROUP = 4
+ENTRY = 5
+
+
+def parse_value(value):
+    if convert.matchesIPv4(value) or convert.matchesMac(value):
+        return value
+    if value.startswith('0x'):
+        return int(value, 16)
+    return int(value)
+
+
+class P4RuntimeSession:
+    def __init__(self, sw_info, log):
+        self.log = log
+        self.log_lock = threading.Lock()
+        with open(sw_info['runtime_json']) as f:
+            runtime_json = json.load(f)
+        self.p4info = helper.P4InfoHelper(runtime_json['p4info'])
+        address = '127.0.0.1:{}'.format(sw_info['grpc_port'])
+        self.conn = bmv2.Bmv2SwitchConnection(name=sw_info['name'],
+                                              address=address,
+                                              device_id=sw_info['device_id'])
+        self.conn.MasterArbitrationUpdate()
+        # Handles, as runtime_CLI.py would have returned them
+        self.next_handle = {}  # next_handle[(kind, act_prof)] = next unused handle
+        self.free_handles = {}  # free_handles[(kind, act_prof)] = heap of released handles
+        self.group_members = {}  # group_members[(act_prof, group)] = [member, ...]
+        self.entries = {}  # entries[table][handle] = table entry
+        self.free_entries = {}  # free_entries[table] = heap of released handles
+        # Batching
+        self.batch_lock = threading.RLock()
+        self.depth = 0
+        self.n_cmds = 0
+        self.updates = []  # updates = [(kind, key, update), ...]
+        self.segments = []  # indices into updates where a segment starts
+        self.segment_entries = False  # whether the current segment updates entries
+        self.group_updates = {}  # group_updates[(act_prof, group)] = pending update
+        self.next_batch = 0
+        self.batches = {}  # batches[batch] = {'n_cmds', 'sent', 'done', 'errors'}
+
+    def write_log(self, text):
+        with self.log_lock:
+            self.log.write(text)
+
+    def cmd(self, cmdline, flush=True):
+        with self.batch_lock:
+            for line in cmdline.strip('\n').split('\n'):
+                self.write_log('{}\n'.format(line))
+                self._translate(line.split())
+                self.n_cmds = self.n_cmds + 1
+            if self.depth == 0:
+                self._write()
+
+    def begin_batch(self):
+        # Batches may be nested, only the outermost one is sent
+        self.batch_lock.acquire()
+        self.depth = self.depth + 1
+
+    def end_batch(self):
+        try:
+            self.depth = self.depth - 1
+            if self.depth > 0 or self.n_cmds == 0:
+                return None
+            batch = self.next_batch
+            self.next_batch = self.next_batch + 1
+            info = {'n_cmds': self.n_cmds, 'sent': time.time(), 'done': None,
+                    'errors': 0}
+            self.batches[batch] = info
+            n_requests, info['errors'] = self._write()
+            info['done'] = time.time()
+            self.write_log('# batch {} done: {} commands in {} requests, {} errors, {:.3f} ms\n'.format(
+                batch, info['n_cmds'], n_requests, info['errors'],
+                (info['done'] - info['sent'])*1e3))
+            return batch
+        finally:
+            self.batch_lock.release()
+
+    def wait_batch(self, batch, timeout=None):
+        # Writes are synchronous, a sent batch is already acknowledged
+        return self.batches[batch]
+
+    def on_batch_done(self, batch, callback):
+        callback(self.batches[batch])
+
+    def close(self):
+        self.conn.shutdown()
+
+    def _write(self):
+        # Group the updates of each segment by kind, keeping their order
+        # within a kind, and split whenever an entity shows up twice in the
+        # same request
+        bounds = [0] + self.segments + [len(self.updates)]
+        segments = [sorted(self.updates[start:end], key=lambda u: u[0])
+                    for start, end in zip(bounds[:-1], bounds[1:])]
+        self.updates = []
+        self.segments = []
+        self.segment_entries = False
+        self.group_updates = {}
+        self.n_cmds = 0
+        requests = []
+        for updates in segments:
+            keys = set()
+            for i, (kind, key, update) in enumerate(updates):
+                if i == 0 or requests[-1][0] != kind or key in keys:
+                    requests.append((kind, []))
+                    keys = set()
+                requests[-1][1].append(update)
+                keys.add(key)
+        errors = 0
+        for kind, request in requests:
+            try:
+                self.conn.WriteUpdates(request)
+            except grpc.RpcError as e:
+                self.write_log('Error: {}\n'.format(e.details()))
+                errors = errors + 1
+        return len(requests), errors
+
+    def _end_segment(self):
+        # Called before a group loses members or a group or member is
+        # deleted: entries updated so far are written before it. Pending
+        # group updates stay in their segment.
+        if self.segment_entries:
+            self.segments.append(len(self.updates))
+            self.segment_entries = False
+            self.group_updates = {}
+
+    def _add(self, kind, key, update_type, field, entity):
+        if kind == ENTRY:
+            self.segment_entries = True
+        update = p4runtime_pb2.Update()
+        update.type = update_type
+        getattr(update.entity, field).CopyFrom(entity)
+        self.updates.append((kind, key, update))
+        return update
+
+    def _action(self, action_name, params):
+        p4info_action = self.p4info.get('actions', name=action_name)
+        action = p4runtime_pb2.Action()
+        action.action_id = p4info_action.preamble.id
+        for p4info_param, value in zip(p4info_action.params, params):
+            action.params.extend([self.p4info.get_action_param_pb(
+                p4info_action.preamble.name, p4info_param.name,
+                parse_value(value))])
+        return action
+
+    def _table_entry(self, table_name, keys):
+        p4info_table = self.p4info.get('tables', name=table_name)
+        table_entry = p4runtime_pb2.TableEntry()
+        table_entry.table_id = p4info_table.preamble.id
+        for mf, key in zip(p4info_table.match_fields, keys):
+            if mf.match_type == p4info_pb2.MatchField.LPM:
+                addr, prefix_len = key.split('/')
+                value = (parse_value(addr), int(prefix_len))
+            elif mf.match_type == p4info_pb2.MatchField.TERNARY:
+                value = tuple(parse_value(v) for v in key.split('&&&'))
+            elif mf.match_type == p4info_pb2.MatchField.RANGE:
+                value = tuple(parse_value(v) for v in key.split('->'))
+            else:
+                value = parse_value(key)
+            table_entry.match.extend([self.p4info.get_match_field_pb(
+                p4info_table.preamble.name, mf.name, value)])
+        return table_entry
+
+    def _entry_key(self, table_entry):
+        match = tuple(m.SerializeToString() for m in table_entry.match)
+        return (ENTRY, table_entry.table_id, match)
+
+    def _insert_entry(self, table_name, table_entry):
+        # bmv2 hands out the lowest released handle first
+        if table_name not in self.entries:
+            self.entries[table_name] = {}
+            self.free_entries[table_name] = []
+        if self.free_entries[table_name]:
+            handle = heapq.heappop(self.free_entries[table_name])
+        else:
+            handle = len(self.entries[table_name])
+        self.entries[table_name][handle] = table_entry
+        key = self._entry_key(table_entry)
+        self._add(ENTRY, key, p4runtime_pb2.Update.INSERT, 'table_entry',
+                  table_entry)
+
+    def _delete_entry(self, table_name, handle):
+        table_entry = self.entries[table_name].pop(handle)
+        heapq.heappush(self.free_entries[table_name], handle)
+        key = self._entry_key(table_entry)
+        self._add(DELETE_ENTRY, key, p4runtime_pb2.Update.DELETE,
+                  'table_entry', table_entry)
+
+    def _new_handle(self, kind, act_prof):
+        # bmv2 hands out the lowest released handle first
+        free = self.free_handles.setdefault((kind, act_prof), [])
+        if free:
+            return heapq.heappop(free)
+        handle = self.next_handle.get((kind, act_prof), 0)
+        self.next_handle[(kind, act_prof)] = handle + 1
+        return handle
+
+    def _release_handle(self, kind, act_prof, handle):
+        heapq.heappush(self.free_handles.setdefault((kind, act_prof), []),
+                       handle)
+
+    def _update_group(self, act_prof, group):
+        # Pending group updates absorb later membership changes
+        members = self.group_members[(act_prof, group)]
+        if (act_prof, group) in self.group_updates:
+            entity = self.group_updates[(act_prof, group)].entity.action_profile_group
+            del entity.members[:]
+        else:
+            entity = p4runtime_pb2.ActionProfileGroup()
+            entity.action_profile_id = self.p4info.get_action_profiles_id(act_prof)
+            entity.group_id = group
+            update = self._add(GROUP, (GROUP, act_prof, group),
+                               p4runtime_pb2.Update.MODIFY,
+                               'action_profile_group', entity)
+            self.group_updates[(act_prof, group)] = update
+            entity = update.entity.action_profile_group
+        for member in members:
+            entity.members.add(member_id=member, weight=1)
+
+    def _translate(self, args):
+        if not args or args[0] == 'EOF':
+            return
+        cmd = args[0]
+        if '=>' in args:
+            sep = args.index('=>')
+            head, params = args[1:sep], args[sep + 1:]
+        else:
+            head, params = args[1:], []
+        if cmd == 'register_write':
+            register = self.p4info.get('registers', name=head[0])
+            bitwidth = register.type_spec.bitstring.bit.bitwidth
+            entity = p4runtime_pb2.RegisterEntry()
+            entity.register_id = register.preamble.id
+            entity.index.index = int(head[1])
+            entity.data.bitstring = convert.encode(parse_value(head[2]), bitwidth)
+            self._add(ENTRY, (ENTRY, cmd, head[0], head[1]),
+                      p4runtime_pb2.Update.MODIFY, 'register_entry', entity)
+        elif cmd == 'table_add':
+            table_entry = self._table_entry(head[0], head[2:])
+            table_entry.action.action.CopyFrom(self._action(head[1], params))
+            self._insert_entry(head[0], table_entry)
+        elif cmd == 'table_indirect_add':
+            table_entry = self._table_entry(head[0], head[1:])
+            table_entry.action.action_profile_member_id = int(params[0])
+            self._insert_entry(head[0], table_entry)
+        elif cmd == 'table_indirect_add_with_group':
+            table_entry = self._table_entry(head[0], head[1:])
+            table_entry.action.action_profile_group_id = int(params[0])
+            self._insert_entry(head[0], table_entry)
+        elif cmd == 'table_modify':
+            handle = int(head[2]) & ENTRY_HANDLE_MASK
+            table_entry = p4runtime_pb2.TableEntry()
+            table_entry.CopyFrom(self.entries[head[0]][handle])
+            table_entry.action.action.CopyFrom(self._action(head[1], head[3:]))
+            self.entries[head[0]][handle] = table_entry
+            self._add(ENTRY, self._entry_key(table_entry),
+                      p4runtime_pb2.Update.MODIFY, 'table_entry', table_entry)
+        elif cmd == 'table_indirect_modify_with_group':
+            handle = int(head[1]) & ENTRY_HANDLE_MASK
+            table_entry = p4runtime_pb2.TableEntry()
+            table_entry.CopyFrom(self.entries[head[0]][handle])
+            table_entry.action.action_profile_group_id = int(head[2])
+            self.entries[head[0]][handle] = table_entry
+            self._add(ENTRY, self._entry_key(table_entry),
+                      p4runtime_pb2.Update.MODIFY, 'table_entry', table_entry)
+        elif cmd in ('table_delete', 'table_indirect_delete'):
+            self._delete_entry(head[0], int(head[1]) & ENTRY_HANDLE_MASK)
+        elif cmd == 'table_clear':
+            # Only entries installed through this session are known here
+            for handle in sorted(self.entries.get(head[0], {})):
+                self._delete_entry(head[0], handle)
+            self.entries[head[0]] = {}
+            self.free_entries[head[0]] = []
+        elif cmd == 'act_prof_create_member':
+            member = self._new_handle(MEMBER, head[0])
+            entity = p4runtime_pb2.ActionProfileMember()
+            entity.action_profile_id = self.p4info.get_action_profiles_id(head[0])
+            entity.member_id = member
+            entity.action.CopyFrom(self._action(head[1], head[2:]))
+            self._add(MEMBER, (MEMBER, head[0], member),
+                      p4runtime_pb2.Update.INSERT, 'action_profile_member',
+                      entity)
+        elif cmd == 'act_prof_create_group':
+            group = self._new_handle(GROUP, head[0])
+            self.group_members[(head[0], group)] = []
+            entity = p4runtime_pb2.ActionProfileGroup()
+            entity.action_profile_id = self.p4info.get_action_profiles_id(head[0])
+            entity.group_id = group
+            update = self._add(GROUP, (GROUP, head[0], group),
+                               p4runtime_pb2.Update.INSERT,
+                               'action_profile_group', entity)
+            self.group_updates[(head[0], group)] = update
+        elif cmd == 'act_prof_add_member_to_group':
+            group = int(head[2])
+            self.group_members[(head[0], group)].append(int(head[1]))
+            self._update_group(head[0], group)
+        elif cmd == 'act_prof_remove_member_from_group':
+            self._end_segment()
+            group = int(head[2])
+            self.group_members[(head[0], group)].remove(int(head[1]))
+            self._update_group(head[0], group)
+        elif cmd == 'act_prof_delete_member':
+            self._end_segment()
+            member = int(head[1])
+            self._release_handle(MEMBER, head[0], member)
+            entity = p4runtime_pb2.ActionProfileMember()
+            entity.action_profile_id = self.p4info.get_action_profiles_id(head[0])
+            entity.member_id = member
+            self._add(DELETE_MEMBER, (MEMBER, head[0], member),
+                      p4runtime_pb2.Update.DELETE, 'action_profile_member',
+                      entity)
+        elif cmd == 'act_prof_delete_group':
+            # The group goes with its members, so a pending membership update
+            # is dropped (and a pending insert makes the delete unnecessary)
+            self._end_segment()
+            group = int(head[1])
+            self._release_handle(GROUP, head[0], group)
+            del self.group_members[(head[0], group)]
+            pending = self.group_updates.pop((head[0], group), None)
+            if pending is not None:
+                self.updates = [u for u in self.updates if u[2] is not pending]
+            if pending is None or pending.type != p4runtime_pb2.Update.INSERT:
+                entity = p4runtime_pb2.ActionProfileGroup()
+                entity.action_profile_id = self.p4info.get_action_profiles_id(head[0])
+                entity.group_id = group
+                self._add(DELETE_GROUP, (GROUP, head[0], group),
+                          p4runtime_pb2.Update.DELETE, 'action_profile_group',
+                          entity)
+        else:
+            raise Exception('Command {} is not supported by the P4Runtime driver.'.format(cmd))
@@ -7,10 +7,13 @@ import time
 import networkx as nx
 
 import felix_switch
+import journal
 
 
 def main(p4prog, topology_json):
     print('Ralph starting up.')
+    # Failure times, for the loss timeline of analyze_logs.py
+    journal.open_journal('logs/ralph_events.jsonl')
     
     with open(topology_json) as f:
         net = json.load(f)
@@ -85,6 +88,7 @@ def main(p4prog, topology_json):
                         found = True
                 elmnt = uname
 
+        journal.record('failure', type=ftype, element=elmnt)
         if ftype == 'link':
             # Link failure
             uname, vname = elmnt
@@ -1,34 +1,243 @@
 """Felix Run Experiments.
 
 Usage:
-    run_experiments.py <recipe> <experiment_dir>
+    run_experiments.py <recipe> <experiment_dir> [--resume=<results_dir>] [--jobs=<n>] [--netns]
+
+Options:
+    --resume=<results_dir>  Run only what the manifest of an earlier sweep of
+                            the same blueprint does not list as done.
+    --jobs=<n>              Runs at a time, each in a network namespace of its
+                            own (requires --netns) [default: 1].
+    --netns                 Run each experiment in a network namespace and
+                            with a /tmp of its own (requires root).
 """
+import copy
 import json
 import os
+import shutil
+import signal
+import subprocess
+import sys
+import threading
 import time
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from distutils.dir_util import copy_tree
 
 from docopt import docopt
 
 
-def main(recipe, exp_dir):
-    # Output dir
-    cdt = datetime.utcnow().strftime('D%Y-%m-%dT%H-%M-%S')
-    output_dir = '../results/{}'.format(cdt)
-    os.makedirs(output_dir + '/metadata')
-    
+# Files of bmv2/felix that are not linked into the workspaces
+WORKSPACE_SKIP = ('build', 'config', 'logs', 'pcaps', '__pycache__', 'scenario.json')
+# Processes of a run that may outlive Mininet, such as receivers waiting for
+# their timeout
+EXPERIMENT_PROCESSES = ('simple_switch', 'traffic_receiver.py', 'tcpreplay',
+                        'felix_routing.py', 'classic_routing.py', 'ralph.py')
+CORES_PER_SWITCH = 1  # cores a concurrent run needs per BMv2 switch
+IDLE_TIMEOUT = 120  # seconds a finished run has to release its workspace
+POLL_INTERVAL = 0.5  # seconds
+
+
+class Manifest:
+    # Runs that are done (or failed), written after every change so that the
+    # file always describes a consistent sweep
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.runs = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.runs = json.load(f)['runs']
+
+    def done(self, run_id):
+        return run_id in self.runs and self.runs[run_id]['status'] == 'done'
+
+    def update(self, run_id, **fields):
+        with self.lock:
+            self.runs[run_id] = fields
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump({'runs': self.runs}, f, indent=4)
+            os.replace(self.path + '.tmp', self.path)
+
+
+def make_workspace(work_dir):
+    # A copy of bmv2/felix made of symbolic links, next to links to bmv2/utils
+    # and bmv2/resources, so the relative paths of the scripts still hold while
+    # config/, build/, logs/ and pcaps/ are private to the run
+    felix_dir = os.getcwd()
+    bmv2_dir = os.path.dirname(felix_dir)
+    if os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+    os.makedirs(work_dir + '/felix')
+    os.makedirs(work_dir + '/tmp')
+    for name in ('utils', 'resources'):
+        os.symlink(os.path.join(bmv2_dir, name), os.path.join(work_dir, name))
+    for name in os.listdir(felix_dir):
+        if name in WORKSPACE_SKIP or name.endswith('.pcap'):
+            continue
+        os.symlink(os.path.join(felix_dir, name), os.path.join(work_dir, 'felix', name))
+    return work_dir + '/felix'
+
+
+def workspace_processes(work_dir, any_experiment):
+    # PIDs of the processes that run in or refer to the workspace; with
+    # any_experiment, also every process of an experiment, whatever its
+    # workspace (/proc/<pid>/cwd is only readable for our own processes
+    # unless we run as root)
+    pids = []
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        try:
+            with open('/proc/{}/cmdline'.format(pid), 'rb') as f:
+                cmdline = f.read().replace(b'\0', b' ').decode(errors='replace')
+            try:
+                cwd = os.readlink('/proc/{}/cwd'.format(pid))
+            except PermissionError:
+                cwd = ''
+        except (FileNotFoundError, ProcessLookupError):
+            continue  # already gone
+        if (cwd == work_dir or cwd.startswith(work_dir + '/') or work_dir in cmdline
+                or (any_experiment and any(p in cmdline for p in EXPERIMENT_PROCESSES))):
+            pids.append(int(pid))
+    return pids
+
+
+def wait_idle(work_dir, any_experiment, timeout=IDLE_TIMEOUT):
+    # Waits until no process uses the workspace any more, so that the logs are
+    # complete and the next run does not compete with this one; whatever is
+    # still running after the timeout is killed
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        pids = workspace_processes(work_dir, any_experiment)
+        if not pids:
+            return True
+        time.sleep(POLL_INTERVAL)
+    print('Killing processes left in {}: {}'.format(work_dir, pids), flush=True)
+    subprocess.call(['sudo', 'kill', '-9'] + [str(pid) for pid in pids])
+    return False
+
+
+def run_logged(cmd, cwd, log, echo):
+    # Runs cmd, appending its output to log (and printing it if echo)
+    proc = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, start_new_session=True)
+    for line in proc.stdout:
+        log.write(line)
+        log.flush()
+        if echo:
+            sys.stdout.buffer.write(line)
+            sys.stdout.flush()
+    return proc.wait()
+
+
+def netns_cmd(ns, tmp_dir, cmd):
+    # cmd run in network namespace ns, with tmp_dir mounted on /tmp (ip netns
+    # exec gives each command a mount namespace of its own)
+    return (['ip', 'netns', 'exec', ns, 'sh', '-c', 'mount --bind "$0" /tmp && exec "$@"', tmp_dir]
+            + cmd)
+
+
+def run_one(job, slot, ctx):
+    run_id, engine, fs_name, run, scenario = job
+    work_dir = os.path.join(ctx['output_dir'], 'work', run_id)
+    ws = make_workspace(work_dir)
+    os.makedirs(ws + '/logs')
+    with open(ws + '/scenario.json', 'w') as f:
+        json.dump(scenario, f, indent=4)
+    with open(work_dir + '/tmp/python3path', 'w') as f:
+        f.write(ctx['python3path'] + '\n')
+    echo = ctx['jobs'] == 1
+    ns = 'felix-{}'.format(slot) if ctx['netns'] else None
+
+    steps = [
+        [ctx['python3path'], 'configure.py', engine, 'scenario.json'],
+        ['make', 'all', 'P4PROG={}.p4'.format(engine)],
+    ]
+    if ns is None:
+        steps.insert(0, ['sudo', 'mn', '-c'])
+    else:
+        subprocess.call(['ip', 'netns', 'delete', ns], stderr=subprocess.DEVNULL)  # left by an interrupted sweep
+        subprocess.check_call(['ip', 'netns', 'add', ns])
+        subprocess.check_call(['ip', 'netns', 'exec', ns, 'ip', 'link', 'set', 'lo', 'up'])
+        steps = [netns_cmd(ns, work_dir + '/tmp', step) for step in steps]
+
+    print('Starting run {}'.format(run_id), flush=True)
+    started = datetime.utcnow()
+    exit_code = 0
+    with open(ws + '/exp_log.txt', 'wb') as log:
+        for step in steps:
+            exit_code = run_logged(step, ws, log, echo)
+            if exit_code != 0:
+                break
+    idle = wait_idle(work_dir, ns is None)
+    if ns is not None:
+        pids = subprocess.run(['ip', 'netns', 'pids', ns], stdout=subprocess.PIPE).stdout.split()
+        for pid in pids:
+            os.kill(int(pid), signal.SIGKILL)
+        subprocess.call(['ip', 'netns', 'delete', ns])
+    shutil.move(ws + '/exp_log.txt', ws + '/logs/exp_log.txt')
+
+    cmd = [ctx['python3path'], ctx['exp_dir'] + '/analyze_logs.py', 'scenario.json',
+           ctx['bwl_json'], './logs/']
+    with open(ws + '/logs/analysis_result.txt', 'wb') as log:
+        analysis_code = run_logged(cmd, ws, log, echo)
+
+    # Keep the logs and the run's configuration only
+    run_dir = os.path.join(ctx['output_dir'], run_id)
+    if os.path.exists(run_dir):
+        shutil.rmtree(run_dir)  # left by an interrupted sweep
+    os.makedirs(run_dir)
+    for name in ('logs', 'config', 'scenario.json'):
+        if os.path.exists(os.path.join(ws, name)):
+            shutil.move(os.path.join(ws, name), os.path.join(run_dir, name))
+    if os.path.isdir(ws + '/pcaps') and os.listdir(ws + '/pcaps'):
+        shutil.move(ws + '/pcaps', run_dir + '/pcaps')
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    status = 'done' if exit_code == 0 and analysis_code == 0 else 'failed'
+    ctx['manifest'].update(run_id, status=status, engine=engine,
+                           failure_scenario=fs_name, run=run,
+                           started=started.strftime('%Y-%m-%dT%H:%M:%S'),
+                           seconds=round((datetime.utcnow() - started).total_seconds(), 1),
+                           exit_code=exit_code, analysis_exit_code=analysis_code,
+                           released=idle)
+    print('#'*80)
+    print('End of Run: ({}), {}'.format(run_id, status))
+    print('#'*80, flush=True)
+    return status
+
+
+def main(recipe, exp_dir, resume=None, jobs=1, netns=False):
+    if jobs > 1 and not netns:
+        raise Exception('Running more than one experiment at a time requires --netns.')
+    if netns and os.geteuid() != 0:
+        raise Exception('--netns requires running run_experiments.py as root.')
+
     # Benchmark
     with open(recipe) as f:
         bm = json.load(f)
-    with open(output_dir + '/metadata/benchmark.json', 'w') as f:
-        json.dump(bm, f)
+
+    # Output dir
+    if resume is None:
+        cdt = datetime.utcnow().strftime('D%Y-%m-%dT%H-%M-%S')
+        output_dir = os.path.abspath('../results/{}'.format(cdt))
+        os.makedirs(output_dir + '/metadata')
+        with open(output_dir + '/metadata/benchmark.json', 'w') as f:
+            json.dump(bm, f)
+    else:
+        output_dir = os.path.abspath(resume)
+        with open(output_dir + '/metadata/benchmark.json') as f:
+            if json.load(f) != bm:
+                raise Exception('{} does not match the blueprint of {}.'.format(recipe, resume))
+
+    if netns and (output_dir + '/').startswith('/tmp/'):
+        raise Exception('Runs with --netns get a /tmp of their own, {} cannot be under /tmp.'.format(output_dir))
 
     engines = bm['engines']
     f_scenarios = bm['failure_scenarios']
     runs_pfs = bm['runs_per_failure_scenario']
-    
+
     # Experiment Mainfile
     with open(exp_dir + '/main.json') as f:
         exp = json.load(f)
@@ -41,45 +250,62 @@ def main(recipe, exp_dir):
     with open(output_dir + '/metadata/build_workload_log.json', 'w') as f:
         json.dump(bwl, f)
 
+    manifest = Manifest(output_dir + '/metadata/manifest.json')
+    all_jobs = []
     for fs_name, fs in f_scenarios.items():
-        print('Failure Scenario:', fs_name)
-        exp['network']['failures'] = fs
-
-        with open('scenario.json', 'w') as f:
-            json.dump(exp, f, indent=4)
-
+        scenario = copy.deepcopy(exp)
+        scenario['network']['failures'] = fs
         for run in range(runs_pfs):
-            print('Run:', run)
             for engine in engines:
-                print('Engine:', engine)
-                
-                cmd = 'bash run_experiment.sh {} scenario.json | tee /tmp/exp_log.txt'.format(engine)
-                # cmd = 'bash run_experiment.sh {} scenario.json'.format(engine)
-                os.system(cmd)
-                os.system('cp /tmp/exp_log.txt ./logs/exp_log.txt')
-
-                cmd = 'python3 {exp_dir}/analyze_logs.py scenario.json {bwl_dir}/build_workload_log.json ./logs/ | tee ./logs/analysis_result.txt'
-                cmd = cmd.format(exp_dir=exp_dir, bwl_dir=bwl_dir)
-                os.system(cmd)
+                run_id = 'E{}-F{}-R{:02d}'.format(engine, fs_name, run)
+                if not manifest.done(run_id):
+                    all_jobs.append((run_id, engine, fs_name, run, scenario))
+    print('{} runs to go, {} done'.format(
+        len(all_jobs), len(f_scenarios)*runs_pfs*len(engines) - len(all_jobs)))
 
-                time.sleep(2)
+    # Concurrent runs share the machine's cores
+    if jobs > 1:
+        n_cores = os.cpu_count() or 1
+        per_job = exp['network']['n_switches']*CORES_PER_SWITCH + 1
+        if jobs*per_job > n_cores:
+            jobs = max(1, n_cores//per_job)
+            print('Running {} experiments at a time ({} cores, {} per experiment)'.format(
+                jobs, n_cores, per_job))
 
-                run_dir = output_dir + '/E{}-F{}-R{:02d}'.format(engine, fs_name, run)
-                os.makedirs(run_dir)
+    python3path = shutil.which('python3')
+    if not netns:
+        with open('/tmp/python3path', 'w') as f:
+            f.write(python3path + '\n')
+    ctx = {
+        'output_dir': output_dir,
+        'exp_dir': os.path.abspath(exp_dir),
+        'bwl_json': os.path.abspath(bwl_dir + 'build_workload_log.json'),
+        'python3path': python3path,
+        'manifest': manifest,
+        'jobs': jobs,
+        'netns': netns,
+    }
 
-                cmd = 'cat logs/{}_routing.txt'.format(engine)
-                os.system(cmd)
-                print('\n')
+    # Each run takes a free slot, which names its network namespace
+    slots = list(range(jobs))
+    slots_lock = threading.Lock()
 
-                copy_tree('.', run_dir)
+    def worker(job):
+        with slots_lock:
+            slot = slots.pop()
+        try:
+            return run_one(job, slot, ctx)
+        finally:
+            with slots_lock:
+                slots.append(slot)
 
-                print('#'*80)
-                print('End of Run: (E{}-F{}-R{:02d})'.format(engine, fs_name, run))
-                print('#'*80)
-                print('Taking a nap for 20 seconds.')
-                time.sleep(20)
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        statuses = list(pool.map(worker, all_jobs))
+    shutil.rmtree(output_dir + '/work', ignore_errors=True)
+    print('{} runs done, {} failed'.format(statuses.count('done'), statuses.count('failed')))
 
 
 if __name__ == '__main__':
     args = docopt(__doc__)
-    main(args['<recipe>'], args['<experiment_dir>'])
\ No newline at end of file
+    main(args['<recipe>'], args['<experiment_dir>'], args['--resume'],
+         int(args['--jobs']), args['--netns'])
@@ -0,0 +1,144 @@
+# Members and groups of one action selector, shared through reference counts.
+#
+# Members are keyed by their action and parameters, groups by the sorted
+# handles of their members, so entries with the same next hops share a group
+# whatever their state or destination. Groups no entry refers to are kept for
+# reuse and only deleted (along with members left unused) in batches, once
+# enough of them pile up or the selector runs out of room.
+#
+# bmv2 hands out the lowest free member and group handles, which is mirrored
+# here so that handles can be tracked locally.
+import heapq
+
+
+class SelectorPool:
+    def __init__(self, switch, act_prof, size, gc_batch=32):
+        self.switch = switch
+        self.act_prof = act_prof
+        self.size = size  # number of members the selector can hold
+        self.gc_batch = gc_batch
+        self.members = {}  # members[action] = {'handle', 'refs'}
+        self.member_actions = {}  # member_actions[handle] = action
+        self.groups = {}  # groups[member handles] = {'handle', 'refs'}
+        self.group_keys = {}  # group_keys[handle] = member handles
+        self.unreferenced = set()  # handles of groups with no references
+        self.free = {'members': [], 'groups': []}  # heaps of released handles
+        self.next_handle = {'members': 0, 'groups': 0}
+        self.stats = {'created_members': 0, 'created_groups': 0,
+                      'deleted_members': 0, 'deleted_groups': 0,
+                      'reused_groups': 0, 'collections': 0}
+
+    def _new_handle(self, kind):
+        if self.free[kind]:
+            return heapq.heappop(self.free[kind])
+        handle = self.next_handle[kind]
+        self.next_handle[kind] = handle + 1
+        return handle
+
+    def _make_room(self, actions):
+        missing = set(action for action in actions if action not in self.members)
+        if len(self.members) + len(missing) > self.size:
+            self.collect()
+
+    def _member(self, action):
+        if action not in self.members:
+            if len(self.members) == self.size:
+                self.switch.session.write_log('# Warning: {} is over its size of {} members\n'.format(
+                    self.act_prof, self.size))
+            create_member = 'act_prof_create_member {} {}'
+            self.switch._cmd(create_member.format(self.act_prof, action))
+            handle = self._new_handle('members')
+            self.members[action] = {'handle': handle, 'refs': 0}
+            self.member_actions[handle] = action
+            self.stats['created_members'] += 1
+        return self.members[action]
+
+    def get_member(self, action):
+        # Member handle for an entry that refers to it directly
+        self._make_room([action])
+        member = self._member(action)
+        member['refs'] += 1
+        return member['handle']
+
+    def get_group(self, actions):
+        # Group handle, with one member per action, for an entry that refers
+        # to it. Reuses an existing group with the same members if any.
+        self.switch.begin_batch()
+        self._make_room(actions)
+        members = [self._member(action) for action in actions]
+        key = tuple(sorted(set(member['handle'] for member in members)))
+        if key in self.groups:
+            group = self.groups[key]
+            if group['refs'] == 0:
+                self.unreferenced.discard(group['handle'])
+                self.stats['reused_groups'] += 1
+        else:
+            create_group = 'act_prof_create_group {}'
+            self.switch._cmd(create_group.format(self.act_prof))
+            group = {'handle': self._new_handle('groups'), 'refs': 0}
+            self.groups[key] = group
+            self.group_keys[group['handle']] = key
+            add_m2g = 'act_prof_add_member_to_group {} {} {}'
+            for member_handle in key:
+                self.switch._cmd(add_m2g.format(self.act_prof, member_handle,
+                                                group['handle']))
+                self.members[self.member_actions[member_handle]]['refs'] += 1
+            self.stats['created_groups'] += 1
+        group['refs'] += 1
+        self.switch.end_batch()
+        return group['handle']
+
+    def put_group(self, handle):
+        # Drops a reference taken by get_group. Call collect_if_needed once the
+        # entries referring to the group are gone.
+        group = self.groups[self.group_keys[handle]]
+        group['refs'] -= 1
+        if group['refs'] == 0:
+            self.unreferenced.add(handle)
+
+    def collect_if_needed(self):
+        if len(self.unreferenced) >= self.gc_batch:
+            return self.collect()
+        return 0
+
+    def collect(self):
+        # Deletes unreferenced groups and then unused members, in one batch
+        if not self.unreferenced:
+            return 0
+        self.switch.begin_batch()
+        n_groups = len(self.unreferenced)
+        remove_m2g = 'act_prof_remove_member_from_group {} {} {}'
+        delete_group = 'act_prof_delete_group {} {}'
+        for handle in sorted(self.unreferenced):
+            key = self.group_keys.pop(handle)
+            del self.groups[key]
+            for member_handle in key:
+                self.switch._cmd(remove_m2g.format(self.act_prof,
+                                                   member_handle, handle))
+                self.members[self.member_actions[member_handle]]['refs'] -= 1
+            self.switch._cmd(delete_group.format(self.act_prof, handle))
+            heapq.heappush(self.free['groups'], handle)
+        self.unreferenced = set()
+        delete_member = 'act_prof_delete_member {} {}'
+        for action, member in list(self.members.items()):
+            if member['refs'] == 0:
+                self.switch._cmd(delete_member.format(self.act_prof,
+                                                      member['handle']))
+                heapq.heappush(self.free['members'], member['handle'])
+                del self.member_actions[member['handle']]
+                del self.members[action]
+                self.stats['deleted_members'] += 1
+        self.stats['deleted_groups'] += n_groups
+        self.stats['collections'] += 1
+        self.switch.end_batch()
+        self.switch.session.write_log('# {}\n'.format(self.report()))
+        return n_groups
+
+    def occupancy(self):
+        return {'members': len(self.members), 'size': self.size,
+                'groups': len(self.groups),
+                'unreferenced_groups': len(self.unreferenced)}
+
+    def report(self):
+        return '{}: {members}/{size} members, {groups} groups ({unreferenced_groups} unreferenced)'.format(
+            self.act_prof, **self.occupancy())
@@ -0,0 +1,22 @@
+# Shutdown signalling for the routing scripts
+#
+# felix_experiment.run stops a routing script by sending it SIGTERM (relayed by
+# sudo). The handler sets exit_event, which the entry installers check in
+# memory, and wakes the announcement loop right away by putting EXIT in its
+# queue.
+import signal
+import threading
+
+
+EXIT = object()  # put in the announcement queue on shutdown
+exit_event = threading.Event()
+
+
+def listen(ann_queue, signals=(signal.SIGTERM, signal.SIGINT)):
+    # ann_queue must be a queue.SimpleQueue, whose put is safe to call from a
+    # signal handler
+    def handler(signum, frame):
+        exit_event.set()
+        ann_queue.put(EXIT)
+    for signum in signals:
+        signal.signal(signum, handler)
@@ -0,0 +1,182 @@
+# Simulation of the packets lost while alternative entries are installed.
+#
+# For every state one link failure away from the base state (the states the
+# routing script installs alternatives for at the entry installation rate),
+# plans and collects the alternative entries as felix_routing.py does and
+# installs them, one per ei_delay after the propagation delay of each switch,
+# in FIFO and in impact order (install_order "impact"). A second link then
+# fails at a random time while they are installed. Until the state transitions
+# at both ends of the link and its own alternative entry are in place, the
+# traffic a switch reroutes towards a destination in the new state is counted
+# as lost. Second failures are weighted by the odds of their links and the
+# failure time is uniform over the installation of the whole update.
+import json
+import sys
+
+import networkx as nx
+
+import felix_routing
+import spdag
+
+
+HDR_AND_MSG_LEN = 1514  # bytes per packet, as generated by build_workload.py
+
+
+def load_network(netinfo):
+    switches = netinfo['switches']
+    slowdown = netinfo['slowdown']
+    delay_to_dp = {}
+    base_net = nx.Graph()
+    for sname in switches.keys():
+        if sname != 's0':
+            base_net.add_node(sname)
+    for link in netinfo['links']:
+        if link[0][:2] == 's0':
+            delay_to_dp[link[1].split('-')[0]] = int(link[2][:-2])*slowdown/1e6
+        elif link[0][0] != 'h' and link[1][0] != 'h':
+            u = link[0].split('-')[0]
+            v = link[1].split('-')[0]
+            base_net.add_edge(u, v, weight=int(link[2][:-2]))
+    graph = spdag.CSRGraph.from_networkx(
+        base_net, nodes=[sname for sname in switches.keys() if sname != 's0'],
+        weight='weight')
+    return graph, delay_to_dp
+
+
+def plan_changes(graph, switches, sttman, fwd, impact, link_odds, base_net_state,
+                 cur_net_state):
+    # Alternatives of cur_net_state, as planned and collected by the routing
+    # script. Returns the changes and the link failure state of every up link.
+    changes = {}
+    link_states = {}
+    cur_set = sttman.get_state(cur_net_state)
+    node_links = {node: [felix_routing.order_link((node, peer))
+                         for peer in graph.neighbors(node)]
+                  for node in graph.nodes}
+    for lid in fwd[cur_net_state].up_link_ids():
+        uname, vname = felix_routing.order_link(graph.links[lid])
+        new_set = cur_set.add_link(lid)
+        new_net_state = new_set.net_state
+        u_lat_net_state = new_set.add_node(vname).net_state
+        v_lat_net_state = new_set.add_node(uname).net_state
+        link_states[lid] = new_net_state
+        for net_state, links in [
+                (new_net_state, [(uname, vname)]),
+                (u_lat_net_state, [(uname, vname)] + node_links[vname]),
+                (v_lat_net_state, [(uname, vname)] + node_links[uname])]:
+            impact.odds[net_state] = max(impact.odds.get(net_state, 0),
+                                         link_odds[lid])
+            if net_state not in fwd:
+                fwd[net_state] = fwd[cur_net_state].derive(links)
+                felix_routing.add_alt_fwding_changes(changes, switches, fwd,
+                                                     base_net_state, net_state)
+        felix_routing.add_changes(changes, uname)
+        changes[uname]['stt'].append([cur_net_state, switches[vname],
+                                      new_net_state, u_lat_net_state])
+        felix_routing.add_changes(changes, vname)
+        changes[vname]['stt'].append([cur_net_state, switches[uname],
+                                      new_net_state, v_lat_net_state])
+    return changes, link_states
+
+
+def install_times(changes, delay_to_dp, ei_delay, priorities):
+    # times[(kind, switch, state, peer or dst)] = time the entry is installed
+    times = {}
+    for cur_hop, entries in changes.items():
+        entries = [('fwd', entry) for entry in entries['fwd']] + \
+            [('stt', entry) for entry in entries['stt']]
+        if priorities is not None:
+            priority = priorities(cur_hop)
+            entries.sort(key=lambda x: -priority(*x))
+        for i, (kind, entry) in enumerate(entries):
+            net_state = entry[0] if kind == 'fwd' else entry[2]
+            t = delay_to_dp[cur_hop] + (i + 1)*ei_delay
+            times[(kind, cur_hop, net_state, entry[1]['name'])] = t
+    return times
+
+
+def expected_loss(graph, fwd, impact, link_odds, cur_net_state, link_states,
+                  times):
+    # Expected Mbit lost (traffic in Mbps times seconds unprotected)
+    window = max(times.values())
+    total_odds = sum(link_odds[lid] for lid in link_states)
+    loss = 0.0
+    for lid, net_state in link_states.items():
+        uname, vname = graph.links[lid]
+        t_stt = max(times[('stt', uname, net_state, vname)],
+                    times[('stt', vname, net_state, uname)])
+        node_load = impact.state_loads(fwd, net_state)[0]
+        state_loss = 0.0
+        for dst, cur in zip(*fwd[net_state].changed(fwd[cur_net_state])):
+            key = ('fwd', graph.nodes[cur], net_state, graph.nodes[dst])
+            if key not in times:
+                continue  # same entry as in the base state
+            t = max(times[key], t_stt)
+            # Failure at a uniform time in [0, window]: E[max(0, t - t_f)]
+            state_loss += node_load[dst, cur]*t*t/(2*window)
+        loss += state_loss*link_odds[lid]/total_odds
+    return loss
+
+
+def main(topology_json):
+    with open(topology_json) as f:
+        netinfo = json.load(f)
+    switches = netinfo['switches']
+    slowdown = netinfo['slowdown']
+    ei_delay = (1.0/netinfo['entry_installation_rate'])*slowdown
+    demands = netinfo['demands'] if 'demands' in netinfo else {}
+    if not demands:
+        print('No demands in {}, nothing to order.'.format(topology_json))
+        sys.exit(1)
+    graph, delay_to_dp = load_network(netinfo)
+    link_probs = netinfo['link_failure_probs'] if 'link_failure_probs' in netinfo else {}
+    link_odds = []
+    for link in graph.links:
+        p = link_probs.get('{}-{}'.format(*felix_routing.order_link(link)), 0.01)
+        link_odds.append(p/(1 - p))
+    pkts_per_mbit = 1e6/(8*HDR_AND_MSG_LEN)
+
+    BASE_STATE = 0
+    sttman = felix_routing.StateManager(graph)
+    base = spdag.ForwardingState.compute(graph)
+    totals = {'fifo': 0.0, 'impact': 0.0}
+    print('{:>12} {:>8} {:>14} {:>14} {:>8}'.format(
+        'first', 'entries', 'fifo (pkts)', 'impact (pkts)', 'saved'))
+    for lid in range(graph.n_links):
+        cur_net_state = sttman.get_state(BASE_STATE).add_link(lid).net_state
+        fwd = {BASE_STATE: base}
+        fwd[cur_net_state] = base.derive([graph.links[lid]])
+        impact = felix_routing.EntryImpact(graph, demands)
+        changes, link_states = plan_changes(graph, switches, sttman, fwd,
+                                            impact, link_odds, BASE_STATE,
+                                            cur_net_state)
+        if not link_states:
+            continue
+        loss = {}
+        for order, priorities in [
+                ('fifo', None),
+                ('impact', lambda cur_hop: impact.priority(fwd, cur_hop))]:
+            times = install_times(changes, delay_to_dp, ei_delay, priorities)
+            loss[order] = expected_loss(graph, fwd, impact, link_odds,
+                                        cur_net_state, link_states,
+                                        times)*pkts_per_mbit
+            totals[order] += loss[order]
+        n_entries = sum(len(entries['fwd']) + len(entries['stt'])
+                        for entries in changes.values())
+        print('{:>12} {:8d} {:14.1f} {:14.1f} {:8.1f}'.format(
+            '-'.join(felix_routing.order_link(graph.links[lid])), n_entries,
+            loss['fifo'], loss['impact'], loss['fifo'] - loss['impact']))
+    saved = totals['fifo'] - totals['impact']
+    print('Total expected packets lost: {:.1f} in FIFO order, {:.1f} in impact order'.format(
+        totals['fifo'], totals['impact']))
+    print('Impact order saves {:.1f} packets ({:.1f}%)'.format(
+        saved, 100*saved/totals['fifo'] if totals['fifo'] else 0))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(sys.argv[1])
+    else:
+        print('Usage: python3 simulate_install_order.py <topology_json>')
+        print('Using default file... config/topology.json')
+        main('config/topology.json')
@@ -0,0 +1,318 @@
+# Shortest-path DAG (SPDAG) computation and incremental repair
+#
+# Shared by the live controllers (felix_routing.py and classic_routing.py) and
+# the routing evaluation notebook (notebook/routing.py). The base graph is stored once in
+# CSR form. A forwarding state holds, for every destination, a next-hop
+# bitmask and a distance per node, plus the set of failed links as a mask over
+# the links of the base graph.
+import math
+
+from heapq import heappush, heappop
+
+import numpy as np
+
+
+MAX_DEGREE = 64  # next hops are a bitmask over the adjacency of a node
+
+
+class CSRGraph:
+    def __init__(self, nodes, links, weights):
+        self.nodes = list(nodes)
+        self.index = {node: i for i, node in enumerate(self.nodes)}
+        self.links = [tuple(link) for link in links]
+        self.link_index = {}
+        # Group adjacency slots (two per link) by node
+        adj = [[] for _ in self.nodes]
+        for lid, (u, v) in enumerate(self.links):
+            ui = self.index[u]
+            vi = self.index[v]
+            adj[ui].append((vi, lid, weights[lid]))
+            adj[vi].append((ui, lid, weights[lid]))
+            self.link_index[(u, v)] = lid
+            self.link_index[(v, u)] = lid
+        indptr = [0]
+        indices = []
+        slot_weights = []
+        link_ids = []
+        slot_nodes = []
+        for u, peers in enumerate(adj):
+            if len(peers) > MAX_DEGREE:
+                raise Exception('Node {} has more than {} links.'.format(
+                    self.nodes[u], MAX_DEGREE))
+            for v, lid, w in peers:
+                indices.append(v)
+                slot_weights.append(w)
+                link_ids.append(lid)
+                slot_nodes.append(u)
+            indptr.append(len(indices))
+        # Map every slot (u -> v) to its opposite slot (v -> u)
+        slots = {}
+        for j, (u, v) in enumerate(zip(slot_nodes, indices)):
+            slots[(u, v)] = j
+        reverse = [slots[(v, u)] for u, v in zip(slot_nodes, indices)]
+        link_slots = [[] for _ in self.links]
+        for j, lid in enumerate(link_ids):
+            link_slots[lid].append(j)
+        #
+        self.indptr = np.array(indptr, dtype=np.int32)
+        self.indices = np.array(indices, dtype=np.int32)
+        self.weights = np.array(slot_weights, dtype=np.float64)
+        self.link_ids = np.array(link_ids, dtype=np.int32)
+        self.reverse = np.array(reverse, dtype=np.int32)
+        # Plain list copies for the traversals below (faster element access)
+        self._indptr = indptr
+        self._indices = indices
+        self._weights = slot_weights
+        self._link_ids = link_ids
+        self._reverse = reverse
+        self._slot_nodes = slot_nodes
+        self._link_slots = link_slots
+
+    @classmethod
+    def from_networkx(cls, graph, nodes=None, weight='weight'):
+        if nodes is None:
+            nodes = graph.nodes
+        links = list(graph.edges())
+        weights = [graph.edges[u, v][weight] for u, v in links]
+        return cls(nodes, links, weights)
+
+    @property
+    def n_nodes(self):
+        return len(self.nodes)
+
+    @property
+    def n_links(self):
+        return len(self.links)
+
+    def link_mask(self, links):
+        mask = np.zeros(self.n_links, dtype=np.bool_)
+        for link in links:
+            mask[self.link_index[link]] = True
+        return mask
+
+    def neighbors(self, node):
+        u = self.index[node]
+        return [self.nodes[v] for v in self._indices[self._indptr[u]:self._indptr[u + 1]]]
+
+    def next_hops(self, cur, bits):
+        # Decode a next-hop bitmask of node index cur into sorted node names
+        next_hops = []
+        j = self._indptr[cur]
+        while bits:
+            if bits & 1:
+                next_hops.append(self.nodes[self._indices[j]])
+            bits = bits >> 1
+            j = j + 1
+        return sorted(next_hops)
+
+
+class ForwardingState:
+    def __init__(self, graph, failed, nexthops, dist, n_computed=0):
+        self.graph = graph
+        self.failed = failed  # failed[link] = link is down (over base graph links)
+        self.nexthops = nexthops  # nexthops[dst][cur] = bitmask of next hops towards dst
+        self.dist = dist  # dist[dst][cur] = distance from cur to dst
+        self.n_computed = n_computed  # destinations computed or repaired to get here
+
+    @classmethod
+    def compute(cls, graph, n_dst=None, failed=None):
+        # Destinations are the first n_dst nodes of the graph
+        if n_dst is None:
+            n_dst = graph.n_nodes
+        if failed is None:
+            failed = np.zeros(graph.n_links, dtype=np.bool_)
+        nexthops = np.zeros((n_dst, graph.n_nodes), dtype=np.uint64)
+        dist = np.full((n_dst, graph.n_nodes), math.inf)
+        failed_list = failed.tolist()
+        for dst in range(n_dst):
+            dijkstra(graph, dst, failed_list, nexthops[dst], dist[dst])
+        return cls(graph, failed, nexthops, dist, n_dst)
+
+    @property
+    def n_dst(self):
+        return self.nexthops.shape[0]
+
+    def derive(self, links):
+        # Fail links on top of this state and repair only the shortest paths
+        # that traversed them
+        graph = self.graph
+        lids = []
+        for link in links:
+            lid = graph.link_index[link]
+            if not self.failed[lid]:
+                lids.append(lid)
+        failed = self.failed.copy()
+        failed[lids] = True
+        nexthops = self.nexthops.copy()
+        dist = self.dist.copy()
+        n_computed = 0
+        if lids:
+            failed_list = failed.tolist()
+            for dst in range(self.n_dst):
+                if repair(graph, nexthops[dst], dist[dst], failed_list, lids):
+                    n_computed = n_computed + 1
+        return ForwardingState(graph, failed, nexthops, dist, n_computed)
+
+    def up_link_ids(self):
+        return np.flatnonzero(~self.failed).tolist()
+
+    def up_links(self):
+        return [self.graph.links[lid] for lid in self.up_link_ids()]
+
+    def changed(self, base):
+        # (dst, cur) pairs with next hops that are not empty and differ from base
+        return np.nonzero((self.nexthops != base.nexthops) & (self.nexthops != 0))
+
+    def next_hops(self, dst, cur):
+        return self.graph.next_hops(cur, int(self.nexthops[dst, cur]))
+
+    def loads(self, demand):
+        # Traffic of demand[src][dst] (over node indices) split evenly over the
+        # next hops at every node. Returns node_load[dst][cur], the traffic
+        # towards dst through cur, and link_load[link], the traffic over each
+        # link. Traffic of nodes with no path to dst is dropped there.
+        graph = self.graph
+        indptr = graph._indptr
+        indices = graph._indices
+        link_ids = graph._link_ids
+        node_load = np.zeros(self.nexthops.shape)
+        link_load = np.zeros(graph.n_links)
+        for dst in range(self.n_dst):
+            load = demand[:, dst].tolist()
+            nexthops = self.nexthops[dst].tolist()
+            # Farthest first, so a node has all its traffic before splitting it
+            for cur in np.argsort(-self.dist[dst], kind='stable').tolist():
+                bits = nexthops[cur]
+                if not bits or not load[cur]:
+                    continue
+                share = load[cur]/bin(bits).count('1')
+                j = indptr[cur]
+                while bits:
+                    if bits & 1:
+                        load[indices[j]] += share
+                        link_load[link_ids[j]] += share
+                    bits = bits >> 1
+                    j = j + 1
+            node_load[dst] = load
+        return node_load, link_load
+
+
+def dijkstra(graph, dst, failed, nexthops, dist):
+    # Full SPDAG towards dst, written into the nexthops and dist rows
+    indptr = graph._indptr
+    indices = graph._indices
+    weights = graph._weights
+    link_ids = graph._link_ids
+    reverse = graph._reverse
+    nh = [0]*graph.n_nodes
+    d = [math.inf]*graph.n_nodes
+    visited = [False]*graph.n_nodes
+    d[dst] = 0
+    queue = [(0, dst)]
+    while queue:
+        _, u = heappop(queue)
+        if visited[u]:
+            continue
+        visited[u] = True
+        for j in range(indptr[u], indptr[u + 1]):
+            if failed[link_ids[j]]:
+                continue
+            v = indices[j]
+            dist_via_u = d[u] + weights[j]
+            distdiff = dist_via_u - d[v]
+            if distdiff < 0:
+                d[v] = dist_via_u
+                nh[v] = 1 << (reverse[j] - indptr[v])
+                heappush(queue, (dist_via_u, v))
+            elif distdiff == 0:
+                nh[v] = nh[v] | (1 << (reverse[j] - indptr[v]))
+    nexthops[:] = nh
+    dist[:] = d
+
+
+def affected(graph, nexthops, links):
+    # Find the nodes whose shortest paths traverse at least one of the links
+    # with a reverse BFS over the SPDAG (nexthops of a single destination)
+    indptr = graph._indptr
+    indices = graph._indices
+    reverse = graph._reverse
+    marked = set()
+    queue = []
+    for lid in links:
+        for j in graph._link_slots[lid]:
+            # link is in the SPDAG in the direction u -> v
+            u = graph._slot_nodes[j]
+            if u not in marked and (int(nexthops[u]) >> (j - indptr[u])) & 1:
+                marked.add(u)
+                queue.append(u)
+    for u in queue:
+        for j in range(indptr[u], indptr[u + 1]):
+            w = indices[j]
+            if w in marked:
+                continue
+            # w uses u as one of its next hops
+            if (int(nexthops[w]) >> (reverse[j] - indptr[w])) & 1:
+                marked.add(w)
+                queue.append(w)
+    return queue
+
+
+def repair(graph, nexthops, dist, failed, links):
+    # Update the nexthops and dist rows of a single destination after links
+    # (already set in failed) go down. Returns the affected nodes.
+    indptr = graph._indptr
+    indices = graph._indices
+    weights = graph._weights
+    link_ids = graph._link_ids
+    reverse = graph._reverse
+    recompute = affected(graph, nexthops, links)
+    if not recompute:
+        return recompute
+    pending = set(recompute)
+    nh = {}
+    d = {}
+
+    # Build initial priority queue from the best known available paths
+    queue = []
+    for u in recompute:
+        min_dist = math.inf
+        bits = 0
+        for j in range(indptr[u], indptr[u + 1]):
+            v = indices[j]
+            if v in pending or failed[link_ids[j]] or dist[v] == math.inf:
+                continue
+            dist_via_v = dist[v] + weights[j]
+            distdiff = dist_via_v - min_dist
+            if distdiff < 0:
+                min_dist = dist_via_v
+                bits = 1 << (j - indptr[u])
+            elif distdiff == 0:
+                bits = bits | (1 << (j - indptr[u]))
+        d[u] = min_dist
+        nh[u] = bits
+        if min_dist != math.inf:
+            heappush(queue, (min_dist, u))
+
+    # Partial Dijkstra over the affected nodes
+    while queue:
+        _, u = heappop(queue)
+        if u not in pending:
+            continue
+        pending.remove(u)
+        for j in range(indptr[u], indptr[u + 1]):
+            v = indices[j]
+            if v not in pending or failed[link_ids[j]]:
+                continue
+            dist_via_u = d[u] + weights[j]
+            distdiff = dist_via_u - d[v]
+            if distdiff < 0:
+                d[v] = dist_via_u
+                nh[v] = 1 << (reverse[j] - indptr[v])
+                heappush(queue, (dist_via_u, v))
+            elif distdiff == 0:
+                nh[v] = nh[v] | (1 << (reverse[j] - indptr[v]))
+
+    for u in recompute:
+        nexthops[u] = nh[u]
+        dist[u] = d[u]
+    return recompute
@@ -1,56 +1,179 @@
+import mmap
 import os
-import signal
+import select
 import socket
-import subprocess
+import struct
 import sys
-import time
 
-from scapy.layers.inet import IP, ICMP, UDP
-from scapy.all import Raw
-from scapy.sendrecv import AsyncSniffer
+import numpy as np
 
 
-output = 'src,tos,id,ttl,ns\n'
-def add_to_output(line):
-    global output
-    output = output + line
+# Binary receiver log: one fixed-width record per packet, in little-endian
+# order: kernel receive time (ns since the epoch), source address, payload
+# stamp (first 4 bytes of the UDP payload), and IP identification, TOS and TTL
+RECORD = struct.Struct('<QIIHBB')
+RECORD_DTYPE = np.dtype([('ts', '<u8'), ('src', '<u4'), ('ns', '<u4'),
+                         ('id', '<u2'), ('tos', 'u1'), ('ttl', 'u1')])
+RECORDS_PER_EXTENT = 1 << 20  # the log file grows this many records at a time
 
-def print_output():
-    global output
-    print(output)
-    output = ''
+# AF_PACKET receive ring (TPACKET_V3), see linux/if_packet.h
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_STATISTICS = 6
+PACKET_VERSION = 10
+TPACKET_V3 = 2
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+ETH_P_IP = 0x0800
+BLOCK_SIZE = 1 << 20
+BLOCK_NR = 16
+FRAME_SIZE = 2048
+BLOCK_TIMEOUT = 10  # ms before a partly filled block is handed over
+BLOCK_DESC = struct.Struct('=IIIII')  # version, offset_to_priv, block_status, num_pkts, offset_to_first_pkt
+TPACKET3_HDR = struct.Struct('=IIIIIIHH')  # next_offset, sec, nsec, snaplen, len, status, mac, net
+SLL_PKTTYPE = 48 + 10  # sockaddr_ll.sll_pkttype, after the aligned tpacket3_hdr
+IP_HDR = struct.Struct('!BBHHHBBHII')
+UDP_HDR_AND_STAMP = struct.Struct('!HHHHI')
 
 
-def main(dst_name, dst_ip, dst_port):
-    # print('# {} {} {}'.format(dst_name, dst_ip, dst_port))
-    sock = socket.socket(socket.AF_INET,  # Internet
-                         socket.SOCK_DGRAM)  # UDP
-    sock.bind((dst_ip, dst_port))
+class RecordLog:
+    # Records written into a memory-mapped file that grows by extents. Unused
+    # space is cut off on close; a log that was not closed ends in zeroed
+    # records, which load_records drops.
+    def __init__(self, path):
+        self.file = open(path, 'w+b')
+        self.n = 0
+        self.capacity = 0
+        self.map = None
+        self._grow()
+
+    def _grow(self):
+        if self.map is not None:
+            self.map.close()
+        self.capacity = self.capacity + RECORDS_PER_EXTENT
+        self.file.truncate(self.capacity*RECORD.size)
+        self.map = mmap.mmap(self.file.fileno(), self.capacity*RECORD.size)
+
+    def append(self, ts, src, stamp, ip_id, tos, ttl):
+        if self.n == self.capacity:
+            self._grow()
+        RECORD.pack_into(self.map, self.n*RECORD.size, ts, src, stamp, ip_id, tos, ttl)
+        self.n = self.n + 1
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        self.file.truncate(self.n*RECORD.size)
+        self.file.close()
+
+
+def load_records(path):
+    # Binary receiver log as a NumPy structured array (RECORD_DTYPE)
+    records = np.fromfile(path, dtype=RECORD_DTYPE)
+    return records[records['ts'] != 0]
+
+
+def ip_to_int(ip):
+    return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+
+def receive_binary(dst_name, dst_ip, dst_port, iface='eth0'):
+    # Reads every IPv4 packet once from a TPACKET_V3 ring shared with the
+    # kernel, one block of packets per wakeup, and logs the UDP datagrams to
+    # dst_ip:dst_port in logs/<dst_name>_receiver.bin
+    sock = socket.socket(socket.AF_PACKET, socket.SOCK_DGRAM, socket.htons(ETH_P_IP))
+    sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+    sock.setsockopt(SOL_PACKET, PACKET_RX_RING, struct.pack(
+        '=7I', BLOCK_SIZE, BLOCK_NR, FRAME_SIZE, BLOCK_SIZE*BLOCK_NR//FRAME_SIZE,
+        BLOCK_TIMEOUT, 0, 0))
+    ring = mmap.mmap(sock.fileno(), BLOCK_SIZE*BLOCK_NR)
+    sock.bind((iface, ETH_P_IP))
+    poller = select.poll()
+    poller.register(sock, select.POLLIN | select.POLLERR)
 
+    log = RecordLog('logs/{}_receiver.bin'.format(dst_name))
+    dst_addr = ip_to_int(dst_ip)
+    block = 0
+    try:
+        while True:
+            start = block*BLOCK_SIZE
+            _, _, status, n_pkts, offset = BLOCK_DESC.unpack_from(ring, start)
+            if not status & TP_STATUS_USER:
+                poller.poll(1000)
+                continue
+            pkt = start + offset
+            for _ in range(n_pkts):
+                next_offset, sec, nsec, snaplen, _, _, _, net = TPACKET3_HDR.unpack_from(ring, pkt)
+                if ring[pkt + SLL_PKTTYPE] == socket.PACKET_OUTGOING:
+                    pkt = pkt + next_offset
+                    continue
+                ip = pkt + net
+                ver_ihl, tos, _, ip_id, _, ttl, proto, _, src, dst = IP_HDR.unpack_from(ring, ip)
+                udp = ip + (ver_ihl & 0xf)*4
+                if dst == dst_addr and proto == 17 and udp + UDP_HDR_AND_STAMP.size <= ip + snaplen:
+                    _, dport, _, _, stamp = UDP_HDR_AND_STAMP.unpack_from(ring, udp)
+                    if dport == dst_port:
+                        log.append(sec*1000000000 + nsec, src, stamp, ip_id, tos, ttl)
+                pkt = pkt + next_offset
+            # Hand the block back to the kernel
+            struct.pack_into('=I', ring, start + 8, TP_STATUS_KERNEL)
+            block = (block + 1) % BLOCK_NR
+    except KeyboardInterrupt:
+        n_recvd, n_dropped, _ = struct.unpack(
+            '=III', sock.getsockopt(SOL_PACKET, PACKET_STATISTICS, 12))
+        log.close()
+        print('{} packets logged, {} packets received by the ring, {} dropped by it'.format(
+            log.n, n_recvd, n_dropped))
+
+
+def receive_csv(dst_name, dst_ip, dst_port):
+    # Dissects every packet with scapy and prints one CSV line per packet
+    from scapy.layers.inet import IP
+    from scapy.all import Raw
+    from scapy.sendrecv import AsyncSniffer
+
+    lines = ['src,tos,id,ttl,ns\n']
     t = AsyncSniffer(
         iface='eth0',
         # lfilter =lambda x: x.haslayer(UDP) and x[IP].dst == dst_ip,
         filter='ip dst host {}'.format(dst_ip),
         # stop_filter=lambda x: x.haslayer(ICMP),
-        prn=lambda x: add_to_output('{},{},{},{},{}\n'.format(x[IP].src, x[IP].tos,
-                                                          x[IP].id, x[IP].ttl, int.from_bytes(x[Raw].load[:4], 'big'))),
+        prn=lambda x: lines.append('{},{},{},{},{}\n'.format(x[IP].src, x[IP].tos,
+                                                         x[IP].id, x[IP].ttl, int.from_bytes(x[Raw].load[:4], 'big'))),
         store=False,
     )
     t.start()
 
     try:
         while True:
-            sock.recvfrom(1514)
+            t.join(1)
     except KeyboardInterrupt:
-        print_output()
         t.stop()
         t.join()
+        print(''.join(lines))
+
+
+def main(dst_name, dst_ip, dst_port, mode='csv'):
+    # print('# {} {} {}'.format(dst_name, dst_ip, dst_port))
+    # The UDP socket keeps the kernel from answering with ICMP port
+    # unreachable; packets are read from the interface, not from it
+    sock = socket.socket(socket.AF_INET,  # Internet
+                         socket.SOCK_DGRAM)  # UDP
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 0)
+    sock.bind((dst_ip, dst_port))
 
+    if mode == 'binary':
+        os.makedirs('logs', exist_ok=True)
+        receive_binary(dst_name, dst_ip, dst_port)
+    else:
+        receive_csv(dst_name, dst_ip, dst_port)
+    sock.close()
     return
 
 
 if __name__ == '__main__':
-    if len(sys.argv) != 4:
-        print('Usage: tcpreplay_receiver.py <dst_name> <dst_IP> <dst_port>')
+    if len(sys.argv) not in (4, 5) or (len(sys.argv) == 5 and sys.argv[4] not in ('csv', 'binary')):
+        print('Usage: traffic_receiver.py <dst_name> <dst_IP> <dst_port> [csv|binary]')
         exit(1)
-    main(sys.argv[1], sys.argv[2], int(sys.argv[3]))
\ No newline at end of file
+    main(sys.argv[1], sys.argv[2], int(sys.argv[3]),
+         sys.argv[4] if len(sys.argv) == 5 else 'csv')
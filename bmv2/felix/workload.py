@@ -0,0 +1,455 @@
+# Workload generation: the PCAP files of the traffic demands of an experiment
+#
+# Shared by the build_workload.py scripts of the experiments and by the loss
+# timeline of log_analysis.py, which generates the send times again.
+#
+# Packets are the ones the original scapy loop built, one random.gauss at a
+# time from random.seed(seed), computed with NumPy instead. This relies on
+# the following behaviour of CPython's random.Random (unchanged from 3.2 up
+# to at least 3.13), which check_random verifies when the module is imported:
+# - its Mersenne Twister state (getstate) continues as NumPy's MT19937
+# - getrandbits(k), for k <= 32, is the next 32-bit word shifted right by 32 - k
+# - randint(a, b) and choice draw getrandbits(k) for the smallest k covering
+#   the range and draw again while the value falls outside of it
+# - random() is ((a >> 5)*2**26 + (b >> 6))/2**53 of the next two words
+# - gauss(mu, sigma) draws x2pi = random()*2*pi and
+#   g2rad = sqrt(-2*log(1 - random())), returns mu + cos(x2pi)*g2rad*sigma
+#   and keeps sin(x2pi)*g2rad for its next call
+import json
+import math
+import os
+import random
+import string
+import struct
+import sys
+
+from heapq import heappush, heappop
+from multiprocessing import Pool
+
+import numpy as np
+
+
+BASE_PORT = 50000
+MAX_FRAME_SIZE = 1518 - 4  # Frame Check Sequence
+HDRS_LEN = 14 + 20 + 8  # Eth + IPv4 + UDP
+MSG_LEN = MAX_FRAME_SIZE - HDRS_LEN
+LOREM_LEN = int(1e6)
+LETTERS = string.ascii_letters + string.digits
+DEFAULT_SEED = 42
+TWOPI = 2.0*math.pi  # random.TWOPI
+
+# PCAP format, as written by scapy's wrpcap on a little-endian host
+PCAP_HEADER = struct.Struct('<IHHIIII')  # magic, version, snaplen, linktype
+PCAP_MAGIC = 0xa1b2c3d4
+PCAP_SNAPLEN = 65535
+LINKTYPE_ETHERNET = 1
+RECORD_DTYPE = np.dtype([('sec', '<u4'), ('usec', '<u4'), ('caplen', '<u4'),
+                         ('wirelen', '<u4'), ('frame', 'u1', MAX_FRAME_SIZE)])
+WRITE_CHUNK = 8192  # packets patched at a time
+STREAM_CHUNK = 1 << 16  # packets generated at a time per demand
+PACKET_FIELDS = [('time', np.float64), ('offset', np.int64),
+                 ('ip_id', np.int64), ('ip_tos', np.int64)]
+
+# Word states of the Mersenne Twister stream, following the draws of one
+# packet: randint(0, LOREM_LEN - MSG_LEN - 1) and then gauss(1, 0.1), which
+# takes four words every other packet and returns the value it cached
+# otherwise
+RANDINT_EVEN, GAUSS1, GAUSS2, GAUSS3, GAUSS4, RANDINT_ODD = range(6)
+RANDINT_RANGE = LOREM_LEN - MSG_LEN  # offsets are below this
+RANDINT_SHIFT = 32 - RANDINT_RANGE.bit_length()  # getrandbits(k) of a word
+ON_ACCEPT = np.array([GAUSS1, GAUSS2, GAUSS3, GAUSS4, RANDINT_ODD, RANDINT_EVEN], dtype=np.uint8)
+ON_REJECT = np.array([RANDINT_EVEN, GAUSS2, GAUSS3, GAUSS4, RANDINT_ODD, RANDINT_ODD], dtype=np.uint8)
+WORDS_PER_CHUNK = 1 << 18
+WORDS_PER_PACKET = 4  # 3 on average: 1 randint (rarely more) and 4 gauss every 2
+
+
+def mersenne_twister(rng):
+    # NumPy bit generator continuing the word stream of a random.Random
+    words = rng.getstate()[1]
+    bitgen = np.random.MT19937()
+    bitgen.state = {'bit_generator': 'MT19937',
+                    'state': {'key': np.array(words[:624], dtype=np.uint32),
+                              'pos': words[624]}}
+    return bitgen
+
+
+def random_floats(a, b):
+    # random.random() from two consecutive words
+    return ((a >> 5).astype(np.float64)*67108864.0 + (b >> 6))*(1.0/9007199254740992.0)
+
+
+class PacketDraws:
+    # The payload offsets and interval noises gen_traffic draws, packet after
+    # packet, from random.Random(seed), computed a chunk of words at a time.
+    # Each word moves the stream between the states above; the state before
+    # every word comes from a prefix scan (by doubling) of the composition of
+    # the per-word transitions. Cosines, sines and logarithms go through math,
+    # like in random.gauss, so that noises are the same to the last bit.
+    def __init__(self, seed):
+        self.bitgen = mersenne_twister(random.Random(seed))
+        self.state = RANDINT_EVEN
+        self.offsets = np.zeros(0, dtype=np.int64)
+        self.noises = np.zeros(0)
+        self.gauss_words = [np.zeros(0, dtype=np.uint32) for _ in range(4)]
+
+    def _draw_words(self, n_words):
+        words = self.bitgen.random_raw(n_words).astype(np.uint32)
+        accept = (words >> RANDINT_SHIFT) < RANDINT_RANGE
+        # prefix[i][s] = state after word i starting from state s
+        prefix = np.where(accept[:, None], ON_ACCEPT, ON_REJECT)
+        step = 1
+        while step < len(words):
+            prefix[step:] = np.take_along_axis(prefix[step:], prefix[:-step], axis=1)
+            step = step*2
+        states = np.empty(len(words), dtype=np.uint8)
+        states[0] = self.state
+        states[1:] = prefix[:-1, self.state]
+        self.state = int(prefix[-1, self.state])
+        randint = ((states == RANDINT_EVEN) | (states == RANDINT_ODD)) & accept
+        self.offsets = np.concatenate([self.offsets,
+                                       (words[randint] >> RANDINT_SHIFT).astype(np.int64)])
+        for i, state in enumerate((GAUSS1, GAUSS2, GAUSS3, GAUSS4)):
+            self.gauss_words[i] = np.concatenate([self.gauss_words[i],
+                                                  words[states == state]])
+        # Every complete set of four words gives the noises of two packets
+        n = len(self.gauss_words[3])
+        g1, g2, g3, g4 = [w[:n] for w in self.gauss_words]
+        self.gauss_words = [w[n:] for w in self.gauss_words]
+        x2pi = (random_floats(g1, g2)*TWOPI).tolist()
+        logs = np.fromiter(map(math.log, (1.0 - random_floats(g3, g4)).tolist()),
+                           np.float64, n)
+        g2rad = np.sqrt(-2.0*logs)
+        noises = np.empty(2*n)
+        noises[0::2] = 1.0 + np.fromiter(map(math.cos, x2pi), np.float64, n)*g2rad*0.1
+        noises[1::2] = 1.0 + np.fromiter(map(math.sin, x2pi), np.float64, n)*g2rad*0.1
+        self.noises = np.concatenate([self.noises, noises])
+
+    def take(self, n):
+        # Offsets and noises of the next n packets
+        while len(self.offsets) < n or len(self.noises) < n:
+            short = n - min(len(self.offsets), len(self.noises))
+            self._draw_words(min(short*WORDS_PER_PACKET + 64, WORDS_PER_CHUNK))
+        offsets, self.offsets = self.offsets[:n], self.offsets[n:]
+        noises, self.noises = self.noises[:n], self.noises[n:]
+        return offsets, noises
+
+
+def gen_lorem(seed, n=LOREM_LEN):
+    # n characters of random.Random(seed).choice(LETTERS)
+    bitgen = mersenne_twister(random.Random(seed))
+    shift = 32 - len(LETTERS).bit_length()
+    chars = np.zeros(0, dtype=np.uint32)
+    while len(chars) < n:
+        words = bitgen.random_raw(2*n).astype(np.uint32) >> shift
+        chars = np.concatenate([chars, words[words < len(LETTERS)]])
+    letters = np.frombuffer(LETTERS.encode(), dtype=np.uint8)
+    return letters[chars[:n]]
+
+
+def check_random(seed=DEFAULT_SEED, n=256):
+    # The first n packets and lorem characters, drawn with random.Random as
+    # well, must be the same to the last bit
+    rng = random.Random(seed)
+    offsets = []
+    noises = []
+    for _ in range(n):
+        offsets.append(rng.randint(0, RANDINT_RANGE - 1))
+        noises.append(rng.gauss(1, 0.1))
+    rng = random.Random(seed)
+    letters = ''.join(rng.choice(LETTERS) for _ in range(n))
+    draws_offsets, draws_noises = PacketDraws(seed).take(n)
+    if (draws_offsets.tolist() != offsets or draws_noises.tolist() != noises
+            or gen_lorem(seed, n).tobytes().decode() != letters):
+        raise Exception('random.Random of Python {} does not draw as workload.py '
+                        'reproduces it, the PCAPs would not match.'.format(sys.version.split()[0]))
+
+
+def demand_packets(src, dst, rate, duration, seed=DEFAULT_SEED,
+                   chunk_size=STREAM_CHUNK):
+    # Arrival times, IP identification and TOS fields and payload offsets of
+    # the packets of a demand, in chunks of up to chunk_size packets in order
+    # of time. The same draws as building each packet with scapy, one
+    # random.gauss at a time, from random.seed(seed).
+    t = 0.0 + (dst['num']/1000)
+    delay = 1.0/((rate*1e6)/(8*(HDRS_LEN + MSG_LEN)))
+    draws = PacketDraws(seed)
+    seq = 0
+    while t < float(duration):
+        # Enough packets for the rest of the demand, if they fit in a chunk
+        n_chunk = min(chunk_size, int((float(duration) - t)/delay*1.05) + 64)
+        offsets, noises = draws.take(n_chunk)
+        # Intervals are added one after the other, as in a loop
+        times = np.add.accumulate(np.concatenate([[t], noises*delay]))
+        n = int(np.searchsorted(times >= float(duration), True))
+        n = min(n, n_chunk)
+        nums = np.arange(seq, seq + n)
+        yield {'time': times[:n], 'offset': offsets[:n],
+               'ip_id': nums % 65536, 'ip_tos': (nums // 65536) % 256}
+        t = times[n]
+        seq = seq + n
+
+
+def gen_traffic(src, dst, rate, duration, seed=DEFAULT_SEED):
+    # All the packets of a demand
+    chunks = list(demand_packets(src, dst, rate, duration, seed))
+    return {field: np.concatenate([c[field] for c in chunks]
+                                  if chunks else [np.zeros(0, dtype=dtype)])
+            for field, dtype in PACKET_FIELDS}
+
+
+def merge_demands(streams):
+    # Streaming k-way merge of the chunks of the demands. A heap holds the
+    # time of the last buffered packet of every demand; the earliest of them
+    # bounds what no later chunk can precede, so every buffered packet up to
+    # it is sorted and yielded, and that demand's buffer is refilled. Packets
+    # at the same time keep the order of the demands, as in a stable sort.
+    buffers = {}
+    heap = []
+
+    def refill(i):
+        chunk = next(streams[i], None)
+        if chunk is None:
+            buffers.pop(i, None)
+            return
+        chunk['demand'] = np.full(len(chunk['time']), i)
+        buffers[i] = chunk
+        heappush(heap, (chunk['time'][-1], i))
+
+    for i in range(len(streams)):
+        refill(i)
+    while heap:
+        frontier, i = heappop(heap)
+        parts = []
+        for j in sorted(buffers):
+            n = int(np.searchsorted(buffers[j]['time'], frontier, side='right'))
+            if n > 0:
+                parts.append({f: a[:n] for f, a in buffers[j].items()})
+                buffers[j] = {f: a[n:] for f, a in buffers[j].items()}
+        if parts:
+            packets = {f: np.concatenate([p[f] for p in parts]) for f in parts[0]}
+            order = np.argsort(packets['time'], kind='stable')
+            yield {f: a[order] for f, a in packets.items()}
+        refill(i)
+
+
+def mac_bytes(mac):
+    return bytes(int(x, 16) for x in mac.split(':'))
+
+
+def ip_bytes(ip):
+    return bytes(int(x) for x in ip.split('/')[0].split('.'))
+
+
+def header_template(src, dst):
+    # Eth + IPv4 + UDP headers of a demand, with TOS, identification and
+    # checksums left at zero. Frames go from the source host to its gateway.
+    eth = mac_bytes('08:00:00:00:{:02X}:00'.format(src['snum'])) + mac_bytes(src['mac'])
+    eth = eth + struct.pack('!H', 0x0800)
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + 8 + MSG_LEN, 0, 0, 64, 17,
+                     0, ip_bytes(src['ip']), ip_bytes(dst['ip']))
+    udp = struct.pack('!HHHH', BASE_PORT + dst['num'], BASE_PORT, 8 + MSG_LEN, 0)
+    return np.frombuffer(eth + ip + udp, dtype=np.uint8)
+
+
+def word_sum(data):
+    return sum(struct.unpack('!{}H'.format(len(data)//2), data))
+
+
+def fold(sums):
+    # One's complement of the one's complement sums
+    sums = (sums & 0xffff) + (sums >> 16)
+    sums = (sums & 0xffff) + (sums >> 16)
+    return ~sums & 0xffff
+
+
+class PayloadSums:
+    # Sums of the 16-bit words of every MSG_LEN long window of lorem, from
+    # prefix sums of the bytes at even and at odd positions
+    def __init__(self, lorem):
+        self.windows = np.lib.stride_tricks.sliding_window_view(lorem, MSG_LEN)
+        self.prefix = [np.concatenate([[0], np.cumsum(lorem[p::2], dtype=np.int64)])
+                       for p in (0, 1)]
+
+    def _every_other(self, start):
+        # Sums of lorem[start], lorem[start + 2], ... (MSG_LEN/2 bytes)
+        half = start//2
+        n = MSG_LEN//2
+        even = self.prefix[0][np.minimum(half + n, len(self.prefix[0]) - 1)] - self.prefix[0][half]
+        odd = self.prefix[1][np.minimum(half + n, len(self.prefix[1]) - 1)] - self.prefix[1][half]
+        return np.where(start % 2 == 0, even, odd)
+
+    def sums(self, offsets):
+        return self._every_other(offsets)*256 + self._every_other(offsets + 1)
+
+
+class PcapWriter:
+    # Writes packets (one array per field, demand[i] indexes templates) to a
+    # PCAP file, patching fields and checksums into copies of the header
+    # templates, WRITE_CHUNK packets at a time
+    def __init__(self, filename, templates, lorem):
+        self.file = open(filename, 'wb')
+        self.file.write(PCAP_HEADER.pack(PCAP_MAGIC, 2, 4, 0, 0, PCAP_SNAPLEN,
+                                         LINKTYPE_ETHERNET))
+        self.records = np.zeros(WRITE_CHUNK, dtype=RECORD_DTYPE)
+        self.records['caplen'] = MAX_FRAME_SIZE
+        self.records['wirelen'] = MAX_FRAME_SIZE
+        self.payload = PayloadSums(lorem)
+        self.ip_sums = np.array([word_sum(t[14:34].tobytes()) for t in templates])
+        # UDP pseudo header (addresses, protocol and length) and header
+        self.udp_sums = np.array([word_sum(t[26:34].tobytes()) + 17 + 8 + MSG_LEN
+                                  + word_sum(t[34:42].tobytes()) for t in templates])
+        self.templates = np.array(templates)
+        self.n_packets = np.zeros(len(templates), dtype=np.int64)
+
+    def write(self, packets):
+        n = len(packets['time'])
+        self.n_packets += np.bincount(packets['demand'], minlength=len(self.n_packets))
+        for start in range(0, n, WRITE_CHUNK):
+            end = min(start + WRITE_CHUNK, n)
+            self._write_chunk({f: a[start:end] for f, a in packets.items()})
+
+    def _write_chunk(self, packets):
+        chunk = self.records[:len(packets['time'])]
+        times = packets['time']
+        ip_tos = packets['ip_tos']
+        ip_id = packets['ip_id']
+        offsets = packets['offset']
+        idx = packets['demand']
+        sec = times.astype(np.int64)
+        chunk['sec'] = sec
+        chunk['usec'] = np.rint((times - sec)*1000000)
+        frames = chunk['frame']
+        frames[:, :HDRS_LEN] = self.templates[idx]
+        frames[:, HDRS_LEN:] = self.payload.windows[offsets]
+        frames[:, 15] = ip_tos
+        frames[:, 18] = ip_id >> 8
+        frames[:, 19] = ip_id & 0xff
+        ip_chksum = fold(self.ip_sums[idx] + ip_tos + ip_id)
+        frames[:, 24] = ip_chksum >> 8
+        frames[:, 25] = ip_chksum & 0xff
+        udp_chksum = fold(self.udp_sums[idx] + self.payload.sums(offsets))
+        udp_chksum[udp_chksum == 0] = 0xffff
+        frames[:, 40] = udp_chksum >> 8
+        frames[:, 41] = udp_chksum & 0xff
+        self.file.write(chunk.tobytes())
+
+    def close(self):
+        self.file.close()
+
+
+def gen_host_traffic(info):
+    print('Generating packets for traffic from {}'.format(info['src']['name']))
+    templates = [header_template(info['src'], demand['dst'])
+                 for demand in info['demands']]
+    writer = PcapWriter(info['output_filename'], templates, info['lorem'])
+    streams = []
+    for demand in info['demands']:
+        if info['stream']:
+            packets = demand_packets(src=info['src'],
+                                     dst=demand['dst'],
+                                     rate=demand['rate'],
+                                     duration=info['duration'],
+                                     seed=info['seed'])
+        else:
+            # The whole demand as a single chunk
+            traffic = gen_traffic(src=info['src'],
+                                  dst=demand['dst'],
+                                  rate=demand['rate'],
+                                  duration=info['duration'],
+                                  seed=info['seed'])
+            packets = iter([traffic] if len(traffic['time']) else [])
+        streams.append(packets)
+    # Packets are written in order of time (and of demand among equals) as
+    # they are merged; when streaming, memory does not grow with the duration
+    # of the workload
+    print('Writing packets from {} to pcap file'.format(info['src']['name']), flush=True)
+    for packets in merge_demands(streams):
+        writer.write(packets)
+    writer.close()
+
+    # Logging
+    n_packets = {}
+    for demand, n in zip(info['demands'], writer.n_packets.tolist()):
+        n_packets[demand['dst']['name']] = n
+    return n_packets
+
+
+def main(exp_json):
+    # Load main experiment definition json file
+    with open(exp_json) as f:
+        exp = json.load(f)
+
+    # Read base parameters into variables
+    n_switches = exp['network']['n_switches']
+    hosts_per_switch = exp['network']['hosts_per_switch']
+    if 'edge_switches' in exp['network']:
+        edge_switches = exp['network']['edge_switches']
+    else:
+        edge_switches = ['s{}'.format(i + 1) for i in range(n_switches)]
+    slowdown = exp['slowdown']
+    wl = exp['workload']
+    duration = wl['duration']*slowdown
+    multiplier = wl['multiplier'] if 'multiplier' in wl else 1.0
+    seed = wl['seed'] if 'seed' in wl else DEFAULT_SEED
+    stream = wl['stream'] if 'stream' in wl else False
+
+    # Create basic host dicts
+    hosts = {}
+    for i in range(n_switches):
+        snum = i + 1
+        sname = 's{}'.format(snum)
+        # print(sname)
+        if sname in edge_switches:
+            for j in range(hosts_per_switch):
+                hnum = (snum - 1)*hosts_per_switch + j + 1
+                hname = 'h{}'.format(hnum)
+                # print(hname)
+                hosts[hname] = {
+                    'name': hname,
+                    'num': hnum,
+                    'snum': snum,
+                    'ip': '10.0.{}.{}'.format(snum, hnum),
+                    'mac': '08:00:00:00:{:02X}:{:02X}'.format(snum, hnum),
+                }
+
+
+    # Create demand traffic pcap files
+    lorem = gen_lorem(seed)
+
+    output_dir = '../../' + wl['base_dir']
+    os.makedirs(output_dir, exist_ok=True)
+
+    gen_info = {}
+    for demand in wl['demands']:
+        src_name = demand['src']
+        # Create base info
+        if src_name not in gen_info:
+            gen_info[src_name] = {
+                'src': hosts[src_name],
+                'output_filename': '{}/{}.pcap'.format(output_dir, src_name),
+                'duration': duration,
+                'lorem': lorem,
+                'seed': seed,
+                'stream': stream,
+                'demands': []
+            }
+        # Add new flow
+        gen_info[src_name]['demands'].append({
+            'dst': hosts[demand['dst']],
+            'rate': (demand['rate']/slowdown)*multiplier  # Mbps
+        })
+
+    with Pool(16) as pool:
+        result = pool.map(gen_host_traffic, gen_info.values())
+
+    print(result)
+
+    total_packets = {}
+    for src_name, res in zip(gen_info.keys(), result):
+        total_packets[src_name] = res
+
+    with open('{}/build_workload_log.json'.format(output_dir), 'w') as f:
+        json.dump(total_packets, f, indent=4)
+
+
+check_random()
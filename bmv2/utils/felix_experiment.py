@@ -2,11 +2,15 @@ from __future__ import print_function
 
 import json
 import os
+import signal
 import subprocess
 import sys
 import time
 
 
+ROUTING_EXIT_TIMEOUT = 10  # seconds before the routing script is killed
+
+
 def run(mn, net_cli, exp_json='config/experiment.json'):
     # Load main experiment definition json file
     with open(exp_json) as f:
@@ -25,6 +29,7 @@ def run(mn, net_cli, exp_json='config/experiment.json'):
         edge_switches = ['s{}'.format(i + 1) for i in range(n_switches)]
     run_workload = exp['run_workload'] if 'run_workload' in exp else False
     sim_failures = exp['sim_failures'] if 'sim_failures' in exp else False
+    receiver_log = exp['receiver_log'] if 'receiver_log' in exp else 'csv'
     wl = exp['workload']
     p4prog = exp['p4prog']
 
@@ -48,8 +53,6 @@ def run(mn, net_cli, exp_json='config/experiment.json'):
     routing_proc = None
     routing_stdout = None
     print('\nStarting Routing Script:', p4prog.capitalize())
-    with open('/tmp/felix_routing_exit_flag', 'w') as f:
-        f.write('0')
     if p4prog == 'felix':
         cmd = ['sudo', python3path, '-u', 'felix_routing.py', 'config/topology.json']
         routing_stdout = open('logs/felix_routing.txt', 'w')
@@ -86,7 +89,7 @@ def run(mn, net_cli, exp_json='config/experiment.json'):
             # Send command
             cmd = 'timeout -sSIGINT {timeout} '
             cmd += 'sudo {python3path} -u'
-            cmd += ' traffic_receiver.py {dst_name} {dst_ip} {dst_port} '
+            cmd += ' traffic_receiver.py {dst_name} {dst_ip} {dst_port} {mode} '
             cmd += '&> logs/{log_file} &'
             cmd = cmd.format(
                 python3path=python3path,
@@ -94,6 +97,7 @@ def run(mn, net_cli, exp_json='config/experiment.json'):
                 dst_name=recv_host,
                 dst_ip=dst_ip,
                 dst_port=dst_port,
+                mode=receiver_log,
                 log_file=log_file
             )
             print('{}$ {}'.format(recv_host, cmd))
@@ -172,10 +176,13 @@ def run(mn, net_cli, exp_json='config/experiment.json'):
 
     # Stop Routing Script
     print('\nSignalling Routing Script to Finish')
-    with open('/tmp/felix_routing_exit_flag', 'w') as f:
-        f.write('1')
+    # sudo relays SIGTERM to the routing script, which exits right away
+    routing_proc.send_signal(signal.SIGTERM)
     print('Waiting for Routing Script to Finish')
     sys.stdout.flush()
-    time.sleep(10)
-    routing_proc.kill()
+    deadline = time.time() + ROUTING_EXIT_TIMEOUT
+    while routing_proc.poll() is None and time.time() < deadline:
+        time.sleep(0.1)
+    if routing_proc.poll() is None:
+        routing_proc.kill()
     routing_stdout.close()
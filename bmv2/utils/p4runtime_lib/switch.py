@@ -12,7 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
-from Queue import Queue
+from __future__ import print_function
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
 from abc import abstractmethod
 from datetime import datetime
 
@@ -63,7 +67,7 @@ class SwitchConnection(object):
         request.arbitration.election_id.low = 1
 
         if dry_run:
-            print "P4Runtime MasterArbitrationUpdate: ", request
+            print("P4Runtime MasterArbitrationUpdate: ", request)
         else:
             self.requests_stream.put(request)
             for item in self.stream_msg_resp:
@@ -81,7 +85,7 @@ class SwitchConnection(object):
 
         request.action = p4runtime_pb2.SetForwardingPipelineConfigRequest.VERIFY_AND_COMMIT
         if dry_run:
-            print "P4Runtime SetForwardingPipelineConfig:", request
+            print("P4Runtime SetForwardingPipelineConfig:", request)
         else:
             self.client_stub.SetForwardingPipelineConfig(request)
 
@@ -96,7 +100,18 @@ class SwitchConnection(object):
             update.type = p4runtime_pb2.Update.INSERT
         update.entity.table_entry.CopyFrom(table_entry)
         if dry_run:
-            print "P4Runtime Write:", request
+            print("P4Runtime Write:", request)
+        else:
+            self.client_stub.Write(request)
+
+    def WriteUpdates(self, updates, dry_run=False):
+        # Batched write: a single WriteRequest holding many updates
+        request = p4runtime_pb2.WriteRequest()
+        request.device_id = self.device_id
+        request.election_id.low = 1
+        request.updates.extend(updates)
+        if dry_run:
+            print("P4Runtime Write:", request)
         else:
             self.client_stub.Write(request)
 
@@ -110,7 +125,7 @@ class SwitchConnection(object):
         else:
             table_entry.table_id = 0
         if dry_run:
-            print "P4Runtime Read:", request
+            print("P4Runtime Read:", request)
         else:
             for response in self.client_stub.Read(request):
                 yield response
@@ -127,7 +142,7 @@ class SwitchConnection(object):
         if index is not None:
             counter_entry.index.index = index
         if dry_run:
-            print "P4Runtime Read:", request
+            print("P4Runtime Read:", request)
         else:
             for response in self.client_stub.Read(request):
                 yield response
@@ -141,7 +156,7 @@ class SwitchConnection(object):
         update.type = p4runtime_pb2.Update.INSERT
         update.entity.packet_replication_engine_entry.CopyFrom(pre_entry)
         if dry_run:
-            print "P4Runtime Write:", request
+            print("P4Runtime Write:", request)
         else:
             self.client_stub.Write(request)
 
@@ -28,6 +28,7 @@ import copy
 import json
 import math
 import random
+import sys
 import time
 
 from multiprocessing import Pool
@@ -37,6 +38,9 @@ import networkx as nx
 import numpy as np
 import pandas as pd
 
+sys.path.append('../bmv2/felix')
+import spdag
+
 
 # %%
 # MATPLOTLIB AND SEABORN
@@ -97,39 +101,14 @@ def cnft(nm, graph, dst):
     n = nm['n_nodes']
     n_dst = len(nm['edge_switches']) if 'edge_switches' in nm else n
 
-    n_entries = np.zeros(n, dtype=np.uint)  # [cur] -> number of forwarding entries in cur
-    nexthops = {}  # [cur] -> list of next hops from cur to dst
-    prevhops = {}  # [cur] -> list of previous hops from cur to dst
-    reachability = np.zeros(n_dst, dtype=np.bool_)  # [src] -> reachability from src to dst
+    nexthops = np.zeros(n, dtype=np.uint64)  # [cur] -> bitmask of next hops from cur to dst
     dist = np.empty(n)  # [cur] -> distance from cur to dst
-    dist.fill(math.inf)
-    dist[dst] = 0
-    visited = np.zeros(n, dtype=np.bool_)
-    
-    queue = [(0, dst)]
-    while queue:
-        _, u = heappop(queue)
-        if visited[u]:
-            continue
-        visited[u] = 1
-        if u < n_dst:
-            reachability[u] = 1
-        if len(nexthops) > 0:
-            n_entries[u] = n_entries[u] + 1
-        prevhops[u] = set()
-        for v, md in graph.adj[u].items():
-            dist_via_u = dist[u] + md['w']
-            distdiff = dist_via_u - dist[v]
-            if distdiff < 0:
-                nexthops[v] = set([u])
-                dist[v] = dist_via_u
-                prevhops[u].add(v)
-                heappush(queue, (dist_via_u, v))
-            elif distdiff == 0:
-                nexthops[v].add(u)
-                prevhops[u].add(v)
-
-    return (n_entries, nexthops, prevhops, reachability, dist)
+    spdag.dijkstra(graph, dst, [False]*graph.n_links, nexthops, dist)
+
+    n_entries = (nexthops != 0).astype(np.uint)  # [cur] -> number of forwarding entries in cur
+    reachability = dist[:n_dst] != math.inf  # [src] -> reachability from src to dst
+
+    return (n_entries, nexthops, None, reachability, dist)
 
 # %%
 def cnft_worker(nm, graph, worker_id, n_workers):
@@ -137,21 +116,19 @@ def cnft_worker(nm, graph, worker_id, n_workers):
     n_dst = len(nm['edge_switches']) if 'edge_switches' in nm else n
 
     n_entries = np.zeros(n, dtype=np.uint)  # [cur] -> number of forwarding entries in cur
-    nexthops = {}  # [dst][cur] -> list of next hops from cur to dst
-    prevhops = {}  # [dst][cur] -> list of previous hops from cur to dst
+    nexthops = np.zeros((n_dst, n), dtype=np.uint64)  # [dst][cur] -> bitmask of next hops from cur to dst
     reachability = np.zeros((n_dst, n_dst), dtype=np.bool_)  # [dst][src] -> reachability from src to dst
-    dist = {}  # [dst][cur] -> distance from cur to dst
+    dist = np.full((n_dst, n), math.inf)  # [dst][cur] -> distance from cur to dst
 
     for i, dst in enumerate(range(n_dst)):
         if (i % n_workers) == worker_id:
             results = cnft(nm, graph, dst)
             n_entries = n_entries + results[0]
             nexthops[dst] = results[1]
-            prevhops[dst] = results[2]
             reachability[dst] = results[3]
             dist[dst] = results[4]
     
-    return (n_entries, nexthops, prevhops, reachability, dist)
+    return (n_entries, nexthops, None, reachability, dist)
 
 
 def cnft_iface(nm, graph, n_workers):
@@ -159,10 +136,9 @@ def cnft_iface(nm, graph, n_workers):
     n_dst = len(nm['edge_switches']) if 'edge_switches' in nm else n
 
     n_entries = np.zeros(n, dtype=np.uint)  # [cur] -> number of forwarding entries in cur
-    nexthops = {}  # [dst][cur] -> list of next hops from cur to dst
-    prevhops = {}  # [dst][cur] -> list of previous hops from cur to dst
+    nexthops = np.zeros((n_dst, n), dtype=np.uint64)  # [dst][cur] -> bitmask of next hops from cur to dst
     reachability = np.zeros((n_dst, n_dst), dtype=np.bool_)  # [dst][src] -> reachability from src to dst
-    dist = {}  # [dst][cur] -> distance from cur to dst
+    dist = np.full((n_dst, n), math.inf)  # [dst][cur] -> distance from cur to dst
 
     worker_arguments = ((nm, graph, i, n_workers) for i in range(n_workers))
     with Pool(processes=n_workers) as pool:
@@ -170,12 +146,11 @@ def cnft_iface(nm, graph, n_workers):
     
     for worker_results in workers_results:
         n_entries = n_entries + worker_results[0]
-        nexthops.update(worker_results[1])
-        prevhops.update(worker_results[2])
+        nexthops = nexthops | worker_results[1]
         reachability = reachability + worker_results[3]
-        dist.update(worker_results[4])
+        dist = np.minimum(dist, worker_results[4])
     
-    return ForwardingTactic(0, n_entries, nexthops, prevhops, reachability, dist)
+    return ForwardingTactic(0, n_entries, nexthops, None, reachability, dist)
 
 
 
@@ -199,129 +174,25 @@ def caft(nm, graph, nft, ftid, failure_set):
     n_dst = len(nm['edge_switches']) if 'edge_switches' in nm else n
     # n_dst = n
 
-    nexthops = {}  # [dst][cur] -> list of next hops from cur to dst
-    # prevhops = {}  # [dst][cur] -> list of previous hops from cur to dst
-    n_entries = np.zeros(n, dtype=np.uint)  # [cur] -> number of forwarding entries in cur
     n_transition_entries = np.zeros(n, dtype=np.uint)  # [cur] -> number of forwarding entries in cur
-    reachability = copy.deepcopy(nft.reachability)  # [dst][src] -> reachability from src to dst
-    dist = copy.deepcopy(nft.dist)  # [dst][cur] -> distance from cur to dst
-
-    cur_graph = graph.copy()
     for (u, v) in failure_set:
-        cur_graph.remove_edge(u, v)
         n_transition_entries[u] = n_transition_entries[u] + 1
         n_transition_entries[v] = n_transition_entries[v] + 1
 
-    for dst in range(n_dst):
-        # print(f"Destination: {node(dst)}")
-        # print(f"Distance: {dist[dst]}")
-        recompute = []
-        visited = np.ones(n, dtype=np.bool_)
-        # Marks all the nodes that will have to have nexthops recomputed
-        for (u, v) in failure_set:
-            if debug: print(f"Failed Element: {(node(u), node(v))}")
-            distdiff = nft.dist[dst][u] - nft.dist[dst][v]
-            
-            # if both nodes are on the same level,
-            if distdiff == 0:
-                # then there is no dependency and no need to change forwarding
-                continue
-            
-            # make sure u is always the node further away from dst
-            if distdiff < 0:
-                u, v = v, u
-            
-            # if we have not dealt with u already (set dist to infinity)
-            # and link (u, v) is in the SPDAG to dst
-            if dist[dst][u] != math.inf and v in nft.nexthops[dst][u]:
-                # a change in forwarding is definitely needed
-                # perform a reverse BFS on the graph
-                # print(f"Setting dist[{dst}][{u}] to math.inf.")
-                dist[dst][u] = math.inf
-                queue = collections.deque([u])
-                while queue:
-                    u = queue.popleft()
-                    # print(f"Node {node(u)} is affected!")
-                    # add node to list of recompute (partial Dijkstra)
-                    recompute.append(u)
-                    # update reachability temporarily
-                    if u < n_dst:
-                        reachability[dst][u] = 0
-                    # mark as not visited
-                    visited[u] = 0
-                    # add original prevhops as next to be updated
-                    for v in nft.prevhops[dst][u]:
-                        if dist[dst][v] != math.inf:
-                            # print(f"Setting dist[{dst}][{v}] to math.inf.")
-                            dist[dst][v] = math.inf
-                            queue.append(v)
-        
-        # If there are nodes that need to have their nextgops recomputed
-        if recompute:
-            nexthops[dst] = {}
-            # prevhops[dst] = {}
-
-            # Build initial priority queue for Dijkstra
-            heapq = []
-            # print(f"Preparing to recompute:")
-            for u in recompute:
-                # compute the shortest known available path length from u to dst
-                # and the appropriate nexthops
-                min_dist = math.inf
-                nhs = set()
-                for v, md in cur_graph.adj[u].items():
-                    if dist[dst][v] != math.inf:
-                        dist_via_v = dist[dst][v] + md['w']
-                        distdiff = dist_via_v - min_dist
-                        if distdiff < 0:
-                            min_dist = dist_via_v
-                            nhs = set([v])
-                        elif distdiff == 0:
-                            nhs.add(v)
-                # update dist and nexthops variables
-                # print(f"Setting dist[{dst}][{u}] to {min_dist}.")
-                dist[dst][u] = min_dist
-                nexthops[dst][u] = nhs
-                # print(f"Node: {node(u)} => {[node(x) for x in nhs]} ({min_dist})")
-                # add to priority queue only if cost is not infinity
-                if min_dist != math.inf:
-                    heappush(heapq, (min_dist, u))
-            
-            # Recompute shortest paths for the affected nodes
-            while heapq:
-                _, u = heappop(heapq)
-                # print(end=f"Extracted node {node(u)} from priority queue. ")
-                # update reachability
-                if u < n_dst:
-                    reachability[dst][u] = 1
-                # update visited
-                visited[u] = 1
-                # check if alternative forwarding entry is necessary
-                ## prefered version
-                if nexthops[dst][u] and not nexthops[dst][u].issuperset(nft.nexthops[dst][u]):
-                    n_entries[u] = n_entries[u] + 1
-                ## simpler version
-                # if nexthops[dst][u] != nft.nexthops[dst][u]:
-                #     n_entries[u] = n_entries[u] + 1
-                # print(f"Best path has cost {dist[dst][u]} via {[node(x) for x in nexthops[dst][u]]}.")
-                # relax path costs to neighbors
-                for v, md in cur_graph.adj[u].items():
-                    # print(f"Checking neighbor node {node(v)}, current cost is {dist[dst][v]}.")
-                    # if best path to v hasn't already been found
-                    if not visited[v]:
-                        dist_via_u = dist[dst][u] + md['w']
-                        distdiff = dist_via_u - dist[dst][v]
-                        # if path from v through u is (one of) the best
-                        if distdiff < 0:
-                            # update dist and replace nexthops
-                            # print(f"Setting dist[{dst}][{u}] to {dist_via_u}.")
-                            dist[dst][v] = dist_via_u
-                            nexthops[dst][v] = set([u])
-                            # update cost on the priority queue
-                            heappush(heapq, (dist_via_u, v))
-                        elif distdiff == 0:
-                            # update nexthops
-                            nexthops[dst][v].add(u)
+    # Repair the SPDAG to each dst only for the nodes affected by the failures
+    # (reverse BFS over the SPDAG followed by a partial Dijkstra)
+    nfs = spdag.ForwardingState(graph, graph.link_mask([]), nft.nexthops, nft.dist)
+    afs = nfs.derive(failure_set)
+    nexthops = afs.nexthops  # [dst][cur] -> bitmask of next hops from cur to dst
+    dist = afs.dist  # [dst][cur] -> distance from cur to dst
+    reachability = dist[:, :n_dst] != math.inf  # [dst][src] -> reachability from src to dst
+
+    # check if alternative forwarding entry is necessary
+    ## prefered version
+    alt = (nexthops != 0) & ((nft.nexthops & ~nexthops) != 0)
+    ## simpler version
+    # alt = (nexthops != 0) & (nexthops != nft.nexthops)
+    n_entries = alt.sum(axis=0).astype(np.uint)  # [cur] -> number of forwarding entries in cur
     
     if False:
         print(f"### Alternative Forwarding for Failure Set: {[(u + 1, v + 1) for (u, v) in failure_set]}")
@@ -333,11 +204,8 @@ def caft(nm, graph, nft, ftid, failure_set):
             for cur in range(n):
                 if cur == dst: continue
                 if nexthops[dst][cur] != nft.nexthops[dst][cur]:
-                    print(end=f" {cur + 1}=>{np.array(list(nexthops[dst][cur])) + 1}")
+                    print(end=f" {cur + 1}=>{np.array(afs.next_hops(dst, cur)) + 1}")
             print()
-            # print(f"# Prev Hops:")
-            # for cur, phs in sorted(prevhops[dst].items()):
-            #     print(f"{cur + 1}: {np.array(list(phs)) + 1}")
             # print(f"Distance: {dist[dst]}")
 
     # return ForwardingTactic(ftid, n_entries, nexthops, None, reachability, dist, n_transition_entries, failure_set)
@@ -345,15 +213,15 @@ def caft(nm, graph, nft, ftid, failure_set):
 
 # %%
 def caft_worker(nm, graph, nft, worker_id, n_workers):
-    n = len(graph.nodes)
-    m = len(graph.edges)
+    n = graph.n_nodes
+    m = graph.n_links
 
     # fts = {}
 
     worker_n_entries = np.zeros(n)
     worker_n_transition_entries = np.zeros(n)
     n_fs_prepd = 0
-    for i, link in enumerate(graph.edges):
+    for i, link in enumerate(graph.links):
         if (i % n_workers) == worker_id:
             ftid = i + 1
             aft = caft(nm, graph, nft, ftid, [link])
@@ -364,7 +232,7 @@ def caft_worker(nm, graph, nft, worker_id, n_workers):
     for i, node in enumerate(graph.nodes):
         if ((m + i) % n_workers) == worker_id:
             ftid = m + i + 1
-            aft = caft(nm, graph, nft, ftid, [(node, v) for v in graph.adj[node]])
+            aft = caft(nm, graph, nft, ftid, [(node, v) for v in graph.neighbors(node)])
             worker_n_entries = worker_n_entries + aft.n_entries
             worker_n_transition_entries = worker_n_transition_entries + aft.n_transition_entries
             # fts[ftid] = aft
@@ -380,12 +248,13 @@ def evaluate(nm, graph, n_workers):
     n = len(graph.nodes)
     m = len(graph.edges)
     n_fts = 1 + n + m
+    csr = spdag.CSRGraph.from_networkx(graph, nodes=range(n), weight='w')
 
     print(end=f"  Compute normal forwarding entries", flush=True)
     # fts = {}
     fts = [None for _ in range(n_fts)]
     ts = time.time()
-    fts[0] = cnft_iface(nm, graph, n_workers)
+    fts[0] = cnft_iface(nm, csr, n_workers)
     normal_time = round(time.time() - ts, 6)
     print(f"\r  Normal: time={normal_time:.6f}s n_entries={fts[0].total_n_entries}", flush=True)
 
@@ -399,7 +268,7 @@ def evaluate(nm, graph, n_workers):
     global_n_entries = np.zeros(len(graph.nodes))
     global_n_transition_entries = np.zeros(len(graph.nodes))
     ts = time.time()
-    worker_arguments = ((nm, graph, fts[0], i, n_workers) for i in range(n_workers))
+    worker_arguments = ((nm, csr, fts[0], i, n_workers) for i in range(n_workers))
     with Pool(processes=n_workers) as pool:
         workers_results = pool.starmap(caft_worker, worker_arguments)
     alt_time = round(time.time() - ts, 6)